@@ -0,0 +1,65 @@
+import statistics
+import time
+from typing import Awaitable, Callable, List, Optional
+
+
+class BenchmarkUtils:
+
+    @staticmethod
+    def measure_latencies(func: Callable[[], object], repeat: int) -> List[float]:
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - start)
+
+        return latencies
+
+    @staticmethod
+    def time_async_calls(func: Callable[..., Awaitable], latencies: List[float]) -> Callable[..., Awaitable]:
+        # Wraps a coroutine function so the latency of every call made by the pipeline itself is recorded
+        async def timed_func(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+        return timed_func
+
+    @staticmethod
+    def percentile(values: List[float], percent: float) -> float:
+        if not values:
+            return 0.0
+
+        sorted_values = sorted(values)
+        index = min(len(sorted_values) - 1, max(0, round(percent / 100 * len(sorted_values)) - 1))
+        return sorted_values[index]
+
+    @staticmethod
+    def summarize(name: str, latencies: List[float], items_per_call: int = 1, items: Optional[int] = None,
+                  wall_seconds: Optional[float] = None) -> dict:
+        # Concurrent calls overlap, pass the wall clock time and the item count to get their real throughput
+        total_seconds = wall_seconds if wall_seconds is not None else sum(latencies)
+        items = items if items is not None else len(latencies) * items_per_call
+        return {
+            "name": name,
+            "calls": len(latencies),
+            "items": items,
+            "total_seconds": total_seconds,
+            "throughput_per_second": items / total_seconds if total_seconds else 0.0,
+            "mean_ms": statistics.mean(latencies) * 1000 if latencies else 0.0,
+            "p50_ms": BenchmarkUtils.percentile(latencies, 50) * 1000,
+            "p95_ms": BenchmarkUtils.percentile(latencies, 95) * 1000,
+            "p99_ms": BenchmarkUtils.percentile(latencies, 99) * 1000,
+        }
+
+    @staticmethod
+    def print_summary(summary: dict) -> None:
+        line = (f"{summary['name']}: {summary['items']} items in {summary['total_seconds']:.3f}s "
+                f"({summary['throughput_per_second']:.1f}/s)")
+        if summary["calls"] > 1:
+            line += f", p50={summary['p50_ms']:.2f}ms p95={summary['p95_ms']:.2f}ms p99={summary['p99_ms']:.2f}ms"
+
+        print(line)
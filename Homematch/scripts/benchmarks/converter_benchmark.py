@@ -0,0 +1,85 @@
+import argparse
+import random
+import re
+import time
+
+from scripts.benchmarks.benchmark_utils import BenchmarkUtils
+from scripts.models import HouseListing, ListingConverter, ListingDocument
+
+
+class ConverterBenchmark:
+    """
+    Measures parsing listing texts back into listings over a synthetic corpus: the previous per-call regex
+    implementation against the precompiled single-pass codec, both into validated HouseListings and into
+    compact ListingRecords. Also checks that text -> listing -> text round-trips losslessly.
+    """
+
+    def __init__(self, num_listings: int = 100000, seed: int = 0):
+        self.num_listings = num_listings
+        self.random = random.Random(seed)
+
+    def run(self) -> None:
+        listings = [self._create_listing(i) for i in range(self.num_listings)]
+        texts = [ListingConverter.convert_houselisting_to_text(listing) for listing in listings]
+        documents = [ListingDocument(text, {}) for text in texts]
+
+        summaries = [
+            self._measure("legacy regex -> HouseListing", lambda: [self._legacy_convert(doc) for doc in documents]),
+            self._measure("codec -> HouseListing", lambda: [ListingConverter.convert_text_to_houselisting(doc)
+                                                            for doc in documents]),
+            self._measure("codec -> ListingRecord", lambda: [ListingConverter.convert_text_to_record(text)
+                                                             for text in texts]),
+        ]
+        for summary in summaries:
+            BenchmarkUtils.print_summary(summary)
+
+        print(f"Speedup into HouseListing: {summaries[0]['total_seconds'] / summaries[1]['total_seconds']:.1f}x, "
+              f"into ListingRecord: {summaries[0]['total_seconds'] / summaries[2]['total_seconds']:.1f}x")
+
+        lossless = all(ListingConverter.convert_houselisting_to_text(ListingConverter.convert_text_to_record(text))
+                       == text for text in texts)
+        lossless = lossless and all(ListingConverter.convert_text_to_houselisting(document) == listing
+                                    for document, listing in zip(documents, listings))
+        print(f"Round-trip lossless: {lossless}")
+
+    def _measure(self, name: str, func) -> dict:
+        start = time.perf_counter()
+        func()
+        return BenchmarkUtils.summarize(name, [time.perf_counter() - start], items_per_call=self.num_listings)
+
+    def _create_listing(self, index: int) -> HouseListing:
+        bedrooms = self.random.randint(1, 6)
+        return HouseListing(**{
+            "Neighborhood": f"Neighborhood {index % 500}",
+            "Price": f"${self.random.randint(200, 3000) * 1000:,}",
+            "Bedrooms": bedrooms,
+            "Bathrooms": max(1, bedrooms - self.random.randint(0, 2)),
+            "House Size": f"{self.random.randint(800, 6000):,} sqft",
+            "Description": f"A {bedrooms}-bedroom home number {index}.\nIt has a garden and a garage.",
+        })
+
+    @staticmethod
+    def _legacy_convert(listing_text: ListingDocument) -> HouseListing:
+        parsed_data = {}
+        patterns = {
+            'Neighborhood': re.compile(r'neighborhood:(.*?)\n'),
+            'Price': re.compile(r'price:(.*?)\n'),
+            'Bedrooms': re.compile(r'bedrooms:(.*?)\n'),
+            'Bathrooms': re.compile(r'bathrooms:(.*?)\n'),
+            'House Size': re.compile(r'house size:(.*?)\n'),
+            'Description': re.compile(r'description:(.*)', re.DOTALL)
+        }
+
+        for key, pattern in patterns.items():
+            match = pattern.search(listing_text.page_content)
+            if match:
+                parsed_data[key] = match.group(1).strip()
+
+        return HouseListing(**parsed_data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the listing text codec")
+    parser.add_argument("--num-listings", type=int, default=100000)
+    args = parser.parse_args()
+    ConverterBenchmark(args.num_listings).run()
@@ -0,0 +1,115 @@
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+from scripts.embeddings import EMBEDDING_BACKENDS
+from scripts.vector_stores import VECTOR_STORES
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 'import time: self [us] | cumulative | name', the name is indented by its nesting depth
+IMPORT_TIME_PATTERN = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+# The modules each command of home_matcher.py imports: the CLI, then the stages it creates on first use
+STAGE_MODULES = {
+    "generate": ["scripts.listings_creator_langchain", "scripts.call_gen_ai_langchain", "langchain.output_parsers"],
+    "ingest": ["scripts.listings_creator_langchain"],
+    "search": ["scripts.db_semantic_searcher"],
+    "personalize": ["scripts.listing_personalizer"],
+}
+STAGE_MODULES["precompute"] = [*STAGE_MODULES["search"], *STAGE_MODULES["personalize"]]
+STAGE_MODULES["match"] = [*STAGE_MODULES["generate"], *STAGE_MODULES["search"], *STAGE_MODULES["personalize"]]
+
+
+class ImportBenchmark:
+    """
+    Measures the import time of every command of home_matcher.py with python -X importtime: each run is a fresh
+    interpreter importing the CLI and the modules of the command's stages, plus the modules the chosen embedding
+    backend and vector store import lazily. Reports the median total import time over the runs and the
+    packages that cost the most, with the packages they import.
+    """
+
+    def __init__(self, commands: List[str], embedding_backend: str = "hashing", vector_store: str = "numpy",
+                 runs: int = 5, top: int = 5):
+        self.commands = commands
+        self.embedding_backend = embedding_backend
+        self.vector_store = vector_store
+        self.runs = runs
+        self.top = top
+
+    def run(self) -> Dict[str, float]:
+        import_times = {}
+        for command in self.commands:
+            totals, packages = [], {}
+            for _ in range(self.runs):
+                total, run_packages = self._measure(self._get_modules(command))
+                totals.append(total)
+                for package, cumulative in run_packages.items():
+                    packages.setdefault(package, []).append(cumulative)
+
+            import_times[command] = statistics.median(totals) / 1000
+            # The scripts package holds the whole run, the packages below it are the ones worth looking at
+            heaviest = sorted([package for package in packages if package != "scripts"],
+                              key=lambda package: statistics.median(packages[package]), reverse=True)
+            print(f"{command}: {import_times[command]:.1f}ms, heaviest: " +
+                  ", ".join(f"{package} {statistics.median(packages[package]) / 1000:.1f}ms"
+                            for package in heaviest[:self.top]))
+
+        return import_times
+
+    def _get_modules(self, command: str) -> List[str]:
+        modules = ["scripts.home_matcher", *STAGE_MODULES[command]]
+        if command == "personalize":
+            return modules
+
+        if self.vector_store == "chroma":
+            modules.append("langchain.vectorstores")
+
+        if self.embedding_backend == "openai":
+            modules.append("langchain.embeddings")
+
+        return modules
+
+    @staticmethod
+    def _measure(modules: List[str]) -> Tuple[int, Dict[str, int]]:
+        # Returns the total import time and the cumulative import time of every package, in microseconds
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+                                capture_output=True, text=True, check=True, cwd=PROJECT_ROOT_PATH,
+                                env={**os.environ, "PYTHONPATH": PROJECT_ROOT_PATH})
+        total, packages = 0, {}
+        # The lines come children first, so the imports made by a module are pending until its own line
+        pending_children: Dict[int, List[Tuple[str, int]]] = {}
+        for line in result.stderr.splitlines():
+            match = IMPORT_TIME_PATTERN.match(line)
+            if not match:
+                continue
+
+            depth, package, cumulative = len(match.group(3)) // 2, match.group(4).split(".")[0], int(match.group(2))
+            # A package is counted where it is entered from another one, its own submodules are already included
+            for child_package, child_cumulative in pending_children.pop(depth + 1, []):
+                if child_package != package:
+                    packages[child_package] = packages.get(child_package, 0) + child_cumulative
+
+            if depth == 0:
+                total += cumulative
+                packages[package] = packages.get(package, 0) + cumulative
+
+            else:
+                pending_children.setdefault(depth, []).append((package, cumulative))
+
+        return total, packages
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the import time of the home_matcher.py commands")
+    parser.add_argument("--commands", default=",".join(STAGE_MODULES),
+                        help="Comma separated commands to measure")
+    parser.add_argument("--embedding-backend", choices=sorted(EMBEDDING_BACKENDS), default="hashing")
+    parser.add_argument("--vector-store", choices=sorted(VECTOR_STORES), default="numpy")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5, help="Number of the heaviest packages to print")
+    args = parser.parse_args()
+    ImportBenchmark(args.commands.split(","), args.embedding_backend, args.vector_store, args.runs, args.top).run()
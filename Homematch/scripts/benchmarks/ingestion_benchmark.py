@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import os
+import random
+import time
+from typing import List, Tuple
+
+from scripts.benchmarks.benchmark_utils import BenchmarkUtils
+from scripts.models import ListingConverter
+from scripts.resources.consts import CPU_POOL_CHUNK_SIZE
+from scripts.utils.cpu_pool import CpuPool
+
+
+class IngestionBenchmark:
+    """
+    Measures the CPU stage of the ingestion (validating the listings of listings.json, then converting them to the
+    text, id and metadata they are stored with) over a synthetic corpus: in place on the event loop, then in the
+    CPU pool with every worker count.
+    Reports the throughput and the longest stall of the event loop, measured by a ticker task running next to it,
+    so the scaling with the cores and the time the loop is free for its network calls are both visible.
+    """
+
+    def __init__(self, num_listings: int = 100000, worker_counts: List[int] = None,
+                 chunk_size: int = CPU_POOL_CHUNK_SIZE, seed: int = 0):
+        self.num_listings = num_listings
+        self.worker_counts = worker_counts or list(range(1, (os.cpu_count() or 1) + 1))
+        self.chunk_size = chunk_size
+        self.random = random.Random(seed)
+
+    def run(self) -> None:
+        listings_data = [self._create_listing_data(i) for i in range(self.num_listings)]
+        summaries = []
+        # An inline pool never offloads, it is the pipeline before the CPU pool
+        for name, cpu_pool in [("inline", CpuPool(1, self.chunk_size, min_offload_items=self.num_listings + 1)),
+                               *((f"{workers} workers", CpuPool(workers, self.chunk_size))
+                                 for workers in self.worker_counts)]:
+            try:
+                # Starting the workers is a one time cost, it is not part of the measure
+                asyncio.run(cpu_pool.map_chunks(ListingConverter.validate_listings, listings_data[:1]))
+                wall_seconds, max_stall = asyncio.run(self._measure(cpu_pool, listings_data))
+
+            finally:
+                cpu_pool.close()
+
+            summary = BenchmarkUtils.summarize(name, [wall_seconds], items=self.num_listings)
+            summaries.append(summary)
+            BenchmarkUtils.print_summary(summary)
+            print(f"{name}: longest event loop stall {max_stall * 1000:.1f}ms")
+
+        print(", ".join(f"{summary['name']} {summaries[0]['total_seconds'] / summary['total_seconds']:.2f}x"
+                        for summary in summaries[1:]) + " the inline throughput")
+
+    async def _measure(self, cpu_pool: CpuPool, listings_data: List[dict]) -> Tuple[float, float]:
+        stalls = []
+        ticker = asyncio.create_task(self._tick(stalls))
+        await asyncio.sleep(0)
+        start = time.perf_counter()
+        validated_listings = await cpu_pool.map_chunks(ListingConverter.validate_listings, listings_data)
+        records = [listing for listing, _ in validated_listings if listing is not None]
+        await cpu_pool.map_chunks(ListingConverter.convert_records_to_documents, records)
+        wall_seconds = time.perf_counter() - start
+        # Lets the ticker record the stall the work ended on
+        await asyncio.sleep(0.002)
+        ticker.cancel()
+        return wall_seconds, max(stalls, default=0.0)
+
+    @staticmethod
+    async def _tick(stalls: List[float], interval: float = 0.001) -> None:
+        # A free loop wakes the ticker about every interval, the overshoot is the time the loop was held
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            stalls.append(time.perf_counter() - start - interval)
+
+    def _create_listing_data(self, index: int) -> dict:
+        bedrooms = self.random.randint(1, 6)
+        return {
+            "Neighborhood": f"Neighborhood {index % 500}",
+            "Price": f"${self.random.randint(200, 3000) * 1000:,}",
+            "Bedrooms": bedrooms,
+            "Bathrooms": max(1, bedrooms - self.random.randint(0, 2)),
+            "House Size": f"{self.random.randint(800, 6000):,} sqft",
+            "Description": f"A {bedrooms}-bedroom home number {index}.\nIt has a garden and a garage.",
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the CPU stage of the ingestion with the CPU pool")
+    parser.add_argument("--num-listings", type=int, default=100000)
+    parser.add_argument("--workers", default=None,
+                        help="Comma separated worker counts to measure, defaults to 1 to the number of cores")
+    parser.add_argument("--chunk-size", type=int, default=CPU_POOL_CHUNK_SIZE)
+    args = parser.parse_args()
+    worker_counts = [int(workers) for workers in args.workers.split(",")] if args.workers else None
+    IngestionBenchmark(args.num_listings, worker_counts, args.chunk_size).run()
@@ -0,0 +1,455 @@
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from scripts.embeddings import encode_hashed_batch
+
+NUM_LISTINGS_PATTERN = re.compile(r"information about (\d+) imaginary properties")
+LISTING_KEY_PATTERN = re.compile(r'"(listing_\d+)"\s*:')
+MOCK_EMBEDDING_DIMENSIONS = 1536
+RATE_LIMIT_WINDOW_SECONDS = 60
+
+NEIGHBORHOODS = ["Green Oaks", "Lakeside", "Maple Grove", "Riverside", "Harbor View", "Cedar Hills", "Sunnyvale",
+                 "Willow Creek", "Old Town", "Pine Ridge", "Brookfield", "Elm Park"]
+STYLES = ["modern", "craftsman", "colonial", "mid-century", "farmhouse", "Mediterranean", "Victorian", "ranch"]
+FEATURES = ["a large swimming pool", "solar panels", "a renovated chef's kitchen", "hardwood floors throughout",
+            "a two-car garage", "a fenced backyard", "a home office", "a rooftop terrace", "a finished basement",
+            "floor-to-ceiling windows", "a vegetable garden", "a wine cellar"]
+AMENITIES = ["top-rated schools", "a community park", "bike paths", "a farmers market", "public transportation",
+             "walking trails", "a golf course", "cozy cafes", "a private lake", "a fitness center"]
+
+
+class MockOpenAIServer:
+    """
+    An offline stand-in for the OpenAI chat, completion and embedding endpoints, so the pipeline can run and be
+    benchmarked without an API key. Point the clients at base_url through the OPENAI_BASE_URL environment variable.
+
+    Synthetic mode answers every prompt of this repo with well-formed JSON: generated listings, augmented
+    descriptions (single and batched), and deterministic hashed embeddings. Latency, jitter, injected server
+    errors, random 429s and requests/tokens per minute limits are configurable, and rate limit headers are sent
+    with every response. Record mode forwards the requests to a real upstream and stores the responses in a JSONL
+    fixtures file, replay mode serves them back (falling back to synthetic responses for unknown requests).
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, latency_jitter: float = 0.0,
+                 chunk_delay: float = 0.0, stream_chunk_chars: int = 16, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, rpm_limit: Optional[int] = None, tpm_limit: Optional[int] = None,
+                 mode: str = "synthetic", fixtures_path: Optional[str] = None,
+                 upstream_url: str = "https://api.openai.com/v1", seed: Optional[int] = None):
+        if mode not in ("synthetic", "record", "replay"):
+            raise ValueError(f"Unknown mode {mode}, expected synthetic, record or replay")
+
+        if mode != "synthetic" and not fixtures_path:
+            raise ValueError(f"The {mode} mode needs a fixtures path")
+
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.chunk_delay = chunk_delay
+        self.stream_chunk_chars = stream_chunk_chars
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.mode = mode
+        self.fixtures_path = fixtures_path
+        self.upstream_url = upstream_url.rstrip("/")
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests_window: Deque[Tuple[float, int]] = deque()  # (time, tokens) of the requests of the last minute
+        self.counters = {"requests": 0, "errors": 0, "rate_limited": 0, "replay_hits": 0, "replay_misses": 0,
+                         "recorded": 0}
+        self.fixtures: Dict[str, dict] = self._load_fixtures() if mode == "replay" else {}
+
+        self.httpd = _MockHTTPServer((host, port), _MockOpenAIRequestHandler)
+        self.httpd.mock_server = self
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockOpenAIServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self) -> "MockOpenAIServer":
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.stop()
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.counters)
+
+    def increment(self, counter: str) -> None:
+        with self.lock:
+            self.counters[counter] += 1
+
+    def get_latency(self) -> float:
+        with self.lock:
+            jitter = self.random.uniform(-self.latency_jitter, self.latency_jitter) if self.latency_jitter else 0.0
+
+        return max(0.0, self.latency + jitter)
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            return self.error_rate > 0 and self.random.random() < self.error_rate
+
+    def acquire_rate_limit(self, tokens: int) -> Tuple[Optional[float], Dict[str, str]]:
+        """
+        Admits a request into the sliding minute window. Returns the seconds to wait before retrying if the
+        request is rate limited (None otherwise), and the rate limit headers to send back.
+        """
+        with self.lock:
+            now = time.monotonic()
+            while self.requests_window and now - self.requests_window[0][0] >= RATE_LIMIT_WINDOW_SECONDS:
+                self.requests_window.popleft()
+
+            used_requests = len(self.requests_window)
+            used_tokens = sum(window_tokens for _, window_tokens in self.requests_window)
+            reset_seconds = (RATE_LIMIT_WINDOW_SECONDS - (now - self.requests_window[0][0])
+                             if self.requests_window else 0.0)
+            retry_after = None
+            if self.rpm_limit is not None and used_requests >= self.rpm_limit:
+                retry_after = reset_seconds
+
+            elif self.tpm_limit is not None and used_tokens + tokens > self.tpm_limit:
+                retry_after = reset_seconds
+
+            elif self.rate_limit_rate > 0 and self.random.random() < self.rate_limit_rate:
+                retry_after = 1.0
+
+            if retry_after is None:
+                self.requests_window.append((now, tokens))
+                used_requests += 1
+                used_tokens += tokens
+
+            headers = {}
+            if self.rpm_limit is not None:
+                headers.update({"x-ratelimit-limit-requests": str(self.rpm_limit),
+                                "x-ratelimit-remaining-requests": str(max(0, self.rpm_limit - used_requests)),
+                                "x-ratelimit-reset-requests": f"{reset_seconds:.3f}s"})
+
+            if self.tpm_limit is not None:
+                headers.update({"x-ratelimit-limit-tokens": str(self.tpm_limit),
+                                "x-ratelimit-remaining-tokens": str(max(0, self.tpm_limit - used_tokens)),
+                                "x-ratelimit-reset-tokens": f"{reset_seconds:.3f}s"})
+
+            return retry_after, headers
+
+    def split_into_chunks(self, text: str) -> List[str]:
+        return [text[i:i + self.stream_chunk_chars] for i in range(0, len(text), self.stream_chunk_chars)] or [""]
+
+    @staticmethod
+    def get_fixture_key(path: str, body: dict) -> str:
+        return hashlib.sha256(f"{path}\n{json.dumps(body, sort_keys=True)}".encode("utf-8")).hexdigest()
+
+    def get_fixture(self, key: str) -> Optional[dict]:
+        fixture = self.fixtures.get(key)
+        self.increment("replay_hits" if fixture is not None else "replay_misses")
+        return fixture
+
+    def record_fixture(self, key: str, path: str, status: int, content_type: str, body: str) -> None:
+        fixture = {"key": key, "path": path, "status": status, "content_type": content_type, "body": body}
+        with self.lock:
+            self.fixtures[key] = fixture
+            with open(self.fixtures_path, "a") as f:
+                f.write(json.dumps(fixture) + "\n")
+
+            self.counters["recorded"] += 1
+
+    def forward_to_upstream(self, path: str, raw_body: bytes, authorization: Optional[str]) -> Tuple[int, str, str]:
+        request = urllib.request.Request(self.upstream_url + path[len("/v1"):], data=raw_body, method="POST",
+                                         headers={"Content-Type": "application/json",
+                                                  "Authorization": authorization or ""})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return (response.status, response.headers.get("Content-Type", "application/json"),
+                        response.read().decode("utf-8"))
+
+        except urllib.error.HTTPError as e:
+            return e.code, e.headers.get("Content-Type", "application/json"), e.read().decode("utf-8")
+
+    def _load_fixtures(self) -> Dict[str, dict]:
+        fixtures = {}
+        with open(self.fixtures_path, "r") as f:
+            for line in f:
+                if line.strip():
+                    fixture = json.loads(line)
+                    fixtures[fixture["key"]] = fixture
+
+        print(f"Loaded {len(fixtures)} recorded responses from {self.fixtures_path}")
+        return fixtures
+
+
+class SyntheticResponses:
+    """
+    Deterministic responses for the prompts of this repo, seeded by the prompt so a retried request gets
+    the same answer.
+    """
+
+    @staticmethod
+    def complete(prompt: str) -> str:
+        prompt_random = random.Random(hashlib.sha256(prompt.encode("utf-8")).digest())
+        num_listings_match = NUM_LISTINGS_PATTERN.search(prompt)
+        if num_listings_match:
+            return json.dumps({f"property_{index + 1}": SyntheticResponses.create_listing(prompt_random)
+                               for index in range(int(num_listings_match.group(1)))}, indent=4)
+
+        if "Augmented Descriptions" in prompt:
+            listing_keys = sorted(set(LISTING_KEY_PATTERN.findall(prompt)), key=lambda key: int(key.split("_")[1]))
+            return json.dumps({"Augmented Descriptions": {key: SyntheticResponses.create_augmented_description(
+                prompt_random) for key in listing_keys}})
+
+        if "Augmented Description" in prompt:
+            return json.dumps({"Augmented Description": SyntheticResponses.create_augmented_description(
+                prompt_random)})
+
+        return json.dumps({"response": "This is a mock response."})
+
+    @staticmethod
+    def create_listing(prompt_random: random.Random) -> dict:
+        neighborhood = prompt_random.choice(NEIGHBORHOODS)
+        bedrooms = prompt_random.randint(1, 6)
+        bathrooms = max(1, bedrooms - prompt_random.randint(0, 2))
+        features = prompt_random.sample(FEATURES, 3)
+        amenities = prompt_random.sample(AMENITIES, 2)
+        return {
+            "Neighborhood": neighborhood,
+            "Price": f"${prompt_random.randint(200, 3000) * 1000:,}",
+            "Bedrooms": bedrooms,
+            "Bathrooms": bathrooms,
+            "House Size": f"{prompt_random.randint(800, 6000):,} sqft",
+            "Description": f"Welcome to this {prompt_random.choice(STYLES)} {bedrooms}-bedroom, {bathrooms}-bathroom "
+                           f"home in {neighborhood}, featuring {features[0]}, {features[1]} and {features[2]}. "
+                           f"Neighborhood Description: {neighborhood} offers {amenities[0]} and {amenities[1]} "
+                           f"(listing {prompt_random.getrandbits(32):08x})."
+        }
+
+    @staticmethod
+    def create_augmented_description(prompt_random: random.Random) -> str:
+        features = prompt_random.sample(FEATURES, 2)
+        amenities = prompt_random.sample(AMENITIES, 2)
+        return (f"A home tailored to your wishes, with {features[0]} and {features[1]}. "
+                f"The neighborhood offers {amenities[0]} and {amenities[1]}, just what you are looking for.")
+
+    @staticmethod
+    def embed(inputs: List[str], dimensions: int) -> np.ndarray:
+        return encode_hashed_batch(inputs, dimensions).astype(np.float32)
+
+
+class _MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default listen backlog of 5 refuses connections when the pipeline fans out to dozens of requests at once
+    request_queue_size = 1024
+
+
+class _MockOpenAIRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like the real API
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path == "/stats":
+            self._send_json(200, self.server.mock_server.stats())
+            return
+
+        self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+    def do_POST(self) -> None:
+        mock_server: MockOpenAIServer = self.server.mock_server
+        raw_body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path = self.path.split("?")[0]
+        if path not in ("/v1/chat/completions", "/v1/completions", "/v1/embeddings"):
+            self._send_json(404, {"error": {"message": f"Unknown path {path}", "type": "invalid_request_error"}})
+            return
+
+        body = json.loads(raw_body or b"{}")
+        mock_server.increment("requests")
+        prompt_texts = self._get_prompt_texts(path, body)
+        prompt_tokens = sum(len(text) for text in prompt_texts) // 4 + 1
+        retry_after, rate_limit_headers = mock_server.acquire_rate_limit(prompt_tokens + body.get("max_tokens", 0))
+        if retry_after is not None:
+            mock_server.increment("rate_limited")
+            self._send_json(429, {"error": {"message": "Rate limit reached, please try again later",
+                                            "type": "requests", "code": "rate_limit_exceeded"}},
+                            {"Retry-After": f"{max(1, round(retry_after))}", **rate_limit_headers})
+            return
+
+        if mock_server.should_fail():
+            mock_server.increment("errors")
+            time.sleep(mock_server.get_latency())
+            self._send_json(500, {"error": {"message": "The server had an error while processing your request",
+                                            "type": "server_error"}}, rate_limit_headers)
+            return
+
+        if mock_server.mode == "record":
+            self._record(mock_server, path, body, raw_body)
+            return
+
+        if mock_server.mode == "replay":
+            fixture = mock_server.get_fixture(mock_server.get_fixture_key(path, body))
+            if fixture is not None:
+                time.sleep(mock_server.get_latency())
+                self._send_body(fixture["status"], fixture["content_type"], fixture["body"].encode("utf-8"),
+                                rate_limit_headers)
+                return
+
+        if path == "/v1/embeddings":
+            self._send_embeddings(mock_server, body, prompt_texts, prompt_tokens, rate_limit_headers)
+            return
+
+        completion = SyntheticResponses.complete("\n".join(prompt_texts))
+        chunks = mock_server.split_into_chunks(completion)
+        if body.get("stream"):
+            self._stream_completion(mock_server, path, body, chunks, rate_limit_headers)
+            return
+
+        time.sleep(mock_server.get_latency() + mock_server.chunk_delay * len(chunks))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(completion) // 4 + 1,
+                 "total_tokens": prompt_tokens + len(completion) // 4 + 1}
+        choice = ({"index": 0, "message": {"role": "assistant", "content": completion}, "finish_reason": "stop"}
+                  if path == "/v1/chat/completions" else
+                  {"index": 0, "text": completion, "logprobs": None, "finish_reason": "stop"})
+        self._send_json(200, {**self._get_completion_header(path, body, stream=False), "choices": [choice],
+                              "usage": usage}, rate_limit_headers)
+
+    def _send_embeddings(self, mock_server: MockOpenAIServer, body: dict, inputs: List[str], prompt_tokens: int,
+                         rate_limit_headers: Dict[str, str]) -> None:
+        time.sleep(mock_server.get_latency())
+        vectors = SyntheticResponses.embed(inputs, body.get("dimensions") or MOCK_EMBEDDING_DIMENSIONS)
+        if body.get("encoding_format") == "base64":
+            embeddings = [base64.b64encode(vector.tobytes()).decode("ascii") for vector in vectors]
+        else:
+            embeddings = vectors.tolist()
+
+        self._send_json(200, {"object": "list", "model": body.get("model", "text-embedding-ada-002"),
+                              "data": [{"object": "embedding", "index": index, "embedding": embedding}
+                                       for index, embedding in enumerate(embeddings)],
+                              "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}},
+                        rate_limit_headers)
+
+    def _stream_completion(self, mock_server: MockOpenAIServer, path: str, body: dict, chunks: List[str],
+                           rate_limit_headers: Dict[str, str]) -> None:
+        # Server-sent events without a length, the connection is closed once the stream is done
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        for name, value in rate_limit_headers.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.close_connection = True
+        header = self._get_completion_header(path, body, stream=True)
+        time.sleep(mock_server.get_latency())
+        for index, chunk in enumerate(chunks + [None]):
+            if index and mock_server.chunk_delay:
+                time.sleep(mock_server.chunk_delay)
+
+            finish_reason = "stop" if chunk is None else None
+            choice = ({"index": 0, "delta": {"content": chunk} if chunk is not None else {},
+                       "finish_reason": finish_reason}
+                      if path == "/v1/chat/completions" else
+                      {"index": 0, "text": chunk or "", "logprobs": None, "finish_reason": finish_reason})
+            self.wfile.write(f"data: {json.dumps({**header, 'choices': [choice]})}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _record(self, mock_server: MockOpenAIServer, path: str, body: dict, raw_body: bytes) -> None:
+        status, content_type, response_body = mock_server.forward_to_upstream(path, raw_body,
+                                                                              self.headers.get("Authorization"))
+        if status == 200:
+            mock_server.record_fixture(mock_server.get_fixture_key(path, body), path, status, content_type,
+                                       response_body)
+
+        self._send_body(status, content_type, response_body.encode("utf-8"), {})
+
+    @staticmethod
+    def _get_prompt_texts(path: str, body: dict) -> List[str]:
+        if path == "/v1/chat/completions":
+            return [message.get("content") or "" for message in body.get("messages", [])
+                    if isinstance(message.get("content"), str)]
+
+        prompts = body.get("input" if path == "/v1/embeddings" else "prompt", "")
+        if isinstance(prompts, str) or (prompts and isinstance(prompts[0], int)):
+            prompts = [prompts]
+
+        # Token id inputs (sent by clients that tokenize locally) are hashed like words
+        return [prompt if isinstance(prompt, str) else " ".join(map(str, prompt)) for prompt in prompts]
+
+    @staticmethod
+    def _get_completion_header(path: str, body: dict, stream: bool) -> dict:
+        object_name = "chat.completion" if path == "/v1/chat/completions" else "text_completion"
+        return {"id": f"mock-{random.getrandbits(64):016x}", "object": object_name + (".chunk" if stream else ""),
+                "created": int(time.time()), "model": body.get("model", "mock")}
+
+    def _send_json(self, status: int, payload: dict, headers: Optional[Dict[str, str]] = None) -> None:
+        self._send_body(status, "application/json", json.dumps(payload).encode("utf-8"), headers or {})
+
+    def _send_body(self, status: int, content_type: str, body: bytes, headers: Dict[str, str]) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Serve mock OpenAI chat, completion and embedding endpoints")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before the first byte of a response")
+    parser.add_argument("--latency-jitter", type=float, default=0.0, help="Uniform +/- jitter on the latency")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="Seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of requests answered with a 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Fraction of requests answered with a 429 regardless of the limits")
+    parser.add_argument("--rpm-limit", type=int, help="Requests per minute before answering with a 429")
+    parser.add_argument("--tpm-limit", type=int, help="Tokens per minute before answering with a 429")
+    parser.add_argument("--mode", choices=["synthetic", "record", "replay"], default="synthetic")
+    parser.add_argument("--fixtures", help="JSONL file the record mode appends to and the replay mode serves from")
+    parser.add_argument("--upstream-url", default="https://api.openai.com/v1", help="The API the record mode calls")
+    parser.add_argument("--seed", type=int)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = MockOpenAIServer(args.host, args.port, args.latency, args.latency_jitter, args.chunk_delay,
+                              error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                              rpm_limit=args.rpm_limit, tpm_limit=args.tpm_limit, mode=args.mode,
+                              fixtures_path=args.fixtures, upstream_url=args.upstream_url, seed=args.seed)
+    print(f"Mock OpenAI server listening on {server.base_url}, run the pipeline with OPENAI_BASE_URL={server.base_url}")
+    try:
+        server.httpd.serve_forever()
+
+    except KeyboardInterrupt:
+        server.httpd.server_close()
@@ -0,0 +1,158 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from typing import List, Optional
+
+from scripts.benchmarks.benchmark_utils import BenchmarkUtils
+from scripts.benchmarks.mock_openai_server import MockOpenAIServer
+from scripts.db_semantic_searcher import ListingSearcher
+from scripts.embeddings import get_embedding_backend, EMBEDDING_BACKENDS
+from scripts.home_matcher import HomeMatcher
+from scripts.listing_personalizer import ListingPersonalizer
+from scripts.listings_creator_langchain import ListingsGenerator
+from scripts.resources.consts import BUYER_ANSWERS, BUYER_PREFERENCES_STR, MAX_WORKERS, OPENAI_BASE_URL_ENV_VAR, \
+    LISTINGS_SHARD_SIZE
+
+
+class PipelineBenchmark:
+    """
+    Runs the whole pipeline against the mock OpenAI server and reports the throughput and the p50/p95/p99 latency
+    of every stage at every corpus size, which is the pipeline's own overhead when the mock adds no latency:
+    generation (per shard request), ingestion (embedding and storing the corpus), search (per query),
+    personalization (per buyer) and the end-to-end match of a buyer against the stored corpus.
+    It runs in a temporary working directory, so the listings, db and response cache in resources/ are untouched.
+    """
+
+    def __init__(self, sizes: List[int], num_queries: int = 100, num_buyers: int = 20,
+                 embedding_backend: str = "openai", shard_size: int = LISTINGS_SHARD_SIZE,
+                 concurrency: int = MAX_WORKERS, mock_server_options: Optional[dict] = None):
+        self.sizes = sizes
+        self.num_queries = num_queries
+        self.num_buyers = num_buyers
+        self.embedding_backend = embedding_backend
+        self.shard_size = shard_size
+        self.concurrency = concurrency
+        self.mock_server_options = mock_server_options or {}
+
+    def run(self) -> List[dict]:
+        summaries = []
+        os.environ.setdefault("OPENAI_API_KEY", "mock")  # The mock server does not check it
+        with MockOpenAIServer(**self.mock_server_options) as mock_server, \
+                tempfile.TemporaryDirectory() as working_dir:
+            os.environ[OPENAI_BASE_URL_ENV_VAR] = mock_server.base_url
+            previous_working_dir = os.getcwd()
+            os.chdir(working_dir)
+            os.makedirs("resources")
+            try:
+                for size in self.sizes:
+                    print(f"Benchmarking the pipeline with {size} listings")
+                    size_summaries = asyncio.run(self._run_size(size))
+                    for summary in size_summaries:
+                        BenchmarkUtils.print_summary(summary)
+
+                    summaries.extend(size_summaries)
+
+            finally:
+                os.chdir(previous_working_dir)
+
+            print(f"Mock server: {mock_server.stats()}")
+
+        return summaries
+
+    async def _run_size(self, size: int) -> List[dict]:
+        db_path = f"resources/listings_{size}.db"
+        embeddings = get_embedding_backend(self.embedding_backend)
+        summaries = []
+
+        generator = ListingsGenerator(db_path=db_path, embeddings=embeddings, shard_size=self.shard_size)
+        shard_latencies, ingestion_latencies = [], []
+        generator._stream_listings = BenchmarkUtils.time_async_calls(generator._stream_listings, shard_latencies)
+        generator.store_listings_in_db = BenchmarkUtils.time_async_calls(generator.store_listings_in_db,
+                                                                         ingestion_latencies)
+        start = time.perf_counter()
+        await generator.generate_listings(size)
+        generation_seconds = time.perf_counter() - start - sum(ingestion_latencies)
+        await generator.aclose()
+        summaries.append(BenchmarkUtils.summarize(f"generation [{size}]", shard_latencies, items=size,
+                                                  wall_seconds=generation_seconds))
+        summaries.append(BenchmarkUtils.summarize(f"ingestion [{size}]", ingestion_latencies, items=size))
+
+        searcher = ListingSearcher(db_path=db_path, embeddings=embeddings)
+        searcher.warmup()
+        # Distinct queries, so the query-embedding cache does not hide the embedding calls
+        queries = iter([f"{BUYER_ANSWERS[i % len(BUYER_ANSWERS)]} (buyer {i})" for i in range(self.num_queries)])
+        search_latencies = BenchmarkUtils.measure_latencies(lambda: searcher.search_listings(next(queries)),
+                                                            self.num_queries)
+        summaries.append(BenchmarkUtils.summarize(f"search [{size}]", search_latencies))
+
+        personalizer = ListingPersonalizer(db_path=db_path, max_workers=self.concurrency)
+        personalization_latencies = []
+        personalize_listings = BenchmarkUtils.time_async_calls(personalizer.personalize_listings,
+                                                               personalization_latencies)
+        for buyer_preferences in self._get_buyers_preferences(size, "personalization"):
+            await personalize_listings(buyer_preferences, searcher.search_listings(buyer_preferences))
+
+        await personalizer.gen_ai_caller.aclose()
+        summaries.append(BenchmarkUtils.summarize(f"personalization [{size}]", personalization_latencies))
+
+        home_matcher = HomeMatcher(concurrency=self.concurrency, embedding_backend=self.embedding_backend,
+                                   db_path=db_path)
+        match_latencies = []
+        for buyer_preferences in self._get_buyers_preferences(size, "match"):
+            start = time.perf_counter()
+            async for _ in home_matcher.match_stream(buyer_preferences, output_path="resources/matches.jsonl",
+                                                     generate_listings=False):
+                pass
+
+            match_latencies.append(time.perf_counter() - start)
+
+        await home_matcher.aclose()
+        summaries.append(BenchmarkUtils.summarize(f"match [{size}]", match_latencies))
+        embeddings.close()
+        return summaries
+
+    def _get_buyers_preferences(self, size: int, stage: str) -> List[str]:
+        # Distinct preferences, so the response cache does not hide the personalization calls
+        return [f"{BUYER_PREFERENCES_STR}\n(buyer {i} of the {stage} stage, {size} listings)"
+                for i in range(self.num_buyers)]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages against the mock OpenAI server")
+    parser.add_argument("--sizes", default="10,1000,100000", help="Comma separated corpus sizes")
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--num-buyers", type=int, default=20)
+    parser.add_argument("--embedding-backend", choices=sorted(EMBEDDING_BACKENDS), default="openai",
+                        help="openai embeds through the mock server, hashing embeds locally")
+    parser.add_argument("--shard-size", type=int, default=LISTINGS_SHARD_SIZE)
+    parser.add_argument("--concurrency", type=int, default=MAX_WORKERS)
+    parser.add_argument("--latency", type=float, default=0.0, help="Mock server latency in seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0.0)
+    parser.add_argument("--chunk-delay", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--fixtures", help="Replay the responses recorded in this JSONL file")
+    parser.add_argument("--output", help="JSON file the summaries are written to")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    mock_server_options = {"latency": args.latency, "latency_jitter": args.latency_jitter,
+                           "chunk_delay": args.chunk_delay, "error_rate": args.error_rate,
+                           "rate_limit_rate": args.rate_limit_rate}
+    if args.fixtures:
+        mock_server_options.update({"mode": "replay", "fixtures_path": os.path.abspath(args.fixtures)})
+
+    output_path = os.path.abspath(args.output) if args.output else None
+    benchmark_summaries = PipelineBenchmark([int(size) for size in args.sizes.split(",")], args.num_queries,
+                                            args.num_buyers, args.embedding_backend, args.shard_size,
+                                            args.concurrency, mock_server_options).run()
+    if output_path:
+        with open(output_path, "w") as f:
+            json.dump(benchmark_summaries, f, indent=4)
+
+        print(f"Summaries saved to {output_path}")
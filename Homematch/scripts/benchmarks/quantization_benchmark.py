@@ -0,0 +1,100 @@
+import argparse
+import tempfile
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from scripts.benchmarks.benchmark_utils import BenchmarkUtils
+from scripts.resources.consts import VECTOR_INDEX_RESCORE_FACTOR
+from scripts.vector_index import VectorIndex
+
+
+class QuantizationBenchmark:
+    """
+    Compares the memory and the recall of the compact storage modes of the VectorIndex (float16 and int8, with and
+    without Matryoshka truncation and full precision rescoring) against the full precision index.
+    The corpus is either real embeddings loaded from a .npy file or synthetic clustered vectors whose variance
+    decays along the dimensions, the way it does in a Matryoshka embedding. Queries are corpus vectors with noise
+    added, and recall@k is measured against an exact float32 search of the same index.
+    Every mode is opened on the same index directory, so the time to build its compact copy is reported too.
+    """
+    MODES = [("float16", 0), ("int8", 0), ("float16", 512), ("int8", 512), ("int8", 256)]
+
+    def __init__(self, num_vectors: int = 100000, dimensions: int = 1536, num_queries: int = 200, k: int = 10,
+                 rescore_factor: int = VECTOR_INDEX_RESCORE_FACTOR, vectors_path: Optional[str] = None,
+                 repeat: int = 3, seed: int = 0):
+        self.num_vectors = num_vectors
+        self.dimensions = dimensions
+        self.num_queries = num_queries
+        self.k = k
+        self.rescore_factor = rescore_factor
+        self.vectors_path = vectors_path
+        self.repeat = repeat
+        self.rng = np.random.default_rng(seed)
+
+    def run(self) -> None:
+        vectors, queries = self._create_vectors()
+        with tempfile.TemporaryDirectory() as path:
+            # IVF is off so the recall only measures the quantization
+            ivf_min_vectors = len(vectors) + 1
+            VectorIndex(path, ivf_min_vectors, quantization="none").write([str(row) for row in range(len(vectors))],
+                                                                           vectors, [""] * len(vectors),
+                                                                           [{}] * len(vectors))
+            del vectors
+            exact_index = VectorIndex(path, ivf_min_vectors, quantization="none")
+            exact_results = [set(indices) for indices, _ in exact_index.search(queries, self.k)]
+            self._report("float32", exact_index, queries, exact_results, exact_index.search_nbytes)
+            for quantization, dimensions in self.MODES:
+                for rescore_factor in (0, self.rescore_factor):
+                    start = time.perf_counter()
+                    index = VectorIndex(path, ivf_min_vectors, quantization=quantization, dimensions=dimensions,
+                                        rescore_factor=rescore_factor)
+                    name = (f"{quantization} {dimensions or exact_index.vectors.shape[1]} dims "
+                            f"{f'rescored x{rescore_factor}' if rescore_factor else 'not rescored'}")
+                    print(f"{name}: opened in {(time.perf_counter() - start) * 1000:.0f}ms")
+                    self._report(name, index, queries, exact_results, exact_index.search_nbytes)
+
+    def _report(self, name: str, index: VectorIndex, queries: np.ndarray, exact_results: List[set],
+                full_nbytes: int) -> None:
+        index.warmup()
+        results = []
+        latencies = BenchmarkUtils.measure_latencies(lambda: results.append(index.search(queries, self.k)),
+                                                     self.repeat)
+        recall = np.mean([len(set(indices) & exact) / len(exact)
+                          for (indices, _), exact in zip(results[-1], exact_results)])
+        BenchmarkUtils.print_summary(BenchmarkUtils.summarize(name, latencies, items_per_call=len(queries)))
+        print(f"{name}: {index.search_nbytes / 2 ** 20:.1f}MiB scanned "
+              f"({full_nbytes / index.search_nbytes:.1f}x smaller), recall@{self.k} {recall:.3f}")
+
+    def _create_vectors(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self.vectors_path:
+            vectors = np.load(self.vectors_path, mmap_mode="r")[:self.num_vectors].astype(np.float32)
+            decay = vectors.std(axis=0)
+
+        else:
+            decay = 1 / np.sqrt(1 + np.arange(self.dimensions) / 64)
+            centers = self.rng.standard_normal((max(1, self.num_vectors // 100), self.dimensions))
+            vectors = np.empty((self.num_vectors, self.dimensions), dtype=np.float32)
+            for start in range(0, self.num_vectors, 10000):
+                end = min(start + 10000, self.num_vectors)
+                vectors[start:end] = (centers[self.rng.integers(len(centers), size=end - start)] +
+                                      self.rng.standard_normal((end - start, self.dimensions))) * decay
+
+        rows = self.rng.choice(len(vectors), self.num_queries, replace=False)
+        queries = vectors[rows] + 0.5 * self.rng.standard_normal((self.num_queries, vectors.shape[1])) * decay
+        return vectors, queries.astype(np.float32)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the memory and recall of the compact vector storage")
+    parser.add_argument("--num-vectors", type=int, default=100000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--rescore-factor", type=int, default=VECTOR_INDEX_RESCORE_FACTOR)
+    parser.add_argument("--vectors", default=None,
+                        help="A .npy file of real embeddings (rows are vectors) to use instead of synthetic ones")
+    args = parser.parse_args()
+    QuantizationBenchmark(args.num_vectors, args.dimensions, args.num_queries, args.k, args.rescore_factor,
+                          args.vectors).run()
@@ -0,0 +1,103 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+from typing import Dict, List
+
+from scripts.benchmarks.benchmark_utils import BenchmarkUtils
+from scripts.bm25_index import BM25Index
+from scripts.db_semantic_searcher import ListingSearcher
+from scripts.embeddings import get_embedding_backend, EMBEDDING_BACKENDS
+from scripts.listings_creator_langchain import ListingsGenerator
+from scripts.models import HouseListing, ListingConverter
+from scripts.resources.consts import VECTOR_STORE_BACKEND, RETRIEVAL_FETCH_K
+from scripts.vector_stores import VECTOR_STORES
+
+EVAL_SET_PATH = os.path.join(os.path.dirname(__file__), "retrieval_eval_set.json")
+
+
+class RetrievalBenchmark:
+    """
+    Measures the retrieval quality of the dense search, the hybrid (dense + BM25) search and the hybrid search
+    reranked from fetch_k candidates as precision@k on a small labelled eval set: a fixed corpus of listings and
+    buyer queries with the listings relevant to each.
+    It also measures the BM25 query latency on a synthetic corpus of latency_corpus_size listings.
+    """
+
+    def __init__(self, eval_set_path: str = EVAL_SET_PATH, embedding_backend: str = "hashing",
+                 vector_store: str = VECTOR_STORE_BACKEND, k: int = 5, latency_corpus_size: int = 100000,
+                 num_queries: int = 1000, seed: int = 0, fetch_k: int = RETRIEVAL_FETCH_K):
+        self.eval_set_path = eval_set_path
+        self.embedding_backend = embedding_backend
+        self.vector_store = vector_store
+        self.k = k
+        self.fetch_k = fetch_k
+        self.latency_corpus_size = latency_corpus_size
+        self.num_queries = num_queries
+        self.random = random.Random(seed)
+
+    def run(self) -> Dict[str, float]:
+        with open(self.eval_set_path, "r") as f:
+            eval_set = json.load(f)
+
+        listings = {key: HouseListing(**listing) for key, listing in eval_set["listings"].items()}
+        keys_by_id = {ListingConverter.get_listing_id(ListingConverter.convert_houselisting_to_text(listing)): key
+                      for key, listing in listings.items()}
+        embeddings = get_embedding_backend(self.embedding_backend)
+        precisions = {}
+        with tempfile.TemporaryDirectory() as working_dir:
+            db_path = os.path.join(working_dir, "listings.db")
+            generator = ListingsGenerator(db_path=db_path, embeddings=embeddings, vector_store=self.vector_store)
+            asyncio.run(generator.store_listings_in_db(list(listings.values())))
+            for mode, hybrid, reranked in (("dense", False, False), ("hybrid", True, False),
+                                           ("hybrid + rerank", True, True)):
+                searcher = ListingSearcher(db_path=db_path, embeddings=embeddings, vector_store=self.vector_store,
+                                           hybrid=hybrid)
+                query_precisions = []
+                for labelled_query in eval_set["queries"]:
+                    if reranked:
+                        documents = searcher.retrieve_listings(labelled_query["query"], self.fetch_k, self.k)
+
+                    else:
+                        documents = searcher.search_listings(labelled_query["query"], k=self.k)
+
+                    found_keys = [keys_by_id.get(document.metadata["content_hash"]) for document in documents]
+                    query_precisions.append(len(set(found_keys) & set(labelled_query["relevant"])) / self.k)
+
+                precisions[mode] = sum(query_precisions) / len(query_precisions)
+                print(f"{mode} precision@{self.k}: {precisions[mode]:.3f} over {len(query_precisions)} queries")
+
+        embeddings.close()
+        self._measure_lexical_latency(eval_set)
+        return precisions
+
+    def _measure_lexical_latency(self, eval_set: dict) -> None:
+        descriptions = [listing["Description"] for listing in eval_set["listings"].values()]
+        neighborhoods = sorted({listing["Neighborhood"] for listing in eval_set["listings"].values()})
+        # Synthetic listings mixing the sentences of the eval listings, so the terms have realistic document counts
+        texts = [f"neighborhood:{self.random.choice(neighborhoods)} {i}\n"
+                 f"description:{self.random.choice(descriptions)} {self.random.choice(descriptions)}"
+                 for i in range(self.latency_corpus_size)]
+        ids = [str(i) for i in range(self.latency_corpus_size)]
+        bm25_index = BM25Index.build(ids, texts, [{} for _ in ids])
+        queries = iter([self.random.choice(eval_set["queries"])["query"] for _ in range(self.num_queries)])
+        latencies = BenchmarkUtils.measure_latencies(lambda: bm25_index.search(next(queries), self.k * 4),
+                                                     self.num_queries)
+        BenchmarkUtils.print_summary(BenchmarkUtils.summarize(f"BM25 search [{self.latency_corpus_size}]",
+                                                              latencies))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark dense vs hybrid retrieval on the labelled eval set")
+    parser.add_argument("--eval-set", default=EVAL_SET_PATH)
+    parser.add_argument("--embedding-backend", choices=sorted(EMBEDDING_BACKENDS), default="hashing")
+    parser.add_argument("--vector-store", choices=sorted(VECTOR_STORES), default=VECTOR_STORE_BACKEND)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--fetch-k", type=int, default=RETRIEVAL_FETCH_K)
+    parser.add_argument("--latency-corpus-size", type=int, default=100000)
+    parser.add_argument("--num-queries", type=int, default=1000)
+    args = parser.parse_args()
+    RetrievalBenchmark(args.eval_set, args.embedding_backend, args.vector_store, args.k, args.latency_corpus_size,
+                       args.num_queries, fetch_k=args.fetch_k).run()
@@ -0,0 +1,68 @@
+import argparse
+import time
+
+from scripts.db_semantic_searcher import ListingSearcher
+from scripts.benchmarks.benchmark_utils import BenchmarkUtils
+from scripts.resources.consts import BUYER_ANSWERS, VECTOR_STORE_BACKEND
+from scripts.vector_stores import VECTOR_STORES
+
+
+class SearchBenchmark:
+    """
+    Compares the throughput of searching many buyer queries one by one against search_listings_batch.
+    Every query is distinct so the query-embedding cache does not hide the embedding calls.
+    It also reports the cold start of the vector store: opening it and warming it up.
+    """
+
+    def __init__(self, db_path: str = "resources/listings.db", num_queries: int = 100, k: int = 5,
+                 fake_embeddings: bool = False, vector_store: str = VECTOR_STORE_BACKEND):
+        self.db_path = db_path
+        self.num_queries = num_queries
+        self.k = k
+        self.fake_embeddings = fake_embeddings
+        self.vector_store = vector_store
+
+    def run(self) -> None:
+        queries = [f"{BUYER_ANSWERS[i % len(BUYER_ANSWERS)]} (buyer {i})" for i in range(self.num_queries)]
+
+        start = time.perf_counter()
+        looped_searcher = self._create_searcher()
+        print(f"Cold start of the {self.vector_store} store: {(time.perf_counter() - start) * 1000:.1f}ms")
+        start = time.perf_counter()
+        for query in queries:
+            looped_searcher.search_listings(query, k=self.k)
+
+        looped_seconds = time.perf_counter() - start
+
+        batch_searcher = self._create_searcher()
+        start = time.perf_counter()
+        batch_searcher.search_listings_batch(queries, k=self.k)
+        batch_seconds = time.perf_counter() - start
+
+        BenchmarkUtils.print_summary(BenchmarkUtils.summarize("looped search_listings", [looped_seconds],
+                                                              items_per_call=self.num_queries))
+        BenchmarkUtils.print_summary(BenchmarkUtils.summarize("search_listings_batch", [batch_seconds],
+                                                              items_per_call=self.num_queries))
+        print(f"Batch speedup: {looped_seconds / batch_seconds:.1f}x")
+
+    def _create_searcher(self) -> ListingSearcher:
+        embeddings = None
+        if self.fake_embeddings:
+            from langchain_community.embeddings import FakeEmbeddings
+            embeddings = FakeEmbeddings(size=1536)
+
+        searcher = ListingSearcher(db_path=self.db_path, embeddings=embeddings, vector_store=self.vector_store)
+        searcher.warmup()
+        return searcher
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark looped vs batched listing search")
+    parser.add_argument("--db-path", default="resources/listings.db")
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=5)
+    parser.add_argument("--fake-embeddings", action="store_true",
+                        help="Use random local embeddings to measure the search overhead without the OpenAI API")
+    parser.add_argument("--vector-store", choices=sorted(VECTOR_STORES), default=VECTOR_STORE_BACKEND)
+    args = parser.parse_args()
+    SearchBenchmark(args.db_path, args.num_queries, args.k, args.fake_embeddings, args.vector_store).run()
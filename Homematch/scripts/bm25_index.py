@@ -0,0 +1,136 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from scripts.embeddings import TOKEN_PATTERN
+from scripts.listing_attribute_index import ListingAttributeIndex
+from scripts.models import ListingFilter
+from scripts.resources.consts import BM25_K1, BM25_B, BM25_INDEX_SUFFIX, BM25_MAX_POSTINGS_PER_TERM
+
+STOP_WORDS = frozenset(["a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "have", "in", "is",
+                        "it", "its", "like", "of", "on", "or", "that", "the", "this", "to", "want", "with",
+                        "would", "you", "your"])
+
+
+def tokenize(text: str) -> List[str]:
+    # Plurals are folded into their singular, so "pools" matches "pool"
+    return [token[:-1] if len(token) > 3 and token.endswith("s") and not token.endswith("ss") else token
+            for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOP_WORDS]
+
+
+class BM25Index:
+    """
+    A BM25 inverted index of the listing texts, built at ingestion and persisted next to the listings db.
+    The postings of every term are stored as CSR arrays with their final BM25 weight precomputed, so scoring a query
+    is one vectorized scatter-add per query term. The numeric attributes of the listings are kept alongside,
+    so a ListingFilter is applied as a mask without going through the vector store.
+
+    The postings of a term are ordered by weight (impact ordered) and an unfiltered search scores at most the
+    max_postings_per_term best of them. That keeps a query on 100k listings sub-millisecond: it is exact for terms
+    of fewer listings, and a term common enough to be cut carries a low idf, so only its strongest matches count.
+    """
+
+    def __init__(self, ids: np.ndarray, terms: np.ndarray, postings_offsets: np.ndarray, postings_rows: np.ndarray,
+                 postings_weights: np.ndarray, attribute_index: ListingAttributeIndex,
+                 max_postings_per_term: int = BM25_MAX_POSTINGS_PER_TERM):
+        self.ids = ids
+        self.terms = terms  # Sorted, looked up with a binary search
+        self.postings_offsets = postings_offsets
+        self.postings_rows = postings_rows
+        self.postings_weights = postings_weights
+        self.attribute_index = attribute_index
+        self.max_postings_per_term = max_postings_per_term
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, ids: List[str], texts: List[str], metadatas: List[dict], k1: float = BM25_K1,
+              b: float = BM25_B) -> "BM25Index":
+        vocabulary: Dict[str, int] = {}
+        token_rows, token_terms = [], []
+        lengths = np.zeros(len(ids), dtype=np.float32)
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths[row] = len(tokens)
+            token_rows.extend([row] * len(tokens))
+            token_terms.extend(vocabulary.setdefault(token, len(vocabulary)) for token in tokens)
+
+        # Every distinct (term, listing) pair is a posting, its count is the term frequency
+        pairs, frequencies = np.unique(np.asarray(token_terms, dtype=np.int64) * max(1, len(ids)) +
+                                       np.asarray(token_rows, dtype=np.int64), return_counts=True)
+        pair_terms, pair_rows = np.divmod(pairs, max(1, len(ids)))
+        document_frequencies = np.bincount(pair_terms, minlength=len(vocabulary))
+        idf = np.log(1 + (len(ids) - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        average_length = max(float(lengths.mean()), 1.0) if len(ids) else 1.0
+        normalized_lengths = 1 - b + b * lengths[pair_rows] / average_length
+        weights = idf[pair_terms] * frequencies * (k1 + 1) / (frequencies + k1 * normalized_lengths)
+
+        terms = np.array(list(vocabulary), dtype=str)
+        terms_order = np.argsort(terms)
+        term_ranks = np.empty(len(terms), dtype=np.int64)
+        term_ranks[terms_order] = np.arange(len(terms))
+        # Grouped by term in sorted term order, and by descending weight within a term
+        postings_order = np.lexsort((-weights, term_ranks[pair_terms]))
+        postings_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        np.cumsum(document_frequencies[terms_order], out=postings_offsets[1:])
+        return cls(np.array(ids, dtype=str), terms[terms_order], postings_offsets,
+                   pair_rows[postings_order].astype(np.int32), weights[postings_order].astype(np.float32),
+                   ListingAttributeIndex.from_metadatas(ids, metadatas))
+
+    def search(self, query: str, k: int, listing_filter: Optional[ListingFilter] = None) -> List[Tuple[str, float]]:
+        """
+        Returns the ids and scores of the k listings with the best BM25 score for the query, best first.
+        Listings sharing no term with the query are not returned.
+        """
+        mask = None
+        if listing_filter is not None and not listing_filter.is_empty():
+            mask = self.attribute_index.mask(listing_filter)
+
+        scores = np.zeros(len(self.ids), dtype=np.float32)
+        matched_rows = []
+        for term in set(tokenize(query)):
+            term_index = np.searchsorted(self.terms, term)
+            if term_index < len(self.terms) and self.terms[term_index] == term:
+                start, end = self.postings_offsets[term_index], self.postings_offsets[term_index + 1]
+                rows, weights = self.postings_rows[start:end], self.postings_weights[start:end]
+                if mask is not None:
+                    # The best postings of a term may all be filtered out, so a filtered search is exact
+                    rows, weights = rows[mask[rows]], weights[mask[rows]]
+
+                else:
+                    rows, weights = rows[:self.max_postings_per_term], weights[:self.max_postings_per_term]
+
+                # A listing appears once in the postings of a term, so a fancy-indexed add is safe
+                scores[rows] += weights
+                matched_rows.append(rows)
+
+        candidates = np.unique(np.concatenate(matched_rows)) if matched_rows else np.empty(0, dtype=np.int32)
+        k = min(k, len(candidates))
+        if k == 0:
+            return []
+
+        top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]] if k < len(candidates) else candidates
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return list(zip(self.ids[top].tolist(), scores[top].tolist()))
+
+    def save(self, path: str) -> None:
+        columns = {f"column_{column}": values for column, values in self.attribute_index.columns.items()}
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, ids=self.ids, terms=self.terms, postings_offsets=self.postings_offsets,
+                     postings_rows=self.postings_rows, postings_weights=self.postings_weights, **columns)
+
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path) as arrays:
+            columns = {column: arrays[f"column_{column}"] for column in ListingAttributeIndex.COLUMNS}
+            return cls(arrays["ids"], arrays["terms"], arrays["postings_offsets"], arrays["postings_rows"],
+                       arrays["postings_weights"], ListingAttributeIndex(arrays["ids"], columns))
+
+    @staticmethod
+    def get_path(db_path: str) -> str:
+        # Next to the db, e.g. resources/listings.db -> resources/listings.bm25.npz
+        return os.path.splitext(db_path.rstrip("/\\"))[0] + BM25_INDEX_SUFFIX
@@ -1,77 +1,252 @@
 import asyncio
 import json
 import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Union
 
-from langchain.llms import OpenAI
+import openai
+from langchain_community.chat_models import ChatOpenAI
 from langchain_core.output_parsers import PydanticOutputParser
-from langchain.prompts import PromptTemplate
-from concurrent.futures import ThreadPoolExecutor
+from pydantic import ValidationError
 
 from scripts.models import HouseListing
-from scripts.resources.consts import GPT4O_MODEL_NAME, EXTRA_SECURITY_GAP, MAX_OUTPUT_TOKENS_AMOUNT, \
-    LISTINGS_SYSTEM_PROMPT, LISTINGS_PROMPT_QUESTION, LISTINGS_FEW_SHOT_EXAMPLE
+from scripts.prompt_builder import PromptBuilder, BuiltPrompt
+from scripts.resources.consts import GPT4O_MODEL_NAME, MAX_OUTPUT_TOKENS_AMOUNT, \
+    LISTINGS_SYSTEM_PROMPT, LISTINGS_FEW_SHOT_EXAMPLE, LLM_TEMPERATURE, \
+    MAX_IN_FLIGHT_REQUESTS, OPENAI_BASE_URL_ENV_VAR, CPU_POOL_MIN_OFFLOAD_CHARS, CHAT_COMPLETION_TOKENS_ESTIMATE, \
+    CHAT_COMPLETION_TOKENS_SMOOTHING
+from scripts.utils.cpu_pool import get_cpu_pool
+from scripts.utils.metrics import metrics
+from scripts.utils.rate_limiter import get_rate_limiter
+from scripts.utils.response_cache import ResponseCache
 
 
 class GenAICaller:
+    """
+    Calls the language model through a single long-lived client.
+    The client (and its keep-alive HTTP connection pool) is created on first use and reused by every call,
+    requests go through the native async path and at most max_in_flight_requests of them run at once.
+    Call aclose() (or use the caller as an async context manager) to release the connections.
+    A call reserves its prompt tokens plus the running average of the completions of its system prompt in the shared
+    rate limiter, not max_tokens, and settles the reservation with the tokens it used. The rate limit headers of
+    every response update the limiter.
+    The timeout of a call starts once it has a free slot, the time it queued behind the other calls is not counted.
+    """
 
-    def __init__(self):
-        self.executor = ThreadPoolExecutor()
+    def __init__(self, use_cache: bool = True, response_cache: Optional[ResponseCache] = None,
+                 max_in_flight_requests: int = MAX_IN_FLIGHT_REQUESTS):
+        self.model_name = GPT4O_MODEL_NAME
+        self.temperature = LLM_TEMPERATURE
+        self.semaphore = asyncio.Semaphore(max_in_flight_requests)
+        self.rate_limiter = get_rate_limiter("chat")  # Shared with every other caller in the process
+        self.prompt_builder = PromptBuilder(model_name=self.model_name)
+        self.completion_tokens_estimates: Dict[str, float] = {}
+        self.response_cache = None
+        self._owns_response_cache = use_cache and response_cache is None
+        if use_cache:
+            self.response_cache = response_cache if response_cache is not None else ResponseCache()
+
+        self._llm = None
+
+    @property
+    def llm(self) -> ChatOpenAI:
+        if self._llm is None:
+            # A chat model, gpt-4o is only served by the chat completions API. It gets our own async client, so the
+            # rate limit headers of the successful responses reach the limiter
+            http_client = openai.DefaultAsyncHttpxClient(event_hooks={"response": [self._on_response]})
+            async_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"),
+                                              base_url=os.getenv(OPENAI_BASE_URL_ENV_VAR), max_retries=0,
+                                              http_client=http_client).chat.completions
+            self._llm = ChatOpenAI(model_name=self.model_name, temperature=self.temperature,
+                                   max_tokens=MAX_OUTPUT_TOKENS_AMOUNT, openai_api_key=os.getenv("OPENAI_API_KEY"),
+                                   openai_api_base=os.getenv(OPENAI_BASE_URL_ENV_VAR), async_client=async_client,
+                                   max_retries=0)  # Retries go through the shared rate limiter instead
+
+        return self._llm
+
+    async def aclose(self) -> None:
+        if self._llm is not None:
+            # The LLM keeps the AsyncOpenAI resource, its parent client owns the HTTP connection pool
+            async_client = getattr(getattr(self._llm, "async_client", None), "_client", None)
+            if async_client is not None:
+                await async_client.close()
+
+            self._llm = None
+
+        if self.response_cache is not None and self._owns_response_cache:
+            self.response_cache.close()
+            self.response_cache = None
+
+    async def __aenter__(self) -> "GenAICaller":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        await self.aclose()
 
     async def call_gen_ai(self, system_prompt: str,
                           prompt: str,
-                          few_shot_examples: str = None,
-                          parser: PydanticOutputParser = None) -> dict:
-        gen_ai_response = await self._get_gen_ai_response(system_prompt, prompt, few_shot_examples, parser)
-        gen_ai_response_jsonified = self._safe_json_loads(gen_ai_response)
+                          few_shot_examples: Union[str, List[str]] = None,
+                          parser: PydanticOutputParser = None,
+                          bypass_cache: bool = False,
+                          timeout: Optional[float] = None) -> dict:
+        cache_key = None
+        if self.response_cache is not None and not bypass_cache:
+            cache_key = self._get_cache_key(system_prompt, prompt, few_shot_examples, parser)
+            cached_response = self.response_cache.get(cache_key)
+            metrics.counter("homematch_llm_cache_requests_total",
+                            result="hit" if cached_response is not None else "miss")
+            if cached_response is not None:
+                return cached_response
+
+        gen_ai_response = await self._get_gen_ai_response(system_prompt, prompt, few_shot_examples, parser, timeout)
+        gen_ai_response_jsonified = await self.aparse_gen_ai_response(gen_ai_response)
+        if self.response_cache is not None and self._is_valid_response(gen_ai_response_jsonified, parser):
+            cache_key = cache_key or self._get_cache_key(system_prompt, prompt, few_shot_examples, parser)
+            self.response_cache.set(cache_key, gen_ai_response_jsonified)
+
         return gen_ai_response_jsonified
 
+    async def stream_gen_ai(self, system_prompt: str,
+                            prompt: str,
+                            few_shot_examples: Union[str, List[str]] = None,
+                            parser: PydanticOutputParser = None,
+                            timeout: Optional[float] = None) -> AsyncIterator[str]:
+        """
+        Yields the raw text chunks of the response as the model produces them. Streamed responses are not cached.
+        A stream still running timeout seconds after it got its slot raises asyncio.TimeoutError.
+        """
+        built_prompt = self.prompt_builder.build(system_prompt, prompt, few_shot_examples, parser)
+        reserved_tokens = self._get_reserved_tokens(system_prompt, built_prompt)
+        chunks = []
+        async with self._acquire_slot(), self.rate_limiter.limit_async(tokens=reserved_tokens):
+            with metrics.span("llm.stream", model=self.model_name, prompt_tokens=built_prompt.prompt_tokens) as span:
+                start = time.perf_counter()
+                completed = False
+                message_chunks = self.llm.astream(built_prompt.query, max_tokens=built_prompt.max_tokens)
+                try:
+                    while True:
+                        try:
+                            remaining_time = None if timeout is None else timeout - (time.perf_counter() - start)
+                            message_chunk = await asyncio.wait_for(message_chunks.__anext__(), remaining_time)
+
+                        except StopAsyncIteration:
+                            break
+
+                        chunk = message_chunk.content
+                        if not chunk:
+                            continue
+
+                        if not chunks:
+                            metrics.observe("homematch_llm_first_token_seconds", time.perf_counter() - start)
+
+                        chunks.append(chunk)
+                        yield chunk
+
+                    self._record_tokens(span, system_prompt, built_prompt, reserved_tokens, "".join(chunks))
+                    completed = True
+
+                finally:
+                    await message_chunks.aclose()  # Releases the connection of a stream closed before its end
+                    if not completed:
+                        # A stream that failed or that the consumer closed early used the chunks it received,
+                        # and its prompt once the answer started, a failed request nothing
+                        used_tokens = (built_prompt.prompt_tokens + self.prompt_builder.count_tokens("".join(chunks))
+                                       if chunks else 0)
+                        self.rate_limiter.settle(reserved_tokens, used_tokens)
+
+    def _get_cache_key(self, system_prompt: str, prompt: str, few_shot_examples: Union[str, List[str], None],
+                       parser: Optional[PydanticOutputParser]) -> str:
+        parser_schema = self.prompt_builder.get_format_instructions(parser)
+        return ResponseCache.make_key(system_prompt, prompt, few_shot_examples, parser_schema,
+                                      self.model_name, self.temperature)
+
     async def _get_gen_ai_response(self, system_prompt, user_prompt: str,
-                                   few_shot_examples: str = None,
-                                   parser: PydanticOutputParser = None) -> str:
-        openai_api_key = os.getenv("OPENAI_API_KEY")
+                                   few_shot_examples: Union[str, List[str]] = None,
+                                   parser: PydanticOutputParser = None,
+                                   timeout: Optional[float] = None) -> str:
         if not system_prompt:
             print("WARNING: System prompt is empty")
 
-        llm = OpenAI(model_name=GPT4O_MODEL_NAME, temperature=0.2,
-                     max_tokens=MAX_OUTPUT_TOKENS_AMOUNT, api_key=openai_api_key)
+        prompt = self.prompt_builder.build(system_prompt, user_prompt, few_shot_examples, parser)
+        reserved_tokens = self._get_reserved_tokens(system_prompt, prompt)
+        async with self._acquire_slot():
+            response = await asyncio.wait_for(
+                self.rate_limiter.call_async(lambda: self._invoke(system_prompt, prompt, reserved_tokens),
+                                             tokens=reserved_tokens),
+                timeout=timeout)
+
+        return response
 
-        query = await self._create_query(few_shot_examples, parser, system_prompt, user_prompt)
+    async def _invoke(self, system_prompt: str, prompt: BuiltPrompt, reserved_tokens: int) -> str:
+        with metrics.span("llm.call", model=self.model_name, prompt_tokens=prompt.prompt_tokens) as span:
+            response = (await self.llm.ainvoke(prompt.query, max_tokens=prompt.max_tokens)).content
+            self._record_tokens(span, system_prompt, prompt, reserved_tokens, response)
 
-        response = await asyncio.get_event_loop().run_in_executor(self.executor, llm.invoke,
-                                                                  query)  # Async is not supported directly in LangChain
-        response = self._correct_json_parsing(response)
         return response
 
+    def _get_reserved_tokens(self, system_prompt: str, prompt: BuiltPrompt) -> int:
+        completion_tokens = self.completion_tokens_estimates.get(system_prompt, CHAT_COMPLETION_TOKENS_ESTIMATE)
+        return prompt.prompt_tokens + min(prompt.max_tokens, int(completion_tokens))
+
+    async def _on_response(self, response) -> None:
+        # The rate limited responses are handled by the limiter with their error
+        if response.is_success:
+            self.rate_limiter.update_from_headers(response.headers)
+
+    @asynccontextmanager
+    async def _acquire_slot(self) -> AsyncIterator[None]:
+        # The requests waiting for a free slot are the queue in front of the model
+        metrics.add_to_gauge("homematch_llm_waiting_requests", 1)
+        try:
+            await self.semaphore.acquire()
+
+        finally:
+            metrics.add_to_gauge("homematch_llm_waiting_requests", -1)
+
+        try:
+            yield
+
+        finally:
+            self.semaphore.release()
+
+    def _record_tokens(self, span, system_prompt: str, prompt: BuiltPrompt, reserved_tokens: int,
+                       response: str) -> None:
+        completion_tokens = self.prompt_builder.count_tokens(response)
+        span.set_attribute("completion_tokens", completion_tokens)
+        metrics.counter("homematch_llm_tokens_total", prompt.prompt_tokens, kind="prompt", model=self.model_name)
+        metrics.counter("homematch_llm_tokens_total", completion_tokens, kind="completion", model=self.model_name)
+        self.rate_limiter.settle(reserved_tokens, prompt.prompt_tokens + completion_tokens)
+        estimate = self.completion_tokens_estimates.get(system_prompt)
+        self.completion_tokens_estimates[system_prompt] = (
+            completion_tokens if estimate is None
+            else estimate + CHAT_COMPLETION_TOKENS_SMOOTHING * (completion_tokens - estimate))
+
     @staticmethod
-    async def _create_query(few_shot_examples: str, parser: PydanticOutputParser,
-                            system_prompt: str, user_prompt: str) -> str:
-        prompt_template = """
-        {system_prompt}
-        {prompt}
-        Examples:
-        {few_shot_examples}
-        """
+    def _is_valid_response(response: dict, parser: Optional[PydanticOutputParser]) -> bool:
+        # A cached reply is served again for every identical prompt, a malformed one would be retried into itself
+        if not response:
+            return False
+
+        if parser is None:
+            return True
 
-        if parser is not None:
-            prompt_template = """
-            {system_prompt}
-            {prompt}
-            {format_instructions}
-            Examples:
-            {few_shot_examples}
-            """
-
-        prompt = PromptTemplate(
-            template=prompt_template,
-            input_variables=["system_prompt", "prompt", "few_shot_examples"],
-            partial_variables={"format_instructions": parser.get_format_instructions()} if parser is not None else {}
-        )
-        query = prompt.format(
-            system_prompt=system_prompt,
-            prompt=user_prompt,
-            few_shot_examples=few_shot_examples if few_shot_examples else ""
-        )
-        return query
+        try:
+            parser.pydantic_object.model_validate(response)
+            return True
+
+        except ValidationError:
+            return False
+
+    @staticmethod
+    async def aparse_gen_ai_response(response: str) -> dict:
+        # Parsing a large response would hold the event loop, it goes to the CPU pool
+        return await get_cpu_pool().run(GenAICaller.parse_gen_ai_response, response,
+                                        offload=len(response) >= CPU_POOL_MIN_OFFLOAD_CHARS)
+
+    @staticmethod
+    def parse_gen_ai_response(response: str) -> dict:
+        return GenAICaller._safe_json_loads(GenAICaller._correct_json_parsing(response))
 
     @staticmethod
     def _safe_json_loads(response: str) -> dict:
@@ -95,9 +270,15 @@ class GenAICaller:
         return score
 
 
-if __name__ == "__main__":
-    gen_ai_caller = GenAICaller()
-    gen_ai_response = asyncio.run(
-        gen_ai_caller.call_gen_ai(LISTINGS_SYSTEM_PROMPT, LISTINGS_PROMPT_QUESTION, LISTINGS_FEW_SHOT_EXAMPLE,
-                                  parser=PydanticOutputParser(pydantic_object=HouseListing)))
+async def main():
+    from scripts.resources.consts import LISTINGS_PROMPT_QUESTION
+
+    async with GenAICaller() as gen_ai_caller:
+        gen_ai_response = await gen_ai_caller.call_gen_ai(LISTINGS_SYSTEM_PROMPT, LISTINGS_PROMPT_QUESTION,
+                                                          LISTINGS_FEW_SHOT_EXAMPLE,
+                                                          parser=PydanticOutputParser(pydantic_object=HouseListing))
     print(gen_ai_response)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,45 +1,256 @@
 import os
-from typing import List
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-import chromadb
-from langchain.embeddings import OpenAIEmbeddings
-from langchain.schema import Document
-from langchain.vectorstores import Chroma
+from scripts.bm25_index import BM25Index
+from scripts.embeddings import get_embedding_backend
+from scripts.listing_attribute_index import ListingAttributeIndex
+from scripts.listing_reranker import ListingReranker
+from scripts.models import ListingDocument, ListingFilter, ListingConverter
+from scripts.resources.consts import BUYER_PREFERENCES_STR, QUERY_EMBEDDING_CACHE_SIZE, VECTOR_STORE_BACKEND, \
+    HYBRID_SEARCH, HYBRID_FETCH_K_MULTIPLIER, RRF_K, RETRIEVAL_FETCH_K, RETRIEVAL_FINAL_K
+from scripts.utils.lru_cache import LRUCache
+from scripts.utils.metrics import metrics
+from scripts.vector_stores import ListingsVectorStore, get_vector_store
 
-from scripts.resources.consts import BUYER_PREFERENCES_STR
+if TYPE_CHECKING:
+    from langchain_core.embeddings import Embeddings
 
 
 class ListingSearcher:
     """
     Create a class that goes to listings.db chroma.sqlite database and performs a semantic search on the listings.
     The class should have a method that takes a query and returns the top 5 listings that are most similar to the query.
+
+    The store is opened once and kept for the lifetime of the searcher, and query embeddings are cached by their
+    normalized text, so repeated buyer queries skip the embedding API call.
+    The embeddings default to the backend selected by HOMEMATCH_EMBEDDING_BACKEND (see embeddings.py), and the
+    vector store to the one selected by HOMEMATCH_VECTOR_STORE: chroma, or numpy for an in-process
+    memory-mapped index (see vector_stores.py).
+
+    With hybrid search (HOMEMATCH_HYBRID_SEARCH, on by default) the dense results are fused with the results of
+    the BM25 index built at ingestion by reciprocal rank fusion, so exact keyword matches such as an amenity or
+    a neighborhood name are not lost. Without a BM25 index next to the db the search is dense only.
+    retrieve_listings() over-fetches candidates and reranks them locally (see listing_reranker.py), so only the
+    best few reach the costly personalization.
     """
 
-    def __init__(self, db_path="resources/listings.db"):
+    def __init__(self, db_path="resources/listings.db", query_cache_size: int = QUERY_EMBEDDING_CACHE_SIZE,
+                 embeddings: Optional["Embeddings"] = None, vector_store: str = VECTOR_STORE_BACKEND,
+                 hybrid: bool = HYBRID_SEARCH, reranker: Optional[ListingReranker] = None):
         self.db_path = db_path
-        self.chroma_client = chromadb.config.Settings(
-            persist_directory=self.db_path,
-        )
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self.hybrid = hybrid
+        self.reranker = reranker or ListingReranker()
+        self.query_embedding_cache = LRUCache(max_size=query_cache_size)
+        self._vectorstore = None
+        self._lexical_index = None
+        self._lexical_index_loaded = False
+        self._lexical_index_state = None
+
+    @property
+    def vectorstore(self) -> ListingsVectorStore:
+        if self._vectorstore is None:
+            self._vectorstore = get_vector_store(self.db_path, self.embeddings or get_embedding_backend(),
+                                                 self.vector_store)
+
+        return self._vectorstore
+
+    @property
+    def attribute_index(self) -> ListingAttributeIndex:
+        return self.vectorstore.attribute_index
+
+    @property
+    def lexical_index(self) -> Optional[BM25Index]:
+        # Reloaded whenever an ingestion replaced the file, so its ids stay in step with the vector store
+        if not self.hybrid:
+            return None
+
+        bm25_path = BM25Index.get_path(self.db_path)
+        lexical_index_state = self._get_file_state(bm25_path)
+        if self._lexical_index_loaded and lexical_index_state == self._lexical_index_state:
+            return self._lexical_index
+
+        if lexical_index_state is not None:
+            self._lexical_index = BM25Index.load(bm25_path)
+
+        else:
+            self._lexical_index = None
+            print(f"No BM25 index at {bm25_path}, searching by embeddings only")
+
+        self._lexical_index_loaded = True
+        self._lexical_index_state = lexical_index_state
+        return self._lexical_index
 
-    def search_listings(self, query: str) -> List[Document]:
+    def warmup(self) -> None:
+        print("Warming up the listings db")
+        self.vectorstore.warmup()
+        _ = self.lexical_index
+
+    def search_listings(self, query: str, k: int = 5,
+                        listing_filter: Optional[ListingFilter] = None) -> List[ListingDocument]:
+        """
+        Returns the k listings most similar to the query.
+        If a listing_filter is given, only listings whose attributes satisfy it are searched.
+        """
         print("Searching for similar listing")
-        # load the existing db:
-        db = self._load_chroma_db()
-        most_similar = db.similarity_search(query, k=5)
+        with metrics.span("search", k=k) as span:
+            listing_filter, k, fetch_k = self._get_filter_condition(listing_filter, k)
+            span.set_attribute("filtered", listing_filter is not None)
+            if k == 0:
+                return []
+
+            query_embedding = self._embed_query(query)
+            with metrics.span("search.vector_store", k=fetch_k):
+                most_similar = self.vectorstore.search_by_vectors([query_embedding], fetch_k, listing_filter)[0]
+
+            if self.lexical_index is not None:
+                most_similar = self._fuse_with_lexical_results(query, most_similar, k, fetch_k, listing_filter)
+
         return most_similar
 
-    def _load_chroma_db(self) -> Chroma:
-        embeddings = OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY"))
+    def retrieve_listings(self, buyer_preferences: str, fetch_k: int = RETRIEVAL_FETCH_K,
+                          final_k: int = RETRIEVAL_FINAL_K,
+                          listing_filter: Optional[ListingFilter] = None) -> List[ListingDocument]:
+        """
+        Searches fetch_k candidates for the buyer preferences and returns the final_k best after reranking.
+        """
+        candidates = self.search_listings(buyer_preferences, k=max(fetch_k, final_k), listing_filter=listing_filter)
+        return self.reranker.rerank(buyer_preferences, candidates, final_k, listing_filter)
+
+    def search_listings_batch(self, queries: List[str], k: int = 5,
+                              listing_filter: Optional[ListingFilter] = None) -> List[List[ListingDocument]]:
+        """
+        Searches many queries at once: the uncached queries are embedded in batched requests and the collection
+        is queried once with all the embeddings. The results are aligned with the input queries.
+        """
+        print(f"Searching for similar listings of {len(queries)} queries")
+        with metrics.span("search.batch", queries=len(queries), k=k) as span:
+            listing_filter, k, fetch_k = self._get_filter_condition(listing_filter, k)
+            span.set_attribute("filtered", listing_filter is not None)
+            if not queries or k == 0:
+                return [[] for _ in queries]
+
+            query_embeddings = self._embed_queries(queries)
+            with metrics.span("search.vector_store", k=fetch_k, queries=len(queries)):
+                results = self.vectorstore.search_by_vectors(query_embeddings, fetch_k, listing_filter)
+
+            if self.lexical_index is not None:
+                results = [self._fuse_with_lexical_results(query, query_results, k, fetch_k, listing_filter)
+                           for query, query_results in zip(queries, results)]
+
+        return results
+
+    def _get_filter_condition(self, listing_filter: Optional[ListingFilter],
+                              k: int) -> Tuple[Optional[ListingFilter], int, int]:
+        # The columnar index tells how many listings pass the filter before touching the vector store,
+        # so an unsatisfiable filter skips the search and k never exceeds the candidates.
+        # fetch_k is the number of candidates each retriever contributes to the hybrid fusion
+        fetch_k = k
+        if self.lexical_index is not None:
+            fetch_k = min(k * HYBRID_FETCH_K_MULTIPLIER, max(k, len(self.lexical_index)))
+
+        if listing_filter is None or listing_filter.is_empty():
+            return None, k, fetch_k
+
+        candidates_count = self.attribute_index.count(listing_filter)
+        if candidates_count == 0:
+            print("No listings match the buyer's requirements")
+
+        return listing_filter, min(k, candidates_count), min(fetch_k, candidates_count)
+
+    def _fuse_with_lexical_results(self, query: str, dense_documents: List[ListingDocument], k: int,
+                                   fetch_k: int, listing_filter: Optional[ListingFilter]) -> List[ListingDocument]:
+        with metrics.span("search.lexical", k=fetch_k):
+            lexical_ids = [listing_id for listing_id, _ in self.lexical_index.search(query, fetch_k, listing_filter)]
+
+        documents_by_id = {self._get_listing_id(document): document for document in dense_documents}
+        fused_ids = self._reciprocal_rank_fusion([list(documents_by_id), lexical_ids])
+        # Listings found by BM25 only are fetched from the store. An id the store no longer has (deleted since the
+        # BM25 index was loaded) is skipped and the next fused listing takes its place, so k results still come back
+        documents = []
+        position = 0
+        while len(documents) < k and position < len(fused_ids):
+            window = fused_ids[position:position + k - len(documents)]
+            position += len(window)
+            missing_ids = [listing_id for listing_id in window if listing_id not in documents_by_id]
+            if missing_ids:
+                documents_by_id.update((self._get_listing_id(document), document)
+                                       for document in self.vectorstore.get_documents(missing_ids))
+
+            found_documents = [documents_by_id[listing_id] for listing_id in window if listing_id in documents_by_id]
+            metrics.counter("homematch_stale_lexical_ids_total", len(window) - len(found_documents))
+            documents.extend(found_documents)
+
+        return documents
+
+    @staticmethod
+    def _reciprocal_rank_fusion(rankings: List[List[str]], rrf_k: int = RRF_K) -> List[str]:
+        # Every ranking adds 1 / (rrf_k + rank) to the score of its items, so no score normalization is needed
+        scores: Dict[str, float] = {}
+        for ranking in rankings:
+            for rank, listing_id in enumerate(ranking, start=1):
+                scores[listing_id] = scores.get(listing_id, 0.0) + 1 / (rrf_k + rank)
+
+        return sorted(scores, key=scores.get, reverse=True)
+
+    @staticmethod
+    def _get_file_state(path: str) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(path)
+
+        except FileNotFoundError:
+            return None
+
+        return stat.st_ino, stat.st_mtime_ns
+
+    @staticmethod
+    def _get_listing_id(document: ListingDocument) -> str:
+        return document.metadata.get("content_hash") or ListingConverter.get_listing_id(document.page_content)
+
+    def _embed_queries(self, queries: List[str]) -> List[List[float]]:
+        normalized_queries = [self._normalize_query(query) for query in queries]
+        query_embeddings = {}
+        for normalized_query in normalized_queries:
+            query_embedding = self.query_embedding_cache.get(normalized_query)
+            if query_embedding is not None:
+                query_embeddings[normalized_query] = query_embedding
+
+        # Deduplicate the missing queries so each distinct text is embedded once
+        missing_queries = {normalized_query: query for normalized_query, query in zip(normalized_queries, queries)
+                           if normalized_query not in query_embeddings}
+        metrics.counter("homematch_query_embedding_cache_requests_total", len(queries) - len(missing_queries),
+                        result="hit")
+        metrics.counter("homematch_query_embedding_cache_requests_total", len(missing_queries), result="miss")
+        if missing_queries:
+            with metrics.span("search.embed_queries", queries=len(missing_queries)):
+                missing_embeddings = self.vectorstore.embeddings.embed_documents(list(missing_queries.values()))
+
+            for normalized_query, query_embedding in zip(missing_queries, missing_embeddings):
+                self.query_embedding_cache.put(normalized_query, query_embedding)
+                query_embeddings[normalized_query] = query_embedding
+
+        return [query_embeddings[normalized_query] for normalized_query in normalized_queries]
+
+    def _embed_query(self, query: str) -> List[float]:
+        normalized_query = self._normalize_query(query)
+        query_embedding = self.query_embedding_cache.get(normalized_query)
+        metrics.counter("homematch_query_embedding_cache_requests_total",
+                        result="hit" if query_embedding is not None else "miss")
+        if query_embedding is None:
+            with metrics.span("search.embed_query"):
+                query_embedding = self.vectorstore.embeddings.embed_query(query)
+
+            self.query_embedding_cache.put(normalized_query, query_embedding)
+
+        return query_embedding
 
-        vectorstore = Chroma(
-            collection_name="listings_embeddings",
-            embedding_function=embeddings,
-            persist_directory=self.db_path,
-        )
-        print(f"Count of items in db: {vectorstore._collection.count()}")
-        return vectorstore
+    @staticmethod
+    def _normalize_query(query: str) -> str:
+        return " ".join(query.split()).lower()
 
 
 if __name__ == "__main__":
     listing_searcher = ListingSearcher()
+    listing_searcher.warmup()
     listing_searcher.search_listings(BUYER_PREFERENCES_STR)
@@ -0,0 +1,277 @@
+import asyncio
+import os
+import re
+import zlib
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from functools import lru_cache
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from scripts.resources.consts import EMBEDDING_BACKEND, LISTINGS_COLLECTION_NAME, LOCAL_EMBEDDING_DIMENSIONS, \
+    LOCAL_EMBEDDING_BATCH_SIZE, OPENAI_BASE_URL_ENV_VAR, CHARS_PER_TOKEN, EMBEDDING_MAX_INPUTS_PER_REQUEST, \
+    EMBEDDING_MAX_TOKENS_PER_REQUEST, EMBEDDING_MAX_TOKENS_PER_INPUT, EMBEDDING_MIN_INPUTS_PER_REQUEST, \
+    EMBEDDING_MAX_CONCURRENT_REQUESTS
+from scripts.utils.rate_limiter import get_rate_limiter
+
+if TYPE_CHECKING:
+    from langchain_core.embeddings import Embeddings
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+class EmbeddingBackend:
+    """
+    The interface every embedding backend implements. It has the methods of a LangChain Embeddings, so a backend can
+    be handed directly to the Chroma vector store for both ingestion and search. It does not subclass it, importing
+    LangChain would take most of the startup of a search-only process.
+    Each backend stores its vectors in its own collection, since vectors of different backends are not comparable.
+    """
+    name = "base"
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        raise NotImplementedError
+
+    def embed_query(self, text: str) -> List[float]:
+        raise NotImplementedError
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await asyncio.to_thread(self.embed_query, text)
+
+    def embed_in_batches(self, texts: List[str]) -> Iterator[Tuple[int, List[List[float]]]]:
+        """
+        Yields the embeddings of texts one batch at a time, as the offset of the batch in texts and its embeddings.
+        Batches may come in any order, so a large corpus can be written as it is embedded rather than held in memory.
+        """
+        yield 0, self.embed_documents(texts)
+
+    @property
+    def collection_name(self) -> str:
+        return LISTINGS_COLLECTION_NAME
+
+    def close(self) -> None:
+        pass
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    """
+    OpenAI embeddings, requested through the rate limiter shared by all embedding calls.
+    Every text gets one vector. OpenAIEmbeddings tokenizes the texts with tiktoken and embeds a text longer than the
+    input limit of the model in chunks within it, averaged by their token counts, so none of it is dropped (and it
+    fails loudly without the tiktoken encoding). Texts are packed into requests of at most max_inputs_per_request texts and
+    max_tokens_per_request estimated tokens (capped by the token bucket of the limiter, so a request never waits for
+    more than a full bucket), spread evenly over max_concurrent_requests requests in flight at a time.
+    """
+    name = "openai"
+
+    def __init__(self, max_inputs_per_request: int = EMBEDDING_MAX_INPUTS_PER_REQUEST,
+                 max_tokens_per_request: int = EMBEDDING_MAX_TOKENS_PER_REQUEST,
+                 max_concurrent_requests: int = EMBEDDING_MAX_CONCURRENT_REQUESTS):
+        import openai
+        from langchain.embeddings import OpenAIEmbeddings
+        self.rate_limiter = get_rate_limiter("embeddings")
+        # Our own client, so the rate limit headers of the successful responses reach the limiter
+        http_client = openai.DefaultHttpxClient(event_hooks={"response": [self._on_response]})
+        client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"), base_url=os.getenv(OPENAI_BASE_URL_ENV_VAR),
+                               max_retries=0, http_client=http_client).embeddings
+        self.openai_embeddings = OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY"),
+                                                  openai_api_base=os.getenv(OPENAI_BASE_URL_ENV_VAR), client=client,
+                                                  embedding_ctx_length=EMBEDDING_MAX_TOKENS_PER_INPUT,
+                                                  chunk_size=max_inputs_per_request,
+                                                  max_retries=0)  # Retries go through the shared rate limiter
+        self.max_inputs_per_request = max_inputs_per_request
+        self.max_tokens_per_request = max_tokens_per_request
+        self.max_concurrent_requests = max(1, max_concurrent_requests)
+        self._executor = None
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        embeddings = [None] * len(texts)
+        for start, batch_embeddings in self.embed_in_batches(texts):
+            embeddings[start:start + len(batch_embeddings)] = batch_embeddings
+
+        return embeddings
+
+    def embed_in_batches(self, texts: List[str]) -> Iterator[Tuple[int, List[List[float]]]]:
+        max_tokens = min(self.max_tokens_per_request, int(self.rate_limiter.tokens_bucket.capacity))
+        batches = get_embedding_batches(texts, self.max_inputs_per_request, max_tokens, self.max_concurrent_requests)
+        if len(batches) < 2:
+            if texts:
+                yield 0, self._embed_batch(texts)
+
+            return
+
+        executor = self._get_executor()
+        # At most max_concurrent_requests batches are in flight, which also bounds the embeddings held in memory
+        in_flight: Dict[Future, int] = {}
+        for start, end in batches:
+            if len(in_flight) >= self.max_concurrent_requests:
+                yield from self._pop_completed(in_flight)
+
+            in_flight[executor.submit(self._embed_batch, texts[start:end])] = start
+
+        while in_flight:
+            yield from self._pop_completed(in_flight)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.rate_limiter.call(lambda: self.openai_embeddings.embed_query(text),
+                                      tokens=self._estimate_tokens([text]))
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def _on_response(self, response) -> None:
+        # The rate limited responses are handled by the limiter with their error
+        if response.is_success:
+            self.rate_limiter.update_from_headers(response.headers)
+
+    def _embed_batch(self, texts: List[str]) -> List[List[float]]:
+        # One request per batch, unless its long texts were split into more than max_inputs_per_request chunks
+        return self.rate_limiter.call(lambda: self.openai_embeddings.embed_documents(texts, chunk_size=len(texts)),
+                                      tokens=self._estimate_tokens(texts))
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrent_requests,
+                                                thread_name_prefix="embeddings")
+
+        return self._executor
+
+    @staticmethod
+    def _pop_completed(in_flight: Dict[Future, int]) -> Iterator[Tuple[int, List[List[float]]]]:
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield in_flight.pop(future), future.result()
+
+    @staticmethod
+    def _estimate_tokens(texts: List[str]) -> int:
+        return sum(len(text) for text in texts) // CHARS_PER_TOKEN + 1
+
+
+class HashingEmbeddingBackend(EmbeddingBackend):
+    """
+    A CPU-only local embedding: word unigrams and bigrams are hashed into a fixed number of signed buckets,
+    weighted by sublinear term frequency and L2 normalized. It needs no model download or API key.
+    Large inputs are encoded in NumPy batches spread over a pool of processes.
+    """
+    name = "hashing"
+
+    def __init__(self, dimensions: int = LOCAL_EMBEDDING_DIMENSIONS, batch_size: int = LOCAL_EMBEDDING_BATCH_SIZE,
+                 max_workers: Optional[int] = None):
+        self.dimensions = dimensions
+        self.batch_size = batch_size
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._executor = None
+
+    @property
+    def collection_name(self) -> str:
+        return f"{LISTINGS_COLLECTION_NAME}_{self.name}_{self.dimensions}"
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(texts).tolist()
+
+    def embed_in_batches(self, texts: List[str]) -> Iterator[Tuple[int, List[List[float]]]]:
+        # One round of the process pool per batch
+        round_size = self.batch_size * self.max_workers
+        for start in range(0, len(texts), round_size):
+            yield start, self.encode(texts[start:start + round_size]).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return encode_hashed_batch([text], self.dimensions)[0].tolist()
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        if len(texts) <= self.batch_size or self.max_workers == 1:
+            return encode_hashed_batch(texts, self.dimensions)
+
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+
+        return np.vstack(list(self._executor.map(encode_hashed_batch, batches,
+                                                 [self.dimensions] * len(batches))))
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def get_embedding_batches(texts: List[str], max_inputs: int, max_tokens: int,
+                          max_concurrent_requests: int = 1) -> List[Tuple[int, int]]:
+    """
+    Splits texts into consecutive (start, end) batches of at most max_inputs texts and max_tokens estimated tokens.
+    A corpus that fits in fewer than max_concurrent_requests full batches is spread evenly over that many requests,
+    down to EMBEDDING_MIN_INPUTS_PER_REQUEST texts each. A single text over max_tokens gets a batch of its own.
+    """
+    target_inputs = -(-len(texts) // max_concurrent_requests)
+    max_inputs = max(1, min(max_inputs, max(target_inputs, EMBEDDING_MIN_INPUTS_PER_REQUEST)))
+    batches = []
+    start, batch_tokens = 0, 0
+    for end, text in enumerate(texts):
+        text_tokens = len(text) // CHARS_PER_TOKEN + 1
+        if end > start and (end - start >= max_inputs or batch_tokens + text_tokens > max_tokens):
+            batches.append((start, end))
+            start, batch_tokens = end, 0
+
+        batch_tokens += text_tokens
+
+    if start < len(texts):
+        batches.append((start, len(texts)))
+
+    return batches
+
+
+def embed_in_batches(embeddings: "Embeddings", texts: List[str]) -> Iterator[Tuple[int, List[List[float]]]]:
+    """
+    EmbeddingBackend.embed_in_batches, for any LangChain Embeddings.
+    """
+    if isinstance(embeddings, EmbeddingBackend):
+        return embeddings.embed_in_batches(texts)
+
+    return iter([(0, embeddings.embed_documents(texts))])
+
+
+def encode_hashed_batch(texts: List[str], dimensions: int) -> np.ndarray:
+    # Module level so the process pool can pickle it
+    rows, feature_hashes = [], []
+    for row, text in enumerate(texts):
+        tokens = TOKEN_PATTERN.findall(text.lower())
+        features = tokens + [f"{first} {second}" for first, second in zip(tokens, tokens[1:])]
+        rows.extend([row] * len(features))
+        feature_hashes.extend(map(_hash_feature, features))
+
+    feature_hashes = np.asarray(feature_hashes, dtype=np.int64)
+    signs = np.where(feature_hashes & 0x80000000, 1.0, -1.0)
+    flat_indices = np.asarray(rows, dtype=np.int64) * dimensions + feature_hashes % dimensions
+    counts = np.bincount(flat_indices, weights=signs, minlength=len(texts) * dimensions)
+    counts = counts.astype(np.float32).reshape(len(texts), dimensions)
+    vectors = np.sign(counts) * np.log1p(np.abs(counts))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+@lru_cache(maxsize=1 << 20)
+def _hash_feature(feature: str) -> int:
+    # crc32 is stable across processes, unlike the salted built-in hash()
+    return zlib.crc32(feature.encode("utf-8"))
+
+
+EMBEDDING_BACKENDS = {
+    OpenAIEmbeddingBackend.name: OpenAIEmbeddingBackend,
+    HashingEmbeddingBackend.name: HashingEmbeddingBackend,
+}
+
+
+def get_embedding_backend(name: str = EMBEDDING_BACKEND) -> EmbeddingBackend:
+    if name not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{name}', choose one of {sorted(EMBEDDING_BACKENDS)}")
+
+    return EMBEDDING_BACKENDS[name]()
+
+
+def get_collection_name(embeddings: "Embeddings") -> str:
+    return getattr(embeddings, "collection_name", LISTINGS_COLLECTION_NAME)
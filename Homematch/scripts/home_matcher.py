@@ -1,13 +1,25 @@
+import argparse
 import os
 import sys
 import asyncio
 import json
-from typing import List
+from typing import TYPE_CHECKING, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Set
 
-from scripts.db_semantic_searcher import ListingSearcher
-from scripts.listing_personalizer import ListingPersonalizer
-from scripts.listings_creator_langchain import ListingsGenerator
-from scripts.resources.consts import BUYER_PREFERENCES_STR
+from scripts.embeddings import get_embedding_backend, EMBEDDING_BACKENDS
+from scripts.models import ListingDocument, ListingFilter
+from scripts.utils.cpu_pool import get_cpu_pool
+from scripts.utils.metrics import metrics, configure_metrics
+from scripts.vector_stores import VECTOR_STORES
+from scripts.resources.consts import BUYER_PREFERENCES_STR, BUYER_QUESTIONS, MAX_WORKERS, BATCH_MATCHES_PATH, \
+    LISTINGS_COUNT, STREAM_MATCHES_PATH, OPENAI_BASE_URL_ENV_VAR, METRICS_SINKS, METRICS_QUEUE_SAMPLE_INTERVAL_SECONDS, \
+    VECTOR_STORE_BACKEND, RETRIEVAL_FETCH_K, RETRIEVAL_FINAL_K, EMBEDDING_BACKEND, \
+    SEARCH_RESULTS_PATH, PERSONALIZATION_STORE_PATH, PRECOMPUTE_MAX_CLUSTERS
+
+if TYPE_CHECKING:
+    from scripts.db_semantic_searcher import ListingSearcher
+    from scripts.listing_personalizer import ListingPersonalizer
+    from scripts.listings_creator_langchain import ListingsGenerator
+    from scripts.personalization_store import PersonalizationStore
 
 current_file_path = os.path.abspath(__file__)
 project_root_path = os.path.dirname(os.path.dirname(current_file_path))
@@ -19,18 +31,82 @@ sys.path.append(project_root_path)
 class HomeMatcher:
     """
     The main module that coordinates the generation, searching, and personalization of home listings.
+
+    match() handles a single buyer and match_stream() yields its personalized listings as they complete.
+    match_batch() streams a JSONL file of buyer profiles through the search and
+    personalization stages with bounded queues between them and appends the results to a JSONL file as they complete.
+    search_batch() and personalize_batch() run the two stages of match_batch() as separate jobs.
+    precompute_personalizations() is the off-peak job filling the personalization store, which the personalization
+    checks before calling the LLM once it exists.
+
+    Every stage is created, and its module imported, on first use, so a job running a single stage does not pay
+    for the imports of the others (LangChain and the LLM clients are only needed to generate and personalize).
     """
 
-    def __init__(self, api_key: str = os.getenv("OPENAI_API_KEY")):
+    def __init__(self, api_key: str = os.getenv("OPENAI_API_KEY"), concurrency: int = MAX_WORKERS,
+                 embedding_backend: Optional[str] = None, num_listings: int = LISTINGS_COUNT,
+                 batched_personalization: bool = False, db_path: str = "resources/listings.db",
+                 vector_store: str = VECTOR_STORE_BACKEND, fetch_k: int = RETRIEVAL_FETCH_K,
+                 final_k: int = RETRIEVAL_FINAL_K, personalization_store_path: str = PERSONALIZATION_STORE_PATH):
         self.api_key = api_key
-        self.listing_generator = ListingsGenerator()
-        self.listing_searcher = ListingSearcher()
-        self.listing_personalizer = ListingPersonalizer()
-
-    async def match(self) -> List[dict]:
-        await self.listing_generator.generate_listings()  # In reality would be an extraction from a database
-        listing_similar_to_customer_preferences = self.listing_searcher.search_listings(BUYER_PREFERENCES_STR)
-        personalized_listings = await self.listing_personalizer.personalize_listings(BUYER_PREFERENCES_STR,
+        self.concurrency = concurrency
+        self.num_listings = num_listings
+        # fetch_k candidates are searched and reranked, only the final_k best are personalized
+        self.fetch_k = fetch_k
+        self.final_k = final_k
+        self.db_path = db_path
+        self.vector_store = vector_store
+        self.batched_personalization = batched_personalization
+        self.personalization_store_path = personalization_store_path
+        # One backend shared by ingestion and search, so both embed into the same collection
+        self.embeddings = get_embedding_backend(embedding_backend) if embedding_backend else None
+        self._listing_generator = None
+        self._listing_searcher = None
+        self._listing_personalizer = None
+        self._personalization_store = None
+
+    @property
+    def listing_generator(self) -> "ListingsGenerator":
+        if self._listing_generator is None:
+            from scripts.listings_creator_langchain import ListingsGenerator
+            self._listing_generator = ListingsGenerator(db_path=self.db_path, embeddings=self.embeddings,
+                                                        vector_store=self.vector_store)
+
+        return self._listing_generator
+
+    @property
+    def listing_searcher(self) -> "ListingSearcher":
+        if self._listing_searcher is None:
+            from scripts.db_semantic_searcher import ListingSearcher
+            self._listing_searcher = ListingSearcher(db_path=self.db_path, embeddings=self.embeddings,
+                                                     vector_store=self.vector_store)
+
+        return self._listing_searcher
+
+    @property
+    def listing_personalizer(self) -> "ListingPersonalizer":
+        if self._listing_personalizer is None:
+            from scripts.listing_personalizer import ListingPersonalizer
+            self._listing_personalizer = ListingPersonalizer(db_path=self.db_path, max_workers=self.concurrency,
+                                                             batched=self.batched_personalization,
+                                                             personalization_store=self.personalization_store)
+
+        return self._listing_personalizer
+
+    @property
+    def personalization_store(self) -> Optional["PersonalizationStore"]:
+        # Opened once precompute_personalizations() has written it, an empty path disables it
+        if self._personalization_store is None and self.personalization_store_path and \
+                os.path.exists(self.personalization_store_path):
+            from scripts.personalization_store import PersonalizationStore
+            self._personalization_store = PersonalizationStore(self.personalization_store_path)
+
+        return self._personalization_store
+
+    async def match(self, buyer_preferences: str = BUYER_PREFERENCES_STR) -> List[dict]:
+        await self.listing_generator.generate_listings(self.num_listings)  # In reality would be an extraction from a database
+        listing_similar_to_customer_preferences = self._retrieve_listings(buyer_preferences)
+        personalized_listings = await self.listing_personalizer.personalize_listings(buyer_preferences,
                                                                                      listing_similar_to_customer_preferences)
         personalized_listings_json = [listing.dict() for listing in personalized_listings]
         listings_json_path = "resources/personalized_listings.json"
@@ -38,6 +114,367 @@ class HomeMatcher:
             json.dump(personalized_listings_json, f, indent=4)
 
         print(f"Personalized listings saved to {listings_json_path}")
+        return personalized_listings_json
+
+    async def match_stream(self, buyer_preferences: str = BUYER_PREFERENCES_STR,
+                           output_path: str = STREAM_MATCHES_PATH,
+                           on_token: Optional[Callable[[int, str], None]] = None,
+                           generate_listings: bool = True,
+                           on_reset: Optional[Callable[[int], None]] = None) -> AsyncIterator[dict]:
+        """
+        Yields every personalized listing as soon as it is ready and appends it to output_path (JSONL).
+        on_token(listing index, text chunk) receives the partial descriptions while they are generated, and
+        on_reset(listing index) is called when the partial description of a listing is discarded by a fallback.
+        """
+        if generate_listings:
+            await self.listing_generator.generate_listings(self.num_listings)
+
+        listings = await asyncio.to_thread(self._retrieve_listings, buyer_preferences)
+        with open(output_path, "w") as f:
+            async for listing in self.listing_personalizer.personalize_listings_stream(buyer_preferences, listings,
+                                                                                       on_token=on_token,
+                                                                                       on_reset=on_reset):
+                listing_json = listing.dict()
+                f.write(json.dumps(listing_json) + "\n")
+                f.flush()
+                yield listing_json
+
+    async def match_batch(self, profiles_path: str, output_path: str = BATCH_MATCHES_PATH,
+                          generate_listings: bool = True) -> int:
+        """
+        Matches every buyer profile in profiles_path (JSONL) and appends one JSONL line per buyer to output_path.
+        Buyers already present in output_path are skipped, so a crashed run resumes where it stopped. A resumed run
+        never generates listings, the remaining buyers are matched against the corpus of the buyers already matched.
+        Returns the number of buyers matched in this run.
+        """
+        completed_buyer_ids = self._load_completed_buyer_ids(output_path)
+        if completed_buyer_ids:
+            print(f"Resuming batch, {len(completed_buyer_ids)} buyers already matched against the stored listings")
+
+        elif generate_listings:
+            await self.listing_generator.generate_listings(self.num_listings)  # Generated once for the whole batch
+
+        queue_size = self.concurrency * 2
+        search_queue = asyncio.Queue(maxsize=queue_size)
+        personalize_queue = asyncio.Queue(maxsize=queue_size)
+        write_queue = asyncio.Queue(maxsize=queue_size)
+
+        queue_depth_task = asyncio.create_task(self._report_queue_depths({"search": search_queue,
+                                                                          "personalize": personalize_queue,
+                                                                          "write": write_queue}))
+        writer_task = asyncio.create_task(self._write_matches(write_queue, output_path))
+        search_tasks = [asyncio.create_task(self._search_worker(search_queue, personalize_queue))
+                        for _ in range(self.concurrency)]
+        personalize_tasks = [asyncio.create_task(self._personalize_worker(personalize_queue, write_queue))
+                             for _ in range(self.concurrency)]
+
+        async def run_workers() -> None:
+            await self._read_profiles(profiles_path, completed_buyer_ids, search_queue)
+            for _ in search_tasks:
+                await search_queue.put(None)
+
+            await asyncio.gather(*search_tasks)
+            for _ in personalize_tasks:
+                await personalize_queue.put(None)
+
+            await asyncio.gather(*personalize_tasks)
+            await write_queue.put(None)
+
+        try:
+            matched_buyers_count = await self._run_with_writer(run_workers(), writer_task,
+                                                               search_tasks + personalize_tasks)
+
+        finally:
+            queue_depth_task.cancel()
+
+        print(f"Matched {matched_buyers_count} buyers, results saved to {output_path}")
+        return matched_buyers_count
+
+    async def generate(self) -> None:
+        await self.listing_generator.generate_listings(self.num_listings)
+
+    async def ingest(self, listings_path: str = "resources/listings.json") -> int:
+        """
+        Stores the listings of a JSON file, as saved by the generation, in the db without calling the LLM,
+        e.g. to index them again with another embedding backend or vector store. Returns the number of listings.
+        """
+        with open(listings_path, "r") as f:
+            listings_data = list(json.load(f).values())
+
+        listings = await self.listing_generator.validate_listings(listings_data)
+        await self.listing_generator.store_listings_in_db(listings)
+        return len(listings)
+
+    def search(self, buyer_preferences: str = BUYER_PREFERENCES_STR) -> List[ListingDocument]:
+        return self._retrieve_listings(buyer_preferences)
+
+    async def search_batch(self, profiles_path: str, output_path: str) -> int:
+        """
+        Searches the listings of every buyer profile in profiles_path (JSONL) and appends one JSONL line per buyer
+        with the retrieved listings to output_path, the input of personalize_batch().
+        Buyers already present in output_path are skipped. Returns the number of buyers searched in this run.
+        """
+        completed_buyer_ids = self._load_completed_buyer_ids(output_path)
+        search_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        results_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        write_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        writer_task = asyncio.create_task(self._write_matches(write_queue, output_path,
+                                                              "homematch_searched_buyers_total"))
+        results_task = asyncio.create_task(self._format_search_results(results_queue, write_queue))
+        search_tasks = [asyncio.create_task(self._search_worker(search_queue, results_queue))
+                        for _ in range(self.concurrency)]
+
+        async def run_workers() -> None:
+            await self._read_profiles(profiles_path, completed_buyer_ids, search_queue)
+            for _ in search_tasks:
+                await search_queue.put(None)
+
+            await asyncio.gather(*search_tasks)
+            await results_queue.put(None)
+            await results_task
+            await write_queue.put(None)
+
+        searched_buyers_count = await self._run_with_writer(run_workers(), writer_task, search_tasks + [results_task])
+        print(f"Searched the listings of {searched_buyers_count} buyers, results saved to {output_path}")
+        return searched_buyers_count
+
+    async def personalize_batch(self, search_results_path: str, output_path: str = BATCH_MATCHES_PATH) -> int:
+        """
+        Personalizes the listings of every buyer in search_results_path (JSONL, as written by search_batch()) and
+        appends one JSONL line per buyer to output_path, in the format of match_batch().
+        Buyers already present in output_path are skipped. Returns the number of buyers personalized in this run.
+        """
+        completed_buyer_ids = self._load_completed_buyer_ids(output_path)
+        personalize_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        write_queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        writer_task = asyncio.create_task(self._write_matches(write_queue, output_path))
+        personalize_tasks = [asyncio.create_task(self._personalize_worker(personalize_queue, write_queue))
+                             for _ in range(self.concurrency)]
+
+        async def run_workers() -> None:
+            with open(search_results_path, "r") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+
+                    search_result = json.loads(line)
+                    if str(search_result["buyer_id"]) in completed_buyer_ids:
+                        continue
+
+                    await personalize_queue.put((str(search_result["buyer_id"]), search_result["preferences"],
+                                                 [ListingDocument(**listing) for listing in search_result["listings"]]))
+
+            for _ in personalize_tasks:
+                await personalize_queue.put(None)
+
+            await asyncio.gather(*personalize_tasks)
+            await write_queue.put(None)
+
+        personalized_buyers_count = await self._run_with_writer(run_workers(), writer_task, personalize_tasks)
+        print(f"Personalized the listings of {personalized_buyers_count} buyers, results saved to {output_path}")
+        return personalized_buyers_count
+
+    async def precompute_personalizations(self, profiles_path: str,
+                                          max_clusters: int = PRECOMPUTE_MAX_CLUSTERS) -> int:
+        """
+        Clusters the buyer profiles of profiles_path (JSONL) by their preferences and stores the personalized
+        listings of the profile nearest to the center of each of the max_clusters largest clusters in the
+        personalization store. Meant to run off-peak on past or expected profiles, so the interactive requests of
+        similar buyers need no LLM call. Returns the number of clusters stored.
+        """
+        if self.personalization_store is None:
+            from scripts.personalization_store import PersonalizationStore
+            self._personalization_store = PersonalizationStore(self.personalization_store_path)
+
+        with open(profiles_path, "r") as f:
+            buyers_preferences = [self.format_buyer_preferences(json.loads(line)) for line in f if line.strip()]
+
+        clusters = self.personalization_store.cluster_profiles(buyers_preferences, max_clusters)
+        print(f"Precomputing the personalized listings of {len(clusters)} clusters "
+              f"of {len(buyers_preferences)} buyer profiles")
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with metrics.span("precompute", profiles=len(buyers_preferences), clusters=len(clusters)):
+            stored = await asyncio.gather(*(self._precompute_cluster(buyer_preferences, profiles_count, semaphore)
+                                            for buyer_preferences, profiles_count in clusters))
+
+        print(f"Stored the personalized listings of {sum(stored)} clusters in {self.personalization_store_path}")
+        return sum(stored)
+
+    async def _precompute_cluster(self, buyer_preferences: str, profiles_count: int,
+                                  semaphore: asyncio.Semaphore) -> bool:
+        async with semaphore:
+            try:
+                documents = await asyncio.to_thread(self._retrieve_listings, buyer_preferences)
+                listings = await self.listing_personalizer.personalize_listings(buyer_preferences, documents,
+                                                                                use_personalization_store=False)
+
+            except Exception as e:
+                metrics.counter("homematch_errors_total", stage="precompute")
+                print(f"Precomputing a cluster of {profiles_count} profiles failed: {e}")
+                return False
+
+        # A listing whose calls all failed keeps its original description, it is left to the live requests
+        augmented_descriptions = {self.listing_personalizer.get_listing_id(document): listing.augmented_description
+                                  for document, listing in zip(documents, listings)
+                                  if listing.augmented_description != listing.description}
+        self.personalization_store.put_cluster(buyer_preferences, profiles_count, augmented_descriptions)
+        return True
+
+    @staticmethod
+    async def _report_queue_depths(queues: Dict[str, asyncio.Queue]) -> None:
+        try:
+            while True:
+                for queue_name, queue in queues.items():
+                    metrics.gauge("homematch_queue_depth", queue.qsize(), queue=queue_name)
+
+                await asyncio.sleep(METRICS_QUEUE_SAMPLE_INTERVAL_SECONDS)
+
+        finally:
+            # Cancelled once the batch is done, leave the final depths rather than a stale sample
+            for queue_name, queue in queues.items():
+                metrics.gauge("homematch_queue_depth", queue.qsize(), queue=queue_name)
+
+    @staticmethod
+    async def _read_profiles(profiles_path: str, completed_buyer_ids: Set[str], search_queue: asyncio.Queue) -> None:
+        with open(profiles_path, "r") as f:
+            for line_number, line in enumerate(f):
+                if not line.strip():
+                    continue
+
+                profile = json.loads(line)
+                buyer_id = str(profile.get("buyer_id", line_number))
+                if buyer_id in completed_buyer_ids:
+                    continue
+
+                await search_queue.put((buyer_id, HomeMatcher.format_buyer_preferences(profile)))
+
+    def _retrieve_listings(self, buyer_preferences: str) -> List[ListingDocument]:
+        return self.listing_searcher.retrieve_listings(buyer_preferences, self.fetch_k, self.final_k,
+                                                       ListingFilter.from_buyer_preferences(buyer_preferences))
+
+    async def _search_worker(self, search_queue: asyncio.Queue, personalize_queue: asyncio.Queue) -> None:
+        while (item := await search_queue.get()) is not None:
+            buyer_id, buyer_preferences = item
+            try:
+                listings = await asyncio.to_thread(self._retrieve_listings, buyer_preferences)
+
+            except Exception as e:
+                metrics.counter("homematch_errors_total", stage="match_search")
+                print(f"Search failed for buyer {buyer_id}, it will be retried on the next run: {e}")
+                continue
+
+            await personalize_queue.put((buyer_id, buyer_preferences, listings))
+
+    async def _personalize_worker(self, personalize_queue: asyncio.Queue, write_queue: asyncio.Queue) -> None:
+        while (item := await personalize_queue.get()) is not None:
+            buyer_id, buyer_preferences, listings = item
+            try:
+                personalized_listings = await self.listing_personalizer.personalize_listings(buyer_preferences,
+                                                                                             listings)
+
+            except Exception as e:
+                metrics.counter("homematch_errors_total", stage="match_personalization")
+                print(f"Personalization failed for buyer {buyer_id}, it will be retried on the next run: {e}")
+                continue
+
+            await write_queue.put({"buyer_id": buyer_id,
+                                   "listings": [listing.dict() for listing in personalized_listings]})
+
+    @staticmethod
+    async def _format_search_results(results_queue: asyncio.Queue, write_queue: asyncio.Queue) -> None:
+        while (item := await results_queue.get()) is not None:
+            buyer_id, buyer_preferences, listings = item
+            await write_queue.put({"buyer_id": buyer_id, "preferences": buyer_preferences,
+                                   "listings": [listing._asdict() for listing in listings]})
+
+    @staticmethod
+    async def _run_with_writer(run_workers: Awaitable[None], writer_task: asyncio.Task,
+                               worker_tasks: List[asyncio.Task]) -> int:
+        """
+        Runs the workers feeding writer_task and returns the number of results it wrote.
+        If either side fails, e.g. the writer on a full disk, the other is cancelled and the error raised, instead of
+        the workers blocking forever on the full write queue.
+        """
+        workers_task = asyncio.ensure_future(run_workers)
+        await asyncio.wait([workers_task, writer_task], return_when=asyncio.FIRST_EXCEPTION)
+        if workers_task.done() and writer_task.done() and workers_task.exception() is None:
+            return writer_task.result()
+
+        tasks = [workers_task, writer_task] + worker_tasks
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for task in (writer_task, workers_task):
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+
+        raise RuntimeError("The batch was cancelled")
+
+    @staticmethod
+    async def _write_matches(write_queue: asyncio.Queue, output_path: str,
+                             counter_name: str = "homematch_matched_buyers_total") -> int:
+        written_buyers_count = 0
+        with open(output_path, "a") as f:
+            # A crash may have left a partial last line, start the appended results on a fresh line
+            if f.tell() > 0:
+                with open(output_path, "rb") as existing_file:
+                    existing_file.seek(-1, os.SEEK_END)
+                    if existing_file.read(1) != b"\n":
+                        f.write("\n")
+
+            while (buyer_matches := await write_queue.get()) is not None:
+                f.write(json.dumps(buyer_matches) + "\n")
+                f.flush()
+                written_buyers_count += 1
+                metrics.counter(counter_name)
+
+        return written_buyers_count
+
+    @staticmethod
+    def _load_completed_buyer_ids(output_path: str) -> Set[str]:
+        completed_buyer_ids = set()
+        if not os.path.exists(output_path):
+            return completed_buyer_ids
+
+        with open(output_path, "r") as f:
+            for line in f:
+                try:
+                    completed_buyer_ids.add(str(json.loads(line)["buyer_id"]))
+
+                except (json.decoder.JSONDecodeError, KeyError):
+                    continue  # A partially written line from a crashed run
+
+        return completed_buyer_ids
+
+    @staticmethod
+    def format_buyer_preferences(profile: dict) -> str:
+        """
+        Builds the preferences text of a profile, given either as a {question: answer} "preferences" mapping
+        or as "answers" to BUYER_QUESTIONS in order.
+        """
+        preferences = profile.get("preferences")
+        if preferences is None:
+            preferences = dict(zip(BUYER_QUESTIONS, profile["answers"]))
+
+        if isinstance(preferences, str):
+            return preferences
+
+        return "\n".join([f"{q}: {a}" for q, a in preferences.items()])
+
+    async def aclose(self) -> None:
+        if self._listing_generator is not None:
+            await self._listing_generator.aclose()
+
+        if self._listing_personalizer is not None:
+            await self._listing_personalizer.gen_ai_caller.aclose()
+
+        if self._personalization_store is not None:
+            self._personalization_store.close()
+
+        # The worker processes of the shared CPU pool, in a thread since the shutdown waits for them to exit.
+        # The pool starts new ones if it is used again
+        await asyncio.to_thread(get_cpu_pool().close)
 
     @staticmethod
     def load_matches() -> List[dict]:
@@ -47,16 +484,212 @@ class HomeMatcher:
         return matches
 
 
+# The stage each command runs, a command only imports the modules of its own stage
+COMMANDS = {
+    "generate": "Generate listings with the LLM and store them in the db",
+    "ingest": "Store the listings of a JSON file in the db, without calling the LLM",
+    "search": "Retrieve the listings matching buyer preferences from the db",
+    "personalize": "Personalize the listings found by search with the LLM",
+    "precompute": "Cluster buyer profiles and store their personalized listings for reuse, an off-peak job",
+    "match": "Generate, search and personalize in one run, the default command",
+}
+LLM_COMMANDS = ("generate", "personalize", "precompute", "match")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    argv = sys.argv[1:] if argv is None else argv
+    # Without a command the arguments are those of match, so 'home_matcher.py OPENAI_API_KEY --stream' still works
+    if not argv or argv[0] not in [*COMMANDS, "-h", "--help"]:
+        argv = ["match", *argv]
+
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument("api_key", nargs="?", default=os.getenv("OPENAI_API_KEY"),
+                               help="OpenAI API key, defaults to the OPENAI_API_KEY environment variable")
+    common_parser.add_argument("--base-url", default=os.getenv(OPENAI_BASE_URL_ENV_VAR),
+                               help="OpenAI-compatible API base URL, e.g. the mock server of scripts/benchmarks")
+    common_parser.add_argument("--metrics-sinks", default=METRICS_SINKS,
+                               help="Comma separated metrics sinks: logging, trace (a Chrome trace JSON file) and "
+                                    "prometheus (a /metrics endpoint and a text file), "
+                                    "defaults to HOMEMATCH_METRICS_SINKS")
+
+    store_parser = argparse.ArgumentParser(add_help=False)
+    store_parser.add_argument("--embedding-backend", choices=sorted(EMBEDDING_BACKENDS),
+                              help="Embedding backend for ingestion and search, "
+                                   "defaults to HOMEMATCH_EMBEDDING_BACKEND")
+    store_parser.add_argument("--vector-store", choices=sorted(VECTOR_STORES), default=VECTOR_STORE_BACKEND,
+                              help="chroma, or numpy for an in-process memory-mapped index, "
+                                   "defaults to HOMEMATCH_VECTOR_STORE")
+
+    generation_parser = argparse.ArgumentParser(add_help=False)
+    generation_parser.add_argument("--num-listings", type=int, default=LISTINGS_COUNT,
+                                   help="Number of listings to generate, requested from the model in concurrent "
+                                        "shards")
+
+    retrieval_parser = argparse.ArgumentParser(add_help=False)
+    retrieval_parser.add_argument("--fetch-k", type=int, default=RETRIEVAL_FETCH_K,
+                                  help="Number of candidate listings searched and reranked for each buyer")
+    retrieval_parser.add_argument("--final-k", type=int, default=RETRIEVAL_FINAL_K,
+                                  help="Number of reranked listings personalized for each buyer")
+
+    personalization_parser = argparse.ArgumentParser(add_help=False)
+    personalization_parser.add_argument("--concurrency", type=int, default=MAX_WORKERS,
+                                        help="Number of buyers searched and personalized concurrently")
+    personalization_parser.add_argument("--batched-personalization", action="store_true",
+                                        help="Personalize several listings of a buyer in one LLM request")
+    personalization_parser.add_argument("--personalization-store", default=PERSONALIZATION_STORE_PATH,
+                                        help="SQLite store of the descriptions precomputed by precompute, checked "
+                                             "before calling the LLM, an empty value disables it, "
+                                             "defaults to HOMEMATCH_PERSONALIZATION_STORE")
+
+    parser = argparse.ArgumentParser(description="Match buyers with personalized home listings")
+    subparsers = parser.add_subparsers(dest="command", metavar="{" + ",".join(COMMANDS) + "}")
+    subparsers.add_parser("generate", help=COMMANDS["generate"], parents=[common_parser, store_parser,
+                                                                          generation_parser])
+
+    ingest_parser = subparsers.add_parser("ingest", help=COMMANDS["ingest"], parents=[common_parser, store_parser])
+    ingest_parser.add_argument("--listings", default="resources/listings.json",
+                               help="JSON file of listings, as saved by generate")
+
+    search_parser = subparsers.add_parser("search", help=COMMANDS["search"],
+                                          parents=[common_parser, store_parser, retrieval_parser])
+    search_parser.add_argument("--preferences", default=BUYER_PREFERENCES_STR,
+                               help="Buyer preferences to search for, the results are printed as a JSON line")
+    search_parser.add_argument("--profiles", help="JSONL file of buyer profiles to search in batch mode")
+    search_parser.add_argument("--output", default=SEARCH_RESULTS_PATH,
+                               help="JSONL output file of batch mode, the input of personalize")
+    search_parser.add_argument("--concurrency", type=int, default=MAX_WORKERS,
+                               help="Number of buyers searched concurrently")
+
+    personalize_parser = subparsers.add_parser("personalize", help=COMMANDS["personalize"],
+                                               parents=[common_parser, personalization_parser])
+    personalize_parser.add_argument("--search-results", default=SEARCH_RESULTS_PATH,
+                                    help="JSONL file written by search in batch mode")
+    personalize_parser.add_argument("--output", default=BATCH_MATCHES_PATH, help="JSONL output file")
+
+    precompute_parser = subparsers.add_parser("precompute", help=COMMANDS["precompute"],
+                                              parents=[common_parser, store_parser, retrieval_parser,
+                                                       personalization_parser])
+    precompute_parser.add_argument("--profiles", required=True, help="JSONL file of buyer profiles to cluster")
+    precompute_parser.add_argument("--max-clusters", type=int, default=PRECOMPUTE_MAX_CLUSTERS,
+                                   help="Number of the largest clusters whose personalized listings are stored")
+
+    match_parser = subparsers.add_parser("match", help=COMMANDS["match"],
+                                         parents=[common_parser, store_parser, generation_parser, retrieval_parser,
+                                                  personalization_parser])
+    match_parser.add_argument("--profiles", help="JSONL file of buyer profiles to match in batch mode")
+    match_parser.add_argument("--output",
+                              help=f"JSONL output file, defaults to {BATCH_MATCHES_PATH} in batch mode "
+                                   f"and {STREAM_MATCHES_PATH} in stream mode")
+    match_parser.add_argument("--stream", action="store_true",
+                              help="Print each personalized listing as a JSONL line as soon as it is ready")
+    match_parser.add_argument("--stream-tokens", action="store_true",
+                              help="In stream mode, also print the partial descriptions while they are generated")
+    match_parser.add_argument("--skip-generation", action="store_true",
+                              help="Match against the listings already stored in the db (always the case when "
+                                   "resuming a batch)")
+    return parser.parse_args(argv)
+
+
+def print_token_event(index: int, token: str) -> None:
+    print(json.dumps({"event": "token", "index": index, "text": token}), flush=True)
+
+
+def print_reset_event(index: int) -> None:
+    print(json.dumps({"event": "reset", "index": index}), flush=True)
+
+
+def create_home_matcher(args: argparse.Namespace) -> HomeMatcher:
+    # The options of the stages a command does not run are absent from its arguments
+    return HomeMatcher(api_key=args.api_key, concurrency=getattr(args, "concurrency", MAX_WORKERS),
+                       embedding_backend=getattr(args, "embedding_backend", None),
+                       num_listings=getattr(args, "num_listings", LISTINGS_COUNT),
+                       batched_personalization=getattr(args, "batched_personalization", False),
+                       vector_store=getattr(args, "vector_store", VECTOR_STORE_BACKEND),
+                       fetch_k=getattr(args, "fetch_k", RETRIEVAL_FETCH_K),
+                       final_k=getattr(args, "final_k", RETRIEVAL_FINAL_K),
+                       personalization_store_path=getattr(args, "personalization_store", PERSONALIZATION_STORE_PATH))
+
+
+def needs_api_key(args: argparse.Namespace) -> bool:
+    # Searching and ingesting with a local embedding backend never call the API
+    return args.command in LLM_COMMANDS or (getattr(args, "embedding_backend", None) or EMBEDDING_BACKEND) == "openai"
+
+
+async def run_generate(home_matcher: HomeMatcher, args: argparse.Namespace) -> None:
+    await home_matcher.generate()
+
+
+async def run_ingest(home_matcher: HomeMatcher, args: argparse.Namespace) -> None:
+    await home_matcher.ingest(args.listings)
+
+
+async def run_search(home_matcher: HomeMatcher, args: argparse.Namespace) -> None:
+    if args.profiles:
+        await home_matcher.search_batch(args.profiles, args.output)
+
+    else:
+        listings = home_matcher.search(args.preferences)
+        print(json.dumps({"preferences": args.preferences, "listings": [listing._asdict() for listing in listings]}))
+
+
+async def run_personalize(home_matcher: HomeMatcher, args: argparse.Namespace) -> None:
+    await home_matcher.personalize_batch(args.search_results, args.output)
+
+
+async def run_precompute(home_matcher: HomeMatcher, args: argparse.Namespace) -> None:
+    await home_matcher.precompute_personalizations(args.profiles, args.max_clusters)
+
+
+async def run_match(home_matcher: HomeMatcher, args: argparse.Namespace) -> None:
+    if args.profiles:
+        await home_matcher.match_batch(args.profiles, args.output or BATCH_MATCHES_PATH,
+                                       generate_listings=not args.skip_generation)
+
+    elif args.stream:
+        on_token = print_token_event if args.stream_tokens else None
+        on_reset = print_reset_event if args.stream_tokens else None
+        async for listing_json in home_matcher.match_stream(output_path=args.output or STREAM_MATCHES_PATH,
+                                                            on_token=on_token,
+                                                            generate_listings=not args.skip_generation,
+                                                            on_reset=on_reset):
+            print(json.dumps({"event": "listing", "listing": listing_json}), flush=True)
+
+    else:
+        results = await home_matcher.match()
+        print(results)
+
+
+COMMAND_RUNNERS = {
+    "generate": run_generate,
+    "ingest": run_ingest,
+    "search": run_search,
+    "personalize": run_personalize,
+    "precompute": run_precompute,
+    "match": run_match,
+}
+
+
 async def main():
-    if len(sys.argv) != 2 and not os.getenv("OPENAI_API_KEY"):
-        print(
-            "Usage in CLI: 'python scripts/home_matcher.py OPENAI_API_KEY' or set OPENAI_API_KEY environment variable.")
+    args = parse_args()
+    if needs_api_key(args) and not args.api_key:
+        print(f"Usage in CLI: 'python scripts/home_matcher.py {args.command} OPENAI_API_KEY' "
+              f"or set OPENAI_API_KEY environment variable.")
         sys.exit(1)
 
-    openai_api_key = sys.argv[1] if len(sys.argv) == 2 else os.getenv("OPENAI_API_KEY")
-    home_matcher = HomeMatcher(api_key=openai_api_key)
-    results = await home_matcher.match()
-    print(results)
+    if args.api_key:
+        os.environ["OPENAI_API_KEY"] = args.api_key
+
+    configure_metrics([sink_name.strip() for sink_name in args.metrics_sinks.split(",") if sink_name.strip()])
+    if args.base_url:
+        os.environ[OPENAI_BASE_URL_ENV_VAR] = args.base_url
+
+    home_matcher = create_home_matcher(args)
+    try:
+        await COMMAND_RUNNERS[args.command](home_matcher, args)
+
+    finally:
+        await home_matcher.aclose()
+        metrics.close()
 
 
 if __name__ == "__main__":
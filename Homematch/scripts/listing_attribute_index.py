@@ -0,0 +1,55 @@
+from typing import List
+
+import numpy as np
+
+from scripts.models import ListingFilter
+
+
+class ListingAttributeIndex:
+    """
+    A columnar in-memory index of the numeric listing attributes.
+    Every attribute is a contiguous NumPy array aligned with the listing ids, so a range filter is a handful of
+    vectorized comparisons instead of a scan over the stored documents. Listings missing an attribute hold NaN
+    in its column and never match a filter on it.
+    """
+    COLUMNS = ("price", "bedrooms", "bathrooms", "house_size")
+    FILTER_BOUNDS = {
+        "min_bedrooms": ("bedrooms", np.greater_equal),
+        "min_bathrooms": ("bathrooms", np.greater_equal),
+        "min_price": ("price", np.greater_equal),
+        "max_price": ("price", np.less_equal),
+        "min_house_size": ("house_size", np.greater_equal),
+        "max_house_size": ("house_size", np.less_equal),
+    }
+
+    def __init__(self, ids: List[str], columns: dict):
+        self.ids = np.asarray(ids, dtype=object)
+        self.columns = columns
+
+    @classmethod
+    def from_metadatas(cls, ids: List[str], metadatas: List[dict]) -> "ListingAttributeIndex":
+        columns = {
+            column: np.array([np.nan if not metadata or metadata.get(column) is None else metadata[column]
+                              for metadata in metadatas], dtype=np.float64)
+            for column in cls.COLUMNS
+        }
+        return cls(ids, columns)
+
+    def mask(self, listing_filter: ListingFilter) -> np.ndarray:
+        mask = np.ones(len(self.ids), dtype=bool)
+        for field_name, (column, compare) in self.FILTER_BOUNDS.items():
+            bound = getattr(listing_filter, field_name)
+            if bound is not None:
+                # NaN compares False, so listings without the attribute are filtered out
+                mask &= compare(self.columns[column], bound)
+
+        return mask
+
+    def filter_ids(self, listing_filter: ListingFilter) -> List[str]:
+        return self.ids[self.mask(listing_filter)].tolist()
+
+    def count(self, listing_filter: ListingFilter) -> int:
+        return int(np.count_nonzero(self.mask(listing_filter)))
+
+    def __len__(self) -> int:
+        return len(self.ids)
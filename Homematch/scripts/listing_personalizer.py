@@ -1,16 +1,23 @@
 import asyncio
 import json
-from typing import List
+from typing import AsyncIterator, Callable, List, Optional, Tuple
 
 from langchain.output_parsers import PydanticOutputParser
-from langchain.schema import Document
 from pydantic import ValidationError
 
 from scripts.call_gen_ai_langchain import GenAICaller
-from scripts.db_semantic_searcher import ListingSearcher
-from scripts.models import HouseListing, ListingConverter, AugmentedDescription
+from scripts.models import HouseListing, ListingConverter, AugmentedDescription, AugmentedDescriptions, \
+    ListingDocument
+from scripts.personalization_store import PersonalizationStore
 from scripts.resources.consts import BUYER_PREFERENCES_STR, \
-    BUYER_PERSONALIZATION_PROMPT, BUYER_PERSONALIZATION_SYSTEM_PROMPT, BUYER_PERSONALIZATION_FEW_SHOT_EXAMPLES
+    BUYER_PERSONALIZATION_PROMPT, BUYER_PERSONALIZATION_SYSTEM_PROMPT, BUYER_PERSONALIZATION_FEW_SHOT_EXAMPLES, \
+    MAX_WORKERS, PERSONALIZATION_TIMEOUT_SECONDS, PERSONALIZATION_MAX_RETRIES, PERSONALIZATION_MAX_BATCH_SIZE, \
+    PERSONALIZATION_OUTPUT_TOKENS_RATIO, BUYER_BATCH_PERSONALIZATION_PROMPT, BUYER_BATCH_PERSONALIZATION_FEW_SHOT_EXAMPLES, \
+    MAX_OUTPUT_TOKENS_AMOUNT, EXTRA_SECURITY_GAP
+from scripts.utils.json_stream import JsonStringFieldStreamParser
+from scripts.utils.metrics import metrics
+from scripts.utils.rate_limiter import ApiErrors
+from scripts.utils.utils import Utils
 
 
 class ListingPersonalizer:
@@ -29,67 +36,312 @@ class ListingPersonalizer:
 
     Phases:
     1. It then retrieves the top listings that match the buyer’s preferences from db_semantic_searcher.py.
-    2. For each listing, it augments the description using the LLM.
+    2. For each listing, it augments the description using the LLM. The listings are augmented concurrently,
+       bounded by the max_workers slots of its GenAICaller, with a per-call timeout and jittered exponential
+       backoff retries. When a call fails with an error that is not retried, the other calls are cancelled.
+       In batched mode several listings of the buyer are augmented by a single call, sized to the token budget.
+       Listings with a description precomputed for the buyer's cluster in the personalization store are not
+       sent to the LLM at all (see personalization_store.py).
 
     """
 
-    def __init__(self, db_path="resources/listings.db"):
-        self.listing_searcher = ListingSearcher(db_path=db_path)
-        self.gen_ai_caller = GenAICaller()
+    def __init__(self, db_path="resources/listings.db",
+                 max_workers: int = MAX_WORKERS,
+                 timeout: float = PERSONALIZATION_TIMEOUT_SECONDS,
+                 max_retries: int = PERSONALIZATION_MAX_RETRIES,
+                 batched: bool = False,
+                 max_batch_size: int = PERSONALIZATION_MAX_BATCH_SIZE,
+                 personalization_store: Optional[PersonalizationStore] = None):
+        self.db_path = db_path
+        self.gen_ai_caller = GenAICaller(max_in_flight_requests=max_workers)
         self.listing_converter = ListingConverter()
+        self.augmented_description_parser = PydanticOutputParser(pydantic_object=AugmentedDescription)
+        self.augmented_descriptions_parser = PydanticOutputParser(pydantic_object=AugmentedDescriptions)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.batched = batched
+        self.max_batch_size = max_batch_size
+        self.personalization_store = personalization_store
 
-    async def personalize_listings(self, buyer_preferences: str, listings: List[Document]) -> List[HouseListing]:
-        listings = [self.listing_converter.convert_text_to_houselisting(listing) for listing in listings]
+    async def personalize_listings(self, buyer_preferences: str, listings: List[ListingDocument],
+                                   use_personalization_store: bool = True) -> List[HouseListing]:
+        documents = listings
+        listings = [self.listing_converter.convert_text_to_houselisting(listing) for listing in documents]
+        precomputed_listings, pending_listings = self._apply_precomputed_descriptions(
+            buyer_preferences, documents, listings) if use_personalization_store else ([], listings)
         print("Creating personalized listings...")
-        for listing in listings:
-            buyer_personalization_prompt = BUYER_PERSONALIZATION_PROMPT.format(buyer_preferences=buyer_preferences,
-                                                                               listing_description=listing.description)
-            augmented_description = await self.gen_ai_caller.call_gen_ai(
-                system_prompt=BUYER_PERSONALIZATION_SYSTEM_PROMPT,
-                prompt=buyer_personalization_prompt,
-                few_shot_examples=BUYER_PERSONALIZATION_FEW_SHOT_EXAMPLES,
-                parser=PydanticOutputParser(pydantic_object=AugmentedDescription)
-            )
-            augmented_description, max_retries, retries = await self._retry_call_until_success(augmented_description,
-                                                                                               buyer_personalization_prompt)
-
-            if retries >= max_retries:
-                print("Max retries reached, proceeding without augmented description")
-                listing.augmented_description = listing.description
+        with metrics.span("personalization", listings=len(listings), precomputed=len(precomputed_listings),
+                          batched=self.batched):
+            if self.batched:
+                await Utils.gather_or_cancel(*(self._personalize_batch(buyer_preferences, batch)
+                                               for batch in self._split_into_batches(pending_listings)))
 
             else:
-                listing.augmented_description = augmented_description.get("Augmented Description", "")
+                await Utils.gather_or_cancel(*(self._personalize_listing(buyer_preferences, listing)
+                                               for listing in pending_listings))
 
+        # Personalized in place, in the order of the search
         return listings
 
-    async def _retry_call_until_success(self, augmented_description, buyer_personalization_prompt):
-        augmented_description = None
-        retries = 0
-        max_retries = 5
-        while (
-                augmented_description is None or "Augmented Description" not in augmented_description) and retries < max_retries:
-            try:
-                augmented_description = await self.gen_ai_caller.call_gen_ai(
+    async def personalize_listings_stream(self, buyer_preferences: str, listings: List[ListingDocument],
+                                          on_token: Optional[Callable[[int, str], None]] = None,
+                                          on_reset: Optional[Callable[[int], None]] = None
+                                          ) -> AsyncIterator[HouseListing]:
+        """
+        Yields every personalized listing as soon as it is done instead of waiting for the slowest one.
+        If on_token is given, the responses are streamed and on_token(listing index, text chunk) is called with
+        the augmented description as it arrives, without the JSON around it (not available in batched mode).
+        When a streamed call fails after some text was sent, on_reset(listing index) is called before the listing
+        is personalized again, so the partial text can be discarded.
+        """
+        documents = listings
+        listings = [self.listing_converter.convert_text_to_houselisting(listing) for listing in documents]
+        precomputed_listings, pending_listings = self._apply_precomputed_descriptions(buyer_preferences, documents,
+                                                                                      listings)
+        print("Creating personalized listings...")
+        if self.batched:
+            tasks = [asyncio.create_task(self._personalize_batch(buyer_preferences, batch))
+                     for batch in self._split_into_batches(pending_listings)]
+
+        elif on_token is not None:
+            # The listings keep the index of their search result
+            tasks = [asyncio.create_task(self._stream_personalize_listing(buyer_preferences, index, listing, on_token,
+                                                                          on_reset))
+                     for index, listing in enumerate(listings) if listing.augmented_description is None]
+
+        else:
+            tasks = [asyncio.create_task(self._personalize_listing(buyer_preferences, listing))
+                     for listing in pending_listings]
+
+        try:
+            for listing in precomputed_listings:
+                yield listing
+
+            for task in asyncio.as_completed(tasks):
+                personalized = await task
+                for listing in personalized if isinstance(personalized, list) else [personalized]:
+                    yield listing
+
+        finally:
+            # The consumer may stop early, do not leave calls running in the background
+            for task in tasks:
+                task.cancel()
+
+    def _apply_precomputed_descriptions(self, buyer_preferences: str, documents: List[ListingDocument],
+                                        listings: List[HouseListing]
+                                        ) -> Tuple[List[HouseListing], List[HouseListing]]:
+        # Returns the listings given the description precomputed for the buyer's cluster, and those left to the LLM
+        if self.personalization_store is None:
+            return [], listings
+
+        cluster_id = self.personalization_store.find_cluster(buyer_preferences)
+        precomputed_listings, pending_listings = [], []
+        for document, listing in zip(documents, listings):
+            augmented_description = None
+            if cluster_id is not None:
+                augmented_description = self.personalization_store.get(cluster_id, self.get_listing_id(document))
+
+            metrics.counter("homematch_personalization_store_requests_total",
+                            result="hit" if augmented_description is not None else "miss")
+            if augmented_description is None:
+                pending_listings.append(listing)
+                continue
+
+            listing.augmented_description = augmented_description
+            precomputed_listings.append(listing)
+
+        return precomputed_listings, pending_listings
+
+    @staticmethod
+    def get_listing_id(document: ListingDocument) -> str:
+        # The id the listing is stored with, a hash of its text
+        return document.metadata.get("content_hash") or ListingConverter.get_listing_id(document.page_content)
+
+    async def _stream_personalize_listing(self, buyer_preferences: str, index: int, listing: HouseListing,
+                                          on_token: Callable[[int, str], None],
+                                          on_reset: Optional[Callable[[int], None]] = None) -> HouseListing:
+        buyer_personalization_prompt = BUYER_PERSONALIZATION_PROMPT.format(buyer_preferences=buyer_preferences,
+                                                                           listing_description=listing.description)
+        description_stream = JsonStringFieldStreamParser("Augmented Description")
+        try:
+            with metrics.span("personalization.listing_stream", index=index):
+                response = await self._stream_response(buyer_personalization_prompt, index, on_token,
+                                                       description_stream)
+
+            parsed_response = await self.gen_ai_caller.aparse_gen_ai_response(response)
+            augmented_description = parsed_response.get("Augmented Description")
+            if augmented_description:
+                listing.augmented_description = augmented_description
+                return listing
+
+            print("Streamed response is missing the augmented description")
+
+        except asyncio.TimeoutError:
+            metrics.counter("homematch_timeouts_total", stage="personalization")
+            print(f"Streamed personalization call timed out after {self.timeout}s")
+
+        except Exception as e:
+            if not ApiErrors.is_retryable(e):
+                raise
+
+            print(f"Streamed personalization call failed: {e}")
+
+        # Fall back to the regular calls and their retries, the client drops the partial text it received
+        metrics.counter("homematch_fallbacks_total", stage="personalization_stream")
+        if description_stream.decoded_length and on_reset is not None:
+            on_reset(index)
+
+        return await self._personalize_listing(buyer_preferences, listing)
+
+    async def _stream_response(self, buyer_personalization_prompt: str, index: int,
+                               on_token: Callable[[int, str], None],
+                               description_stream: JsonStringFieldStreamParser) -> str:
+        chunks = []
+        async for chunk in self.gen_ai_caller.stream_gen_ai(system_prompt=BUYER_PERSONALIZATION_SYSTEM_PROMPT,
+                                                            prompt=buyer_personalization_prompt,
+                                                            few_shot_examples=BUYER_PERSONALIZATION_FEW_SHOT_EXAMPLES,
+                                                            parser=self.augmented_description_parser,
+                                                            timeout=self.timeout):
+            chunks.append(chunk)
+            text = description_stream.feed(chunk)
+            if text:
+                on_token(index, text)
+
+        return "".join(chunks)
+
+    def _split_into_batches(self, listings: List[HouseListing]) -> List[List[HouseListing]]:
+        # Pack listings while their estimated augmented descriptions fit in one response
+        output_budget = MAX_OUTPUT_TOKENS_AMOUNT - EXTRA_SECURITY_GAP
+        batches, batch, batch_tokens = [], [], 0
+        for listing in listings:
+            listing_tokens = int(self.gen_ai_caller.prompt_builder.count_tokens(listing.description) *
+                                 PERSONALIZATION_OUTPUT_TOKENS_RATIO)
+            if batch and (len(batch) >= self.max_batch_size or batch_tokens + listing_tokens > output_budget):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+
+            batch.append(listing)
+            batch_tokens += listing_tokens
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    async def _personalize_batch(self, buyer_preferences: str, batch: List[HouseListing]) -> List[HouseListing]:
+        """
+        Personalizes several listings of the same buyer in one request, so the system prompt and the few-shot
+        examples are sent once. Listings missing from the reply are personalized on their own.
+        """
+        if len(batch) == 1:
+            return [await self._personalize_listing(buyer_preferences, batch[0])]
+
+        listings_by_key = {f"listing_{index + 1}": listing for index, listing in enumerate(batch)}
+        buyer_personalization_prompt = BUYER_BATCH_PERSONALIZATION_PROMPT.format(
+            buyer_preferences=buyer_preferences,
+            listings_descriptions=json.dumps({key: listing.description for key, listing in listings_by_key.items()},
+                                             indent=4)
+        )
+        augmented_descriptions = {}
+        try:
+            with metrics.span("personalization.batch", listings=len(batch)):
+                response = await self.gen_ai_caller.call_gen_ai(
                     system_prompt=BUYER_PERSONALIZATION_SYSTEM_PROMPT,
                     prompt=buyer_personalization_prompt,
-                    few_shot_examples=BUYER_PERSONALIZATION_FEW_SHOT_EXAMPLES,
-                    parser=PydanticOutputParser(pydantic_object=AugmentedDescription)
+                    few_shot_examples=BUYER_BATCH_PERSONALIZATION_FEW_SHOT_EXAMPLES,
+                    parser=self.augmented_descriptions_parser,
+                    timeout=self.timeout
                 )
+
+            augmented_descriptions = AugmentedDescriptions(**response).augmented_descriptions
+
+        except asyncio.TimeoutError:
+            metrics.counter("homematch_timeouts_total", stage="personalization")
+            print(f"Batched personalization call timed out after {self.timeout}s")
+
+        except ValidationError as e:
+            print(f"Error parsing batched response: {e}")
+
+        except Exception as e:
+            if not ApiErrors.is_retryable(e):
+                raise
+
+            print(f"Batched personalization call failed: {e}")
+
+        missing_listings = []
+        for key, listing in listings_by_key.items():
+            if augmented_descriptions.get(key):
+                listing.augmented_description = augmented_descriptions[key]
+
+            else:
+                missing_listings.append(listing)
+
+        if missing_listings:
+            metrics.counter("homematch_fallbacks_total", len(missing_listings), stage="personalization_batch")
+            print(f"{len(missing_listings)} listings are missing from the batched reply, personalizing them one by one")
+            await Utils.gather_or_cancel(*(self._personalize_listing(buyer_preferences, listing)
+                                           for listing in missing_listings))
+
+        return batch
+
+    async def _personalize_listing(self, buyer_preferences: str, listing: HouseListing) -> HouseListing:
+        buyer_personalization_prompt = BUYER_PERSONALIZATION_PROMPT.format(buyer_preferences=buyer_preferences,
+                                                                           listing_description=listing.description)
+        augmented_description = await self._retry_call_until_success(buyer_personalization_prompt)
+        if augmented_description is None:
+            metrics.counter("homematch_errors_total", stage="personalization")
+            print("Max retries reached, proceeding without augmented description")
+            listing.augmented_description = listing.description
+
+        else:
+            listing.augmented_description = augmented_description
+
+        return listing
+
+    async def _retry_call_until_success(self, buyer_personalization_prompt: str) -> Optional[str]:
+        for attempt in range(self.max_retries):
+            try:
+                with metrics.span("personalization.listing", attempt=attempt):
+                    augmented_description = await self.gen_ai_caller.call_gen_ai(
+                        system_prompt=BUYER_PERSONALIZATION_SYSTEM_PROMPT,
+                        prompt=buyer_personalization_prompt,
+                        few_shot_examples=BUYER_PERSONALIZATION_FEW_SHOT_EXAMPLES,
+                        parser=self.augmented_description_parser,
+                        bypass_cache=attempt > 0,  # A cached reply is what failed, ask the model again
+                        timeout=self.timeout
+                    )
+
+                if "Augmented Description" in augmented_description:
+                    return augmented_description["Augmented Description"]
+
+                print("Response is missing the augmented description")
+
+            except asyncio.TimeoutError:
+                metrics.counter("homematch_timeouts_total", stage="personalization")
+                print(f"Personalization call timed out after {self.timeout}s")
+
             except ValidationError as e:
                 print(f"Error parsing response: {e}")
 
             except Exception as e:
-                print(f"Unexpected error: {e}")
+                # Only transient API errors are worth another attempt, anything else (a bad request, an open
+                # circuit, a bug) is raised instead of being retried into the same failure
+                if not ApiErrors.is_retryable(e):
+                    raise
 
-            retries += 1
+                print(f"Personalization call failed, retrying: {e}")
 
-            # Sleep for a short period before retrying to avoid too many rapid retries
-            await asyncio.sleep(1)
+            if attempt < self.max_retries - 1:
+                metrics.counter("homematch_retries_total", stage="personalization")
+                # The caller's slot is released while backing off, so other listings can use it meanwhile
+                await asyncio.sleep(Utils.get_backoff_delay(attempt))
 
-        return augmented_description, max_retries, retries
+        return None
 
 
 if __name__ == "__main__":
+    from scripts.db_semantic_searcher import ListingSearcher
+
     listing_personalizer = ListingPersonalizer()
     listing_searcher = ListingSearcher()
     listings = listing_searcher.search_listings(BUYER_PREFERENCES_STR)
@@ -0,0 +1,109 @@
+from typing import List, Optional
+
+import numpy as np
+
+from scripts.bm25_index import tokenize
+from scripts.embeddings import encode_hashed_batch
+from scripts.listing_attribute_index import ListingAttributeIndex
+from scripts.models import ListingDocument, ListingFilter
+from scripts.resources.consts import RERANK_RETRIEVAL_WEIGHT, RERANK_ATTRIBUTE_WEIGHT, RERANK_KEYWORD_WEIGHT, \
+    RERANK_MMR_LAMBDA, RERANK_SIMILARITY_DIMENSIONS
+from scripts.utils.metrics import metrics
+
+
+class ListingReranker:
+    """
+    Reranks the candidates of a search locally, without any API call, and keeps the final_k best.
+    The relevance of a candidate mixes its retrieval rank, how well its attributes fit the requirements parsed from
+    the buyer preferences, and the share of the preference keywords its text contains.
+    The final set is picked by maximal marginal relevance (MMR): every pick trades relevance against the similarity
+    to the listings already picked, so near-duplicate listings are not all personalized.
+    """
+
+    def __init__(self, retrieval_weight: float = RERANK_RETRIEVAL_WEIGHT,
+                 attribute_weight: float = RERANK_ATTRIBUTE_WEIGHT, keyword_weight: float = RERANK_KEYWORD_WEIGHT,
+                 mmr_lambda: float = RERANK_MMR_LAMBDA, similarity_dimensions: int = RERANK_SIMILARITY_DIMENSIONS):
+        self.retrieval_weight = retrieval_weight
+        self.attribute_weight = attribute_weight
+        self.keyword_weight = keyword_weight
+        self.mmr_lambda = mmr_lambda
+        self.similarity_dimensions = similarity_dimensions
+
+    def rerank(self, buyer_preferences: str, candidates: List[ListingDocument], final_k: int,
+               listing_filter: Optional[ListingFilter] = None) -> List[ListingDocument]:
+        """
+        Returns the final_k candidates to personalize, best first. The candidates are expected in retrieval order.
+        The listing_filter defaults to the requirements parsed from the buyer preferences.
+        """
+        if len(candidates) <= 1 or final_k <= 0:
+            return candidates[:max(final_k, 0)]
+
+        with metrics.span("rerank", candidates=len(candidates), final_k=final_k):
+            if listing_filter is None:
+                listing_filter = ListingFilter.from_buyer_preferences(buyer_preferences)
+
+            relevance = self.get_relevance(buyer_preferences, candidates, listing_filter)
+            # Local hashed embeddings of the listing texts, only used to compare candidates with each other
+            vectors = encode_hashed_batch([candidate.page_content for candidate in candidates],
+                                          self.similarity_dimensions)
+            selected = self._select_by_mmr(relevance, vectors @ vectors.T, final_k)
+
+        metrics.counter("homematch_reranked_listings_total", len(candidates) - len(selected), result="dropped")
+        return [candidates[index] for index in selected]
+
+    def get_relevance(self, buyer_preferences: str, candidates: List[ListingDocument],
+                      listing_filter: ListingFilter) -> np.ndarray:
+        retrieval_scores = 1 - np.arange(len(candidates)) / len(candidates)
+        attribute_scores = np.array([self._get_attribute_fit(candidate.metadata, listing_filter)
+                                     for candidate in candidates])
+        preference_tokens = set(tokenize(buyer_preferences))
+        keyword_scores = np.array([len(preference_tokens.intersection(tokenize(candidate.page_content))) /
+                                   max(len(preference_tokens), 1) for candidate in candidates])
+        return (self.retrieval_weight * retrieval_scores + self.attribute_weight * attribute_scores +
+                self.keyword_weight * keyword_scores)
+
+    @staticmethod
+    def _get_attribute_fit(metadata: dict, listing_filter: ListingFilter) -> float:
+        # Graded, since the candidates usually all passed the same filter already: an attribute meeting a one-sided
+        # bound scores 1, however far past it, one within a range 0.5 to 1 by its closeness to the middle of the
+        # range, a missed requirement 0 to 0.5 by the ratio to the bound, an unknown attribute 0
+        bounds_by_column = {}
+        for field_name, (column, compare) in ListingAttributeIndex.FILTER_BOUNDS.items():
+            bound = getattr(listing_filter, field_name)
+            if bound is not None:
+                bounds_by_column.setdefault(column, []).append((bound, compare))
+
+        fits = []
+        for column, bounds in bounds_by_column.items():
+            value = metadata.get(column)
+            if value is None or value <= 0 or any(bound <= 0 for bound, _ in bounds):
+                fits.append(0.0)
+                continue
+
+            missed_bounds = [bound for bound, compare in bounds if not compare(value, bound)]
+            if missed_bounds:
+                fits.append(0.5 * min(min(value, bound) / max(value, bound) for bound in missed_bounds))
+
+            elif len(bounds) == 1:
+                fits.append(1.0)
+
+            else:
+                target = sum(bound for bound, _ in bounds) / len(bounds)
+                fits.append(0.5 + 0.5 * min(value, target) / max(value, target))
+
+        return sum(fits) / len(fits) if fits else 1.0
+
+    def _select_by_mmr(self, relevance: np.ndarray, similarities: np.ndarray, final_k: int) -> List[int]:
+        selected = [int(np.argmax(relevance))]
+        max_similarities = similarities[selected[0]].copy()
+        remaining = np.ones(len(relevance), dtype=bool)
+        remaining[selected[0]] = False
+        while len(selected) < min(final_k, len(relevance)):
+            mmr_scores = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * max_similarities
+            mmr_scores[~remaining] = -np.inf
+            index = int(np.argmax(mmr_scores))
+            selected.append(index)
+            remaining[index] = False
+            np.maximum(max_similarities, similarities[index], out=max_similarities)
+
+        return selected
@@ -5,7 +5,7 @@ from typing import List
 import chromadb
 
 from scripts.call_gen_ai import GenAICaller
-from scripts.models import HouseListing
+from scripts.models import HouseListing, ListingConverter
 from scripts.resources.consts import LISTINGS_SYSTEM_PROMPT, LISTINGS_PROMPT_QUESTION
 
 
@@ -13,7 +13,7 @@ class ListingsGenerator:
     def __init__(self, db_path="resources/listings.db"):
         self.gen_ai_caller = GenAICaller()
         self.chroma_client = chromadb.PersistentClient(path=db_path)
-        self.collection = self.chroma_client.create_collection("listings_embeddings")
+        self.collection = self.chroma_client.get_or_create_collection("listings_embeddings")
 
     async def generate_listings(self):
         gen_ai_response = await self.gen_ai_caller.call_gen_ai(LISTINGS_SYSTEM_PROMPT, LISTINGS_PROMPT_QUESTION)
@@ -26,11 +26,21 @@ class ListingsGenerator:
         await self.store_listings_in_db(gen_ai_response_formatted)
 
     async def store_listings_in_db(self, gen_ai_response: List[HouseListing]):
-        embeddable_listings = []
-        for index, listing in enumerate(gen_ai_response):
+        listings_by_id = {
+            ListingConverter.get_listing_id(ListingConverter.convert_houselisting_to_text(listing)): listing
+            for listing in gen_ai_response
+        }
+        stored_ids = set(self.collection.get(include=[])["ids"])
+        stale_ids = list(stored_ids - listings_by_id.keys())
+        if stale_ids:
+            self.collection.delete(ids=stale_ids)
+
+        for listing_id, listing in listings_by_id.items():
+            if listing_id in stored_ids:
+                continue
+
             temp_embedding = await self.gen_ai_caller.convert_to_embedding(listing)
-            embeddable_listings.append(temp_embedding)
-            self.collection.add(ids=str(index), embeddings=temp_embedding)
+            self.collection.upsert(ids=listing_id, embeddings=temp_embedding)
 
         print(f"Listings stored in ChromaDB")
 
@@ -1,58 +1,237 @@
 import asyncio
 import json
 import os
-from typing import List
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
-from langchain.output_parsers import PydanticOutputParser
-from langchain.vectorstores import Chroma
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain_text_splitters import CharacterTextSplitter
+from scripts.bm25_index import BM25Index
+from scripts.embeddings import get_embedding_backend
+from scripts.models import HouseListing, ListingConverter, ListingRecord
+from scripts.resources import consts
+from scripts.resources.consts import LISTINGS_SYSTEM_PROMPT, LISTINGS_FEW_SHOT_EXAMPLE, LISTINGS_SHARD_PROMPT, \
+    LISTINGS_COUNT, LISTINGS_SHARD_SIZE, MAX_CONCURRENT_SHARDS, LISTINGS_SHARD_MAX_RETRIES, VECTOR_STORE_BACKEND
+from scripts.utils.cpu_pool import CpuPool, get_cpu_pool
+from scripts.utils.json_stream import JsonObjectStreamParser
+from scripts.utils.metrics import metrics
+from scripts.utils.rate_limiter import ApiErrors
+from scripts.utils.utils import Utils
+from scripts.vector_stores import ListingsVectorStore, get_vector_store
 
-from scripts.call_gen_ai_langchain import GenAICaller
-from scripts.models import HouseListing, ListingConverter
-from scripts.resources.consts import LISTINGS_SYSTEM_PROMPT, LISTINGS_PROMPT_QUESTION, LISTINGS_FEW_SHOT_EXAMPLE
+if TYPE_CHECKING:
+    from langchain_core.embeddings import Embeddings
+    from scripts.call_gen_ai_langchain import GenAICaller
 
 
 class ListingsGenerator:
-    def __init__(self, db_path="resources/listings.db"):
+    """
+    Generates the listings corpus with the LLM and stores it in the db.
+    The corpus is split into shards of shard_size listings that are requested concurrently, at most
+    max_concurrent_shards at a time. Each shard response is streamed and every listing is validated as soon as
+    it is complete, and a shard that comes back short or whose stream fails partway keeps the listings it received
+    and is re-requested for its missing listings only.
+    Listings are carried as compact ListingRecords, and the validation and conversion of a large corpus run in the
+    CPU pool (see utils/cpu_pool.py), so the event loop stays free.
+    """
+
+    def __init__(self, db_path="resources/listings.db", embeddings: Optional["Embeddings"] = None,
+                 shard_size: int = LISTINGS_SHARD_SIZE, max_concurrent_shards: int = MAX_CONCURRENT_SHARDS,
+                 max_shard_retries: int = LISTINGS_SHARD_MAX_RETRIES, vector_store: str = VECTOR_STORE_BACKEND,
+                 cpu_pool: Optional[CpuPool] = None):
         self.db_path = db_path
-        self.gen_ai_caller = GenAICaller()
+        self.embeddings = embeddings
+        self.vector_store = vector_store
+        self.shard_size = shard_size
+        self.max_shard_retries = max_shard_retries
+        self.max_concurrent_shards = max_concurrent_shards  # The in-flight requests of the LLM caller
         self.listing_converter = ListingConverter()
+        self.cpu_pool = cpu_pool or get_cpu_pool()
+        # The LLM client and parser import LangChain, they are created on the first generation so ingesting
+        # listings that are already generated does not need them
+        self._gen_ai_caller = None
+        self._listing_parser = None
+
+    @property
+    def gen_ai_caller(self) -> "GenAICaller":
+        if self._gen_ai_caller is None:
+            from scripts.call_gen_ai_langchain import GenAICaller
+            self._gen_ai_caller = GenAICaller(max_in_flight_requests=self.max_concurrent_shards)
+
+        return self._gen_ai_caller
+
+    @property
+    def listing_parser(self):
+        if self._listing_parser is None:
+            from langchain.output_parsers import PydanticOutputParser
+            self._listing_parser = PydanticOutputParser(pydantic_object=HouseListing)
+
+        return self._listing_parser
+
+    async def aclose(self) -> None:
+        if self._gen_ai_caller is not None:
+            await self._gen_ai_caller.aclose()
+
+    async def generate_listings(self, num_listings: int = LISTINGS_COUNT) -> None:
+        print(f"Generating {num_listings} listings...")
+        shard_sizes = [min(self.shard_size, num_listings - start) for start in range(0, num_listings, self.shard_size)]
+        with metrics.span("generation", num_listings=num_listings, shards=len(shard_sizes)) as span:
+            shards = await asyncio.gather(*(self._generate_shard(shard_index, len(shard_sizes), shard_listings_count)
+                                            for shard_index, shard_listings_count in enumerate(shard_sizes)))
+            listings = [listing for shard in shards for listing in shard]
+            span.set_attribute("generated_listings", len(listings))
+
+        metrics.counter("homematch_generated_listings_total", len(listings))
+        print(f"Generated {len(listings)} of {num_listings} listings")
+        if not listings:
+            print("No listings were generated, the stored listings are kept")
+            return
+
+        if len(listings) < num_listings:
+            # A partial corpus is added to the stored one, it must not replace it
+            metrics.counter("homematch_partial_generations_total")
+            print(f"Generation fell short, adding the {len(listings)} listings without removing the stored ones")
+            await self.store_listings_in_db(listings, delete_stale=False)
+            return
 
-    async def generate_listings(self) -> None:
-        print("Generating listings...")
-        gen_ai_response = await self.gen_ai_caller.call_gen_ai(LISTINGS_SYSTEM_PROMPT, LISTINGS_PROMPT_QUESTION,
-                                                               LISTINGS_FEW_SHOT_EXAMPLE,
-                                                               parser=PydanticOutputParser(pydantic_object=HouseListing)
-                                                               )
         print(f"Saving listings to resources/listings.json")
-        # Convert each listing into HouseListing object:
         with open("resources/listings.json", "w") as f:
-            json.dump(gen_ai_response, f, indent=4)
-
-        gen_ai_response_formatted = [HouseListing(**listing) if listing else None for listing in
-                                     gen_ai_response.values()]
-        gen_ai_response_formatted = [listing for listing in gen_ai_response_formatted if listing]
-        await self.store_listings_in_db(gen_ai_response_formatted)
-
-    async def store_listings_in_db(self, gen_ai_response: List[HouseListing]) -> None:
-        embeddings = OpenAIEmbeddings(openai_api_key=os.getenv("OPENAI_API_KEY"))
-        listings_texts = [self.listing_converter.convert_houselisting_to_text(listing) for listing in gen_ai_response]
-        text_splitter = CharacterTextSplitter(
-            separator="Listing",
-            chunk_size=1000,
-            chunk_overlap=0,
-            length_function=len,
-            is_separator_regex=False
-        )
-        docs = text_splitter.create_documents(listings_texts)
-        db = Chroma.from_documents(docs, embeddings, persist_directory=self.db_path,
-                                   collection_name="listings_embeddings")
-        print(f"Listings are stored in ChromaDB path: {self.db_path}")
-        print(f"Count of items in db: {db._collection.count()}")
-        # save db to local disk
-        db.persist()
-        print(f"Listings stored in ChromaDB")
+            json.dump({f"property_{index + 1}": listing.to_listing_data() for index, listing in enumerate(listings)},
+                      f, indent=4)
+
+        await self.store_listings_in_db(listings)
+
+    async def _generate_shard(self, shard_index: int, shards_count: int,
+                              shard_listings_count: int) -> List[ListingRecord]:
+        listings = []
+        for attempt in range(self.max_shard_retries):
+            missing_listings_count = shard_listings_count - len(listings)
+            prompt = (consts.LISTINGS_PROMPT_QUESTION_TEMPLATE.replace("{num_listings}", str(missing_listings_count)) +
+                      LISTINGS_SHARD_PROMPT.format(shard_number=shard_index + 1, shards_count=shards_count))
+            try:
+                with metrics.span("generation.shard", shard=shard_index + 1, attempt=attempt,
+                                  requested_listings=missing_listings_count):
+                    await self._stream_listings(prompt, listings)
+
+            except Exception as e:
+                if not ApiErrors.is_retryable(e):
+                    raise
+
+                metrics.counter("homematch_errors_total", stage="generation")
+                print(f"Shard {shard_index + 1} failed: {e}")
+
+            if len(listings) >= shard_listings_count:
+                return listings[:shard_listings_count]
+
+            if attempt < self.max_shard_retries - 1:
+                metrics.counter("homematch_retries_total", stage="generation")
+                print(f"Shard {shard_index + 1} is missing {shard_listings_count - len(listings)} listings, retrying")
+                await asyncio.sleep(Utils.get_backoff_delay(attempt))
+
+        print(f"Shard {shard_index + 1} produced only {len(listings)} of {shard_listings_count} listings")
+        return listings
+
+    async def _stream_listings(self, prompt: str, listings: List[ListingRecord]) -> None:
+        # Listings are added as they complete, so the ones received before a stream fails are kept
+        json_parser = JsonObjectStreamParser()
+        async for chunk in self.gen_ai_caller.stream_gen_ai(LISTINGS_SYSTEM_PROMPT, prompt, LISTINGS_FEW_SHOT_EXAMPLE,
+                                                            parser=self.listing_parser):
+            # A shard brings a handful of listings per chunk, validated in place as they complete
+            listings.extend(self._keep_valid_listings(self.listing_converter.validate_listings(
+                json_parser.feed(chunk))))
+
+    async def validate_listings(self, listings_data: List[dict]) -> List[ListingRecord]:
+        """
+        Validates listings keyed by the HouseListing aliases, e.g. the values of listings.json, in the CPU pool.
+        Invalid listings are skipped.
+        """
+        with metrics.span("ingestion.validate", num_listings=len(listings_data)):
+            return self._keep_valid_listings(await self.cpu_pool.map_chunks(ListingConverter.validate_listings,
+                                                                            listings_data))
+
+    async def store_listings_in_db(self, gen_ai_response: List[HouseListing | ListingRecord],
+                                   delete_stale: bool = True) -> None:
+        """
+        Upserts the listings by a hash of their text: listings already stored are not embedded again,
+        and stored listings that are no longer part of the corpus are deleted, unless delete_stale is False.
+        An empty corpus never replaces the stored one.
+        The numeric attributes of each listing are stored as metadata for filtered searches,
+        and the BM25 index of the hybrid search is rebuilt next to the db when the corpus changed.
+        """
+        if not gen_ai_response:
+            print("No listings to store, the stored listings are kept")
+            return
+
+        with metrics.span("ingestion", num_listings=len(gen_ai_response)):
+            records = [listing if isinstance(listing, ListingRecord) else ListingRecord.from_houselisting(listing)
+                       for listing in gen_ai_response]
+            with metrics.span("ingestion.convert"):
+                documents = await self.cpu_pool.map_chunks(ListingConverter.convert_records_to_documents, records)
+
+            self._store_listings_in_db(documents, delete_stale)
+
+    @staticmethod
+    def _keep_valid_listings(validated_listings: List[Tuple[Optional[ListingRecord], Optional[str]]]
+                             ) -> List[ListingRecord]:
+        listings = []
+        for listing, error in validated_listings:
+            if listing is None:
+                metrics.counter("homematch_invalid_listings_total")
+                print(f"Skipping invalid listing: {error}")
+                continue
+
+            listings.append(listing)
+
+        return listings
+
+    def _store_listings_in_db(self, documents: List[Tuple[str, str, dict]], delete_stale: bool = True) -> None:
+        listings_by_id = {}
+        for listing_id, listing_text, metadata in documents:
+            listings_by_id[listing_id] = (listing_text, {"content_hash": listing_id, **metadata})
+
+        db = self._load_vector_store()
+        with metrics.span("ingestion.read_stored"):
+            stored_metadatas = db.get_metadatas()
+
+        stale_ids = ([listing_id for listing_id in stored_metadatas if listing_id not in listings_by_id]
+                     if delete_stale else [])
+        if stale_ids:
+            db.delete(stale_ids)
+
+        # Listings stored before their metadata changed only need the metadata rewritten, not a new embedding
+        outdated_ids = [listing_id for listing_id, metadata in stored_metadatas.items()
+                        if listing_id in listings_by_id and metadata != listings_by_id[listing_id][1]]
+        if outdated_ids:
+            db.update_metadatas(outdated_ids, [listings_by_id[listing_id][1] for listing_id in outdated_ids])
+
+        new_ids = [listing_id for listing_id in listings_by_id if listing_id not in stored_metadatas]
+        if new_ids:
+            with metrics.span("ingestion.embed_and_store", new_listings=len(new_ids)):
+                db.add_texts([listings_by_id[listing_id][0] for listing_id in new_ids],
+                             [listings_by_id[listing_id][1] for listing_id in new_ids], new_ids)
+
+        bm25_path = BM25Index.get_path(self.db_path)
+        if new_ids or stale_ids or outdated_ids or not os.path.exists(bm25_path):
+            # The BM25 index covers every stored listing, including the ones kept without delete_stale
+            indexed_listings = dict(listings_by_id)
+            kept_ids = [listing_id for listing_id in stored_metadatas if listing_id not in listings_by_id]
+            if kept_ids:
+                indexed_listings.update({listing_id: (document.page_content, document.metadata) for listing_id, document
+                                         in zip(kept_ids, db.get_documents(kept_ids))})
+
+            with metrics.span("ingestion.bm25_index", listings=len(indexed_listings)):
+                BM25Index.build(list(indexed_listings), [text for text, _ in indexed_listings.values()],
+                                [metadata for _, metadata in indexed_listings.values()]).save(bm25_path)
+
+        metrics.counter("homematch_ingested_listings_total", len(new_ids), result="added")
+        metrics.counter("homematch_ingested_listings_total", len(stale_ids), result="removed")
+        metrics.counter("homematch_ingested_listings_total", len(listings_by_id) - len(new_ids), result="unchanged")
+
+        print(f"Listings are stored in the {db.name} store at: {self.db_path}")
+        print(f"Added {len(new_ids)} listings, removed {len(stale_ids)} stale listings, "
+              f"updated the metadata of {len(outdated_ids)} listings, "
+              f"{len(listings_by_id) - len(new_ids)} were already embedded")
+        print(f"Listings stored in the db")
+
+    def _load_vector_store(self) -> ListingsVectorStore:
+        return get_vector_store(self.db_path, self.embeddings or get_embedding_backend(), self.vector_store)
 
     @staticmethod
     def load_listings() -> List[HouseListing]:
@@ -1,11 +1,32 @@
-from typing import Optional
+from typing import Dict, List, NamedTuple, Optional, Tuple
+import hashlib
 import re
 
-from langchain.schema import Document
-from pydantic import Field, BaseModel
+from pydantic import Field, BaseModel, ValidationError
 from pydantic.v1 import validator
 
 
+BEDROOMS_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*\+?[\s-]*(?:bedrooms?|beds?|br)\b')
+BATHROOMS_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*\+?[\s-]*(?:bathrooms?|baths?|ba)\b')
+MAX_PRICE_PATTERN = re.compile(r'(?:under|below|less than|at most|up to|max(?:imum)?|budget of)\s*\$\s*([\d,.]+)\s*(k|m|million)?\b')
+MIN_PRICE_PATTERN = re.compile(r'(?:over|above|more than|at least|min(?:imum)?)\s*\$\s*([\d,.]+)\s*(k|m|million)?\b')
+HOUSE_SIZE_PATTERN = re.compile(r'(under|below|less than|at most|up to)?\s*([\d,]+)\s*(?:sq\.?\s*ft|sqft|square feet)')
+AMOUNT_PATTERN = re.compile(r'\d[\d,]*(?:\.\d+)?')
+AMOUNT_UNITS = {"k": 1000, "m": 1000000, "million": 1000000}
+# The exact layout written by ListingConverter.convert_houselisting_to_text, parsed in a single pass
+LISTING_TEXT_PATTERN = re.compile(r'neighborhood:(.*?)\nprice:(.*?)\nbedrooms:(.*?)\nbathrooms:(.*?)\n'
+                                  r'house size:(.*?)\ndescription:(.*)', re.DOTALL)
+# Field by field fallback for texts that do not follow the exact layout
+LISTING_FIELD_PATTERNS = {
+    'Neighborhood': re.compile(r'neighborhood:(.*?)\n'),
+    'Price': re.compile(r'price:(.*?)\n'),
+    'Bedrooms': re.compile(r'bedrooms:(.*?)\n'),
+    'Bathrooms': re.compile(r'bathrooms:(.*?)\n'),
+    'House Size': re.compile(r'house size:(.*?)\n'),
+    'Description': re.compile(r'description:(.*)', re.DOTALL)
+}
+
+
 class HouseListing(BaseModel):
     neighborhood: str = Field(..., alias="Neighborhood")
     price: str = Field(..., alias="Price", description="Price in dollars")
@@ -69,15 +90,127 @@ class HouseListing(BaseModel):
 
 
 class AugmentedDescription(BaseModel):
-    augmented_description: Optional[str] = Field(None,
-                                                 alias="Augmented Description",
-                                                 description="Augmented description of the house")
+    augmented_description: str = Field(...,
+                                       alias="Augmented Description",
+                                       min_length=1,
+                                       description="Augmented description of the house")
+
+
+class AugmentedDescriptions(BaseModel):
+    augmented_descriptions: Dict[str, str] = Field(...,
+                                                   alias="Augmented Descriptions",
+                                                   description="Augmented description of each listing, "
+                                                               "keyed by its listing key")
+
+
+class ListingRecord(NamedTuple):
+    """
+    A compact, unvalidated listing for internal hot paths. It is a plain tuple, so it is cheap to create,
+    compare and pickle. Convert it to a HouseListing at the boundaries where validation matters.
+    """
+    neighborhood: str
+    price: str
+    bedrooms: float
+    bathrooms: float
+    house_size: str
+    description: str
+    augmented_description: Optional[str] = None
+
+    @classmethod
+    def from_houselisting(cls, listing: HouseListing) -> "ListingRecord":
+        return cls(listing.neighborhood, listing.price, listing.bedrooms, listing.bathrooms, listing.house_size,
+                   listing.description, listing.augmented_description)
+
+    def to_houselisting(self, validate: bool = True) -> HouseListing:
+        if not validate:
+            return HouseListing.model_construct(**self._asdict())
+
+        return HouseListing(**self.to_listing_data(), **{"Augmented Description": self.augmented_description})
+
+    def to_listing_data(self) -> dict:
+        # The fields by their HouseListing alias, as saved in listings.json
+        return {"Neighborhood": self.neighborhood, "Price": self.price, "Bedrooms": self.bedrooms,
+                "Bathrooms": self.bathrooms, "House Size": self.house_size, "Description": self.description}
+
+
+class ListingDocument(NamedTuple):
+    """
+    A stored listing as returned by the vector stores: its canonical text and its metadata.
+    It has the page_content and metadata of a LangChain Document without importing LangChain, so a search-only
+    process does not pay for it.
+    """
+    page_content: str
+    metadata: dict
+
+
+class ListingFilter(BaseModel):
+    min_bedrooms: Optional[float] = None
+    min_bathrooms: Optional[float] = None
+    min_price: Optional[int] = None
+    max_price: Optional[int] = None
+    min_house_size: Optional[int] = None
+    max_house_size: Optional[int] = None
+
+    def is_empty(self) -> bool:
+        return all(value is None for value in self.model_dump().values())
+
+    def to_chroma_where(self) -> Optional[dict]:
+        conditions = []
+        for field_name, attribute, operator in (("min_bedrooms", "bedrooms", "$gte"),
+                                                ("min_bathrooms", "bathrooms", "$gte"),
+                                                ("min_price", "price", "$gte"),
+                                                ("max_price", "price", "$lte"),
+                                                ("min_house_size", "house_size", "$gte"),
+                                                ("max_house_size", "house_size", "$lte")):
+            value = getattr(self, field_name)
+            if value is not None:
+                conditions.append({attribute: {operator: value}})
+
+        if not conditions:
+            return None
+
+        return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+    @classmethod
+    def from_buyer_preferences(cls, buyer_preferences: str) -> "ListingFilter":
+        """
+        Extracts the hard requirements stated in free-text buyer preferences,
+        e.g. "At least 3 bedrooms & 2 bathrooms" or "under $900,000".
+        """
+        text = buyer_preferences.lower()
+        listing_filter = cls()
+        bedrooms_match = BEDROOMS_PATTERN.search(text)
+        if bedrooms_match:
+            listing_filter.min_bedrooms = float(bedrooms_match.group(1))
+
+        bathrooms_match = BATHROOMS_PATTERN.search(text)
+        if bathrooms_match:
+            listing_filter.min_bathrooms = float(bathrooms_match.group(1))
+
+        max_price_match = MAX_PRICE_PATTERN.search(text)
+        if max_price_match:
+            listing_filter.max_price = ListingConverter.parse_amount(*max_price_match.groups())
+
+        min_price_match = MIN_PRICE_PATTERN.search(text)
+        if min_price_match:
+            listing_filter.min_price = ListingConverter.parse_amount(*min_price_match.groups())
+
+        house_size_match = HOUSE_SIZE_PATTERN.search(text)
+        if house_size_match:
+            house_size = ListingConverter.parse_amount(house_size_match.group(2))
+            if house_size_match.group(1):
+                listing_filter.max_house_size = house_size
+
+            else:
+                listing_filter.min_house_size = house_size
+
+        return listing_filter
 
 
 class ListingConverter:
 
     @staticmethod
-    def convert_houselisting_to_text(listing: HouseListing) -> str:
+    def convert_houselisting_to_text(listing: HouseListing | ListingRecord) -> str:
         return (f"neighborhood:{listing.neighborhood}\n"
                 f"price:{listing.price}\n"
                 f"bedrooms:{listing.bedrooms}\n"
@@ -86,20 +219,105 @@ class ListingConverter:
                 f"description:{listing.description}")
 
     @staticmethod
-    def convert_text_to_houselisting(listing_text: Document) -> HouseListing:
+    def convert_houselisting_to_metadata(listing: HouseListing | ListingRecord) -> dict:
+        # Numeric attributes stored next to the embedding, so searches can filter on them. An amount without a
+        # number, e.g. "Contact agent", is left out, and the listing then never matches a filter on it
+        metadata = {"neighborhood": listing.neighborhood}
+        if AMOUNT_PATTERN.search(listing.price or ""):
+            metadata["price"] = ListingConverter.parse_amount(listing.price)
+
+        metadata.update({"bedrooms": float(listing.bedrooms), "bathrooms": float(listing.bathrooms)})
+        if AMOUNT_PATTERN.search(listing.house_size or ""):
+            metadata["house_size"] = ListingConverter.parse_amount(listing.house_size)
+
+        return metadata
+
+    @staticmethod
+    def validate_listings(listings_data: List[dict]) -> List[Tuple[Optional[ListingRecord], Optional[str]]]:
+        """
+        Validates listings keyed by the HouseListing aliases, e.g. from the LLM or listings.json.
+        Returns the record of every valid listing or the validation error of an invalid one, in input order.
+        A price or house size without an amount, e.g. "Contact agent", makes the listing invalid.
+        Meant for the CPU pool: records and strings are much cheaper to send back than HouseListing models.
+        """
+        results = []
+        for listing_data in listings_data:
+            try:
+                listing = ListingRecord.from_houselisting(HouseListing(**listing_data))
+                ListingConverter.parse_amount(listing.price)
+                ListingConverter.parse_amount(listing.house_size)
+                results.append((listing, None))
+
+            except (ValidationError, TypeError, ValueError) as e:
+                results.append((None, str(e)))
+
+        return results
+
+    @staticmethod
+    def convert_records_to_documents(listings: List[ListingRecord]) -> List[Tuple[str, str, dict]]:
+        """
+        Returns the id, text and metadata each listing is stored with in the vector store. Meant for the CPU pool.
+        """
+        documents = []
+        for listing in listings:
+            listing_text = ListingConverter.convert_houselisting_to_text(listing)
+            documents.append((ListingConverter.get_listing_id(listing_text), listing_text,
+                              ListingConverter.convert_houselisting_to_metadata(listing)))
+
+        return documents
+
+    @staticmethod
+    def parse_amount(amount: str, unit: Optional[str] = None) -> int:
+        """
+        Parses amounts such as "$800,000", "2,000 sqft" or ("1.2", "m") into an integer.
+        """
+        number_match = AMOUNT_PATTERN.search(amount)
+        if not number_match:
+            raise ValueError(f"No amount found in '{amount}'")
+
+        value = float(number_match.group(0).replace(",", ""))
+        return int(value * AMOUNT_UNITS.get((unit or "").lower(), 1))
+
+    @staticmethod
+    def get_listing_id(listing_text: str) -> str:
+        # A stable id derived from the canonical listing text, so re-ingesting an unchanged listing is a no-op
+        return hashlib.sha256(listing_text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def convert_text_to_houselisting(listing_text: ListingDocument, validate: bool = True) -> HouseListing:
+        return ListingConverter.convert_text_to_record(listing_text.page_content).to_houselisting(validate)
+
+    @staticmethod
+    def convert_text_to_record(listing_text: str) -> ListingRecord:
+        match = LISTING_TEXT_PATTERN.match(listing_text)
+        if match:
+            neighborhood, price, bedrooms, bathrooms, house_size, description = map(str.strip, match.groups())
+            try:
+                return ListingRecord(neighborhood, price, float(bedrooms), float(bathrooms), house_size, description)
+
+            except ValueError:
+                # The groups are in the order of the fields of LISTING_FIELD_PATTERNS
+                return ListingConverter._validate_fields(dict(zip(LISTING_FIELD_PATTERNS, (
+                    neighborhood, price, bedrooms, bathrooms, house_size, description))))
+
         parsed_data = {}
-        patterns = {
-            'Neighborhood': re.compile(r'neighborhood:(.*?)\n'),
-            'Price': re.compile(r'price:(.*?)\n'),
-            'Bedrooms': re.compile(r'bedrooms:(.*?)\n'),
-            'Bathrooms': re.compile(r'bathrooms:(.*?)\n'),
-            'House Size': re.compile(r'house size:(.*?)\n'),
-            'Description': re.compile(r'description:(.*)', re.DOTALL)
-        }
-
-        for key, pattern in patterns.items():
-            match = pattern.search(listing_text.page_content)
+        for key, pattern in LISTING_FIELD_PATTERNS.items():
+            match = pattern.search(listing_text)
             if match:
                 parsed_data[key] = match.group(1).strip()
 
-        return HouseListing(**parsed_data)
+        try:
+            bedrooms = float(parsed_data['Bedrooms']) if 'Bedrooms' in parsed_data else None
+            bathrooms = float(parsed_data['Bathrooms']) if 'Bathrooms' in parsed_data else None
+
+        except ValueError:
+            return ListingConverter._validate_fields(parsed_data)
+
+        # Missing fields fail validation when the record is converted to a HouseListing
+        return ListingRecord(parsed_data.get('Neighborhood'), parsed_data.get('Price'), bedrooms, bathrooms,
+                             parsed_data.get('House Size'), parsed_data.get('Description'))
+
+    @staticmethod
+    def _validate_fields(parsed_data: dict) -> ListingRecord:
+        # A room count that is not a number raises the ValidationError the callers catch, not a bare ValueError
+        return ListingRecord.from_houselisting(HouseListing(**parsed_data))
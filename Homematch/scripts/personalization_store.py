@@ -0,0 +1,220 @@
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from scripts.embeddings import encode_hashed_batch
+from scripts.models import ListingFilter
+from scripts.resources.consts import BUYER_QUESTIONS, PERSONALIZATION_STORE_PATH, \
+    PERSONALIZATION_STORE_SIMILARITY_THRESHOLD, PERSONALIZATION_STORE_MAX_ENTRIES, \
+    PERSONALIZATION_STORE_MEMORY_MAX_ENTRIES, PERSONALIZATION_STORE_DIMENSIONS
+from scripts.utils.kmeans import spherical_kmeans
+from scripts.utils.lru_cache import LRUCache
+
+
+class PersonalizationStore:
+    """
+    Augmented descriptions precomputed off-peak for clusters of buyer profiles, so the interactive requests of
+    buyers close to a cluster are answered without an LLM call.
+    Every cluster is stored with the preferences its descriptions were written for (the profile nearest to the
+    cluster centroid) and their local hashed embedding. A buyer reuses the descriptions of the most similar cluster
+    with the same hard requirements (the ListingFilter of the preferences) when the cosine similarity of their
+    preferences is at least similarity_threshold. Embeddings alone can't tell "At least 3 bedrooms" from "At least
+    5 bedrooms" (0.92), so clusters are keyed on the requirements. Only the answers are embedded, the questions are
+    the same for every buyer.
+    Lookups go to an in-memory LRU first and fall back to SQLite, which is trimmed to max_entries descriptions by
+    evicting the least recently accessed ones.
+    """
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, db_path: str = PERSONALIZATION_STORE_PATH,
+                 similarity_threshold: float = PERSONALIZATION_STORE_SIMILARITY_THRESHOLD,
+                 max_entries: int = PERSONALIZATION_STORE_MAX_ENTRIES,
+                 memory_max_entries: int = PERSONALIZATION_STORE_MEMORY_MAX_ENTRIES,
+                 dimensions: int = PERSONALIZATION_STORE_DIMENSIONS):
+        self.db_path = db_path
+        self.similarity_threshold = similarity_threshold
+        self.max_entries = max_entries
+        self.dimensions = dimensions
+        self.memory_cache = LRUCache(max_size=memory_max_entries)
+        self._writes_since_eviction = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS clusters (
+                cluster_id INTEGER PRIMARY KEY AUTOINCREMENT,  -- Never reused, the memory LRU may hold old ids
+                preferences TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                profiles_count INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS descriptions (
+                cluster_id INTEGER NOT NULL,
+                listing_id TEXT NOT NULL,
+                augmented_description TEXT NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (cluster_id, listing_id)
+            )
+        """)
+        self._connection.execute("CREATE INDEX IF NOT EXISTS descriptions_last_access ON descriptions (last_access)")
+        self._connection.commit()
+        self._load_clusters()
+
+    def __len__(self) -> int:
+        return len(self.cluster_ids)
+
+    def find_cluster(self, buyer_preferences: str) -> Optional[int]:
+        """
+        Returns the cluster whose descriptions the buyer can reuse, or None when no cluster is similar enough.
+        """
+        candidates = np.flatnonzero(self.cluster_requirements == self.get_requirements(buyer_preferences))
+        if not len(candidates):
+            return None
+
+        similarities = self.cluster_vectors[candidates] @ self.embed([buyer_preferences])[0]
+        best = int(np.argmax(similarities))
+        return int(self.cluster_ids[candidates[best]]) if similarities[best] >= self.similarity_threshold else None
+
+    def get(self, cluster_id: int, listing_id: str) -> Optional[str]:
+        augmented_description = self.memory_cache.get((cluster_id, listing_id))
+        if augmented_description is not None:
+            return augmented_description
+
+        with self._lock:
+            row = self._connection.execute("SELECT augmented_description FROM descriptions "
+                                           "WHERE cluster_id = ? AND listing_id = ?",
+                                           (cluster_id, listing_id)).fetchone()
+            if row is None:
+                return None
+
+            self._connection.execute("UPDATE descriptions SET last_access = ? WHERE cluster_id = ? AND listing_id = ?",
+                                     (time.time(), cluster_id, listing_id))
+            self._connection.commit()
+
+        self.memory_cache.put((cluster_id, listing_id), row[0])
+        return row[0]
+
+    def put_cluster(self, preferences: str, profiles_count: int, augmented_descriptions: Dict[str, str]) -> int:
+        """
+        Stores the descriptions written for preferences, keyed by listing id, and returns the id of their cluster.
+        A cluster stored for the same preferences before is replaced.
+        """
+        now = time.time()
+        vector = self.embed([preferences])[0]
+        with self._lock:
+            row = self._connection.execute("SELECT cluster_id FROM clusters WHERE preferences = ?",
+                                           (preferences,)).fetchone()
+            if row is not None:
+                self._connection.execute("DELETE FROM descriptions WHERE cluster_id = ?", (row[0],))
+                self._connection.execute("DELETE FROM clusters WHERE cluster_id = ?", (row[0],))
+
+            cluster_id = self._connection.execute(
+                "INSERT INTO clusters (preferences, vector, profiles_count, created_at) VALUES (?, ?, ?, ?)",
+                (preferences, vector.tobytes(), profiles_count, now)
+            ).lastrowid
+            self._connection.executemany(
+                "INSERT INTO descriptions (cluster_id, listing_id, augmented_description, last_access) "
+                "VALUES (?, ?, ?, ?)",
+                [(cluster_id, listing_id, augmented_description, now)
+                 for listing_id, augmented_description in augmented_descriptions.items()]
+            )
+            self._evict_if_needed(len(augmented_descriptions))
+            self._connection.commit()
+
+        self._load_clusters()
+        return cluster_id
+
+    def embed(self, preferences: List[str]) -> np.ndarray:
+        return encode_hashed_batch([self.get_answers(buyer_preferences) for buyer_preferences in preferences],
+                                   self.dimensions)
+
+    def cluster_profiles(self, preferences: List[str], max_clusters: int) -> List[Tuple[str, int]]:
+        """
+        Groups buyer preferences into at most max_clusters clusters. Profiles are first grouped by their hard
+        requirements, a cluster never mixes them, and every group gets a share of max_clusters proportional to its
+        size, split by spherical k-means on the embeddings.
+        Returns the preferences nearest to the centroid of every cluster and the size of the cluster, largest first.
+        """
+        if not preferences:
+            return []
+
+        groups = {}
+        for i, buyer_preferences in enumerate(preferences):
+            groups.setdefault(self.get_requirements(buyer_preferences), []).append(i)
+
+        vectors = self.embed(preferences)
+        clusters = []
+        for group in groups.values():
+            group = np.array(group)
+            centroids, assignments = spherical_kmeans(vectors[group],
+                                                      max(1, round(max_clusters * len(group) / len(preferences))))
+            for cluster in range(len(centroids)):
+                members = group[assignments == cluster]
+                if len(members):
+                    representative = members[int(np.argmax(vectors[members] @ centroids[cluster]))]
+                    clusters.append((preferences[representative], len(members)))
+
+        return sorted(clusters, key=lambda cluster: cluster[1], reverse=True)[:max_clusters]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._connection.execute("SELECT COUNT(*) FROM descriptions").fetchone()[0]
+
+        return {"clusters": len(self.cluster_ids), "entries": entries, "memory_entries": len(self.memory_cache)}
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    @staticmethod
+    def get_answers(buyer_preferences: str) -> str:
+        # 'question: answer' lines, as built by HomeMatcher.format_buyer_preferences, are reduced to their answers
+        answers = []
+        for line in buyer_preferences.splitlines():
+            for question in BUYER_QUESTIONS:
+                if line.startswith(f"{question}:"):
+                    line = line[len(question) + 1:]
+                    break
+
+            answers.append(line.strip())
+
+        return "\n".join(answers)
+
+    @staticmethod
+    def get_requirements(buyer_preferences: str) -> str:
+        return ListingFilter.from_buyer_preferences(buyer_preferences).model_dump_json()
+
+    def _load_clusters(self) -> None:
+        with self._lock:
+            rows = self._connection.execute("SELECT cluster_id, preferences, vector FROM clusters "
+                                            "ORDER BY cluster_id").fetchall()
+
+        self.cluster_ids = np.array([cluster_id for cluster_id, _, _ in rows], dtype=np.int64)
+        # Derived from the stored preferences, so the clusters stored before requirements were keyed still match
+        self.cluster_requirements = np.array([self.get_requirements(preferences) for _, preferences, _ in rows],
+                                             dtype=object)
+        self.cluster_vectors = (np.vstack([np.frombuffer(vector, dtype=np.float32) for _, _, vector in rows])
+                                if rows else np.empty((0, self.dimensions), dtype=np.float32))
+
+    def _evict_if_needed(self, writes: int) -> None:
+        # Counting and purging scan the table, so only do it every EVICTION_INTERVAL written descriptions
+        self._writes_since_eviction += writes
+        if self._writes_since_eviction < self.EVICTION_INTERVAL:
+            return
+
+        self._writes_since_eviction = 0
+        entries_count = self._connection.execute("SELECT COUNT(*) FROM descriptions").fetchone()[0]
+        if entries_count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM descriptions WHERE rowid IN "
+                "(SELECT rowid FROM descriptions ORDER BY last_access ASC LIMIT ?)",
+                (entries_count - self.max_entries,)
+            )
+            # A cluster without any description left is no longer worth matching buyers against
+            self._connection.execute("DELETE FROM clusters WHERE cluster_id NOT IN "
+                                     "(SELECT DISTINCT cluster_id FROM descriptions)")
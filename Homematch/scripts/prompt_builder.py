@@ -0,0 +1,135 @@
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+from langchain_core.output_parsers import PydanticOutputParser
+
+from scripts.resources.consts import GPT4O_MODEL_NAME, MAX_TOKENS_AMOUNT, MAX_OUTPUT_TOKENS_AMOUNT, \
+    EXTRA_SECURITY_GAP, MIN_OUTPUT_TOKENS_AMOUNT, CHARS_PER_TOKEN
+
+
+class PromptTooLongError(ValueError):
+    pass
+
+
+class CompiledPromptTemplate(NamedTuple):
+    prefix: str  # Everything before the user prompt
+    infix: str  # Between the user prompt and the few-shot examples
+    suffix: str
+    format_instructions: Optional[str]
+    fixed_tokens: int
+
+
+class BuiltPrompt(NamedTuple):
+    query: str
+    prompt_tokens: int
+    max_tokens: int
+    few_shot_examples_used: int
+
+
+class PromptBuilder:
+    """
+    Assembles the LLM queries.
+    The template, with the system prompt and the parser format instructions already in place, is compiled once per
+    (system prompt, parser schema) and token counts of the fixed parts and of the few-shot examples are memoized,
+    so building a query is only string concatenation plus counting the user prompt.
+    Few-shot examples are dropped from the end while the prompt leaves less than MIN_OUTPUT_TOKENS_AMOUNT for the
+    answer, and max_tokens is set to what the context window has left.
+    """
+
+    def __init__(self, model_name: str = GPT4O_MODEL_NAME, context_tokens: int = MAX_TOKENS_AMOUNT,
+                 max_output_tokens: int = MAX_OUTPUT_TOKENS_AMOUNT, security_gap: int = EXTRA_SECURITY_GAP,
+                 min_output_tokens: int = MIN_OUTPUT_TOKENS_AMOUNT):
+        self.model_name = model_name
+        self.context_tokens = context_tokens
+        self.max_output_tokens = max_output_tokens
+        self.security_gap = security_gap
+        self.min_output_tokens = min_output_tokens
+        self._compiled_templates: Dict[Tuple[str, Optional[type]], CompiledPromptTemplate] = {}
+        self._example_tokens: Dict[str, int] = {}
+        self._encoding = None
+        self._encoding_loaded = False
+
+    def build(self, system_prompt: str, user_prompt: str,
+              few_shot_examples: Union[str, List[str], None] = None,
+              parser: Optional[PydanticOutputParser] = None) -> BuiltPrompt:
+        template = self.compile(system_prompt, parser)
+        examples = [few_shot_examples] if isinstance(few_shot_examples, str) else list(few_shot_examples or [])
+        examples = [example for example in examples if example]
+        prompt_tokens = template.fixed_tokens + self.count_tokens(user_prompt)
+        examples_tokens = [self._count_example_tokens(example) for example in examples]
+
+        output_budget = self.context_tokens - self.security_gap - prompt_tokens - sum(examples_tokens)
+        while examples and output_budget < self.min_output_tokens:
+            examples.pop()
+            output_budget += examples_tokens.pop()
+
+        if output_budget < self.min_output_tokens:
+            raise PromptTooLongError(f"The prompt needs {self.context_tokens - output_budget} tokens, leaving less "
+                                     f"than {self.min_output_tokens} output tokens of {self.context_tokens}")
+
+        query = template.prefix + user_prompt + template.infix + "\n".join(examples) + template.suffix
+        return BuiltPrompt(query=query, prompt_tokens=self.context_tokens - self.security_gap - output_budget,
+                           max_tokens=min(self.max_output_tokens, output_budget),
+                           few_shot_examples_used=len(examples))
+
+    def compile(self, system_prompt: str, parser: Optional[PydanticOutputParser] = None) -> CompiledPromptTemplate:
+        template_key = (system_prompt, parser.pydantic_object if parser is not None else None)
+        template = self._compiled_templates.get(template_key)
+        if template is None:
+            template = self._compile(system_prompt, parser)
+            self._compiled_templates[template_key] = template
+
+        return template
+
+    def get_format_instructions(self, parser: Optional[PydanticOutputParser]) -> Optional[str]:
+        if parser is None:
+            return None
+
+        return self.compile("", parser).format_instructions
+
+    def count_tokens(self, text: str) -> int:
+        encoding = self._get_encoding()
+        if encoding is None:
+            return len(text) // CHARS_PER_TOKEN + 1
+
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def _compile(self, system_prompt: str, parser: Optional[PydanticOutputParser]) -> CompiledPromptTemplate:
+        if parser is None:
+            prefix = f"\n        {system_prompt}\n        "
+            infix = "\n        Examples:\n        "
+            suffix = "\n        "
+            format_instructions = None
+
+        else:
+            format_instructions = parser.get_format_instructions()
+            prefix = f"\n            {system_prompt}\n            "
+            infix = f"\n            {format_instructions}\n            Examples:\n            "
+            suffix = "\n            "
+
+        fixed_tokens = self.count_tokens(prefix + infix + suffix)
+        return CompiledPromptTemplate(prefix, infix, suffix, format_instructions, fixed_tokens)
+
+    def _count_example_tokens(self, example: str) -> int:
+        # Few-shot examples are constants, count each of them once
+        example_tokens = self._example_tokens.get(example)
+        if example_tokens is None:
+            example_tokens = self.count_tokens(example) + 1  # And the newline joining it
+            self._example_tokens[example] = example_tokens
+
+        return example_tokens
+
+    def _get_encoding(self):
+        if not self._encoding_loaded:
+            self._encoding_loaded = True
+            try:
+                import tiktoken
+                try:
+                    self._encoding = tiktoken.encoding_for_model(self.model_name)
+
+                except KeyError:
+                    self._encoding = tiktoken.get_encoding("cl100k_base")
+
+            except Exception as e:
+                print(f"Token counting falls back to an estimate, tiktoken is unavailable: {e}")
+
+        return self._encoding
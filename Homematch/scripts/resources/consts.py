@@ -1,10 +1,59 @@
-from scripts.models import HouseListing
+import os
 
 GPT4O_MODEL_NAME = "gpt-4o"
 MAX_TOKENS_AMOUNT = 128000
 EXTRA_SECURITY_GAP = 100
 MAX_OUTPUT_TOKENS_AMOUNT = 4096
+MIN_OUTPUT_TOKENS_AMOUNT = 256
 MAX_WORKERS = 5
+MAX_IN_FLIGHT_REQUESTS = 8
+PERSONALIZATION_TIMEOUT_SECONDS = 60
+PERSONALIZATION_MAX_RETRIES = 5
+PERSONALIZATION_MAX_BATCH_SIZE = 5
+PERSONALIZATION_OUTPUT_TOKENS_RATIO = 1.5  # Augmented descriptions run somewhat longer than the originals
+RETRY_BASE_DELAY_SECONDS = 1
+RETRY_MAX_DELAY_SECONDS = 20
+LLM_TEMPERATURE = 0.2
+METRICS_SINKS = os.getenv("HOMEMATCH_METRICS_SINKS", "")  # Comma separated: logging, trace, prometheus
+METRICS_TRACE_PATH = "resources/trace.json"
+METRICS_PROMETHEUS_PATH = "resources/metrics.prom"
+METRICS_PROMETHEUS_PORT = 9464
+# Only local scrapers by default, a deployment that scrapes from another host sets e.g. "0.0.0.0"
+METRICS_PROMETHEUS_HOST = os.getenv("HOMEMATCH_METRICS_HOST", "127.0.0.1")
+METRICS_QUEUE_SAMPLE_INTERVAL_SECONDS = 1
+METRICS_LATENCY_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Default to the gpt-4o and embedding limits of the first usage tier, the limits the API reports override them
+CHAT_REQUESTS_PER_MINUTE = int(os.getenv("HOMEMATCH_CHAT_RPM", "500"))
+CHAT_TOKENS_PER_MINUTE = int(os.getenv("HOMEMATCH_CHAT_TPM", "30000"))
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.getenv("HOMEMATCH_EMBEDDING_RPM", "3000"))
+EMBEDDING_TOKENS_PER_MINUTE = int(os.getenv("HOMEMATCH_EMBEDDING_TPM", "1000000"))
+RATE_LIMIT_BURST_SECONDS = 6  # A full bucket holds this many seconds of the per minute rate
+CHAT_COMPLETION_TOKENS_ESTIMATE = 500  # Reserved for a completion until answers to the same system prompt are seen
+CHAT_COMPLETION_TOKENS_SMOOTHING = 0.2  # Weight of the last completion in the running estimate
+RATE_LIMIT_DECREASE_FACTOR = 0.7
+RATE_LIMIT_INCREASE_RATIO = 0.01
+RATE_LIMIT_MIN_RATIO = 0.05
+RATE_LIMIT_DEFAULT_RETRY_SECONDS = 1
+RATE_LIMIT_MAX_RETRIES = 6
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5
+CIRCUIT_BREAKER_RECOVERY_SECONDS = 30
+CHARS_PER_TOKEN = 4  # Rough estimate for texts that are not tokenized, e.g. the embedded listings or without tiktoken
+OPENAI_BASE_URL_ENV_VAR = "OPENAI_BASE_URL"  # Points the chat and embedding clients at another server, e.g. the mock
+RESPONSE_CACHE_PATH = "resources/response_cache.sqlite3"
+RESPONSE_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+RESPONSE_CACHE_MAX_ENTRIES = 100000
+RESPONSE_CACHE_MEMORY_MAX_ENTRIES = 2048
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+PERSONALIZATION_STORE_PATH = os.getenv("HOMEMATCH_PERSONALIZATION_STORE", "resources/personalization_store.sqlite3")
+# Cosine similarity of the hashed embeddings of the answers, between profiles with the same hard requirements
+PERSONALIZATION_STORE_SIMILARITY_THRESHOLD = float(os.getenv("HOMEMATCH_PERSONALIZATION_STORE_THRESHOLD", "0.9"))
+PERSONALIZATION_STORE_MAX_ENTRIES = 100000
+PERSONALIZATION_STORE_MEMORY_MAX_ENTRIES = 4096
+PERSONALIZATION_STORE_DIMENSIONS = 1024
+PRECOMPUTE_MAX_CLUSTERS = 100
+BATCH_MATCHES_PATH = "resources/batch_matches.jsonl"
+SEARCH_RESULTS_PATH = "resources/search_results.jsonl"
+STREAM_MATCHES_PATH = "resources/personalized_listings.jsonl"
 LISTINGS_SYSTEM_PROMPT = """You are a real estate agent who is creating a listing for a new property. You need to provide a detailed description of the property to attract potential buyers."""
 LISTINGS_FEW_SHOT_EXAMPLE = """
 {property_1:
@@ -18,21 +67,57 @@ LISTINGS_FEW_SHOT_EXAMPLE = """
 }
 """
 
-PROPERTY_LISTING_SCHEMA_JSON = HouseListing.model_json_schema()
-LISTINGS_PROMPT_QUESTION = f"""Provide detailed information about 10 imaginary properties to attract potential buyers. 
-The information should include the following details as an example: 
-
-{LISTINGS_FEW_SHOT_EXAMPLE}
-
-Use the following schema for each property listing:
-
-{PROPERTY_LISTING_SCHEMA_JSON}
-
-IMPORTANT- Avoid creating "augmented_description" field in the schema.
-
-Please only answer in a json format without any additional text!
+# Derived from the HouseListing schema, which imports pydantic and builds the JSON schema, so they are computed by
+# the module __getattr__ at the end of this file on first use rather than by every import of the constants
+SCHEMA_DERIVED_CONSTANTS = ("PROPERTY_LISTING_SCHEMA_JSON", "LISTINGS_PROMPT_QUESTION_TEMPLATE",
+                            "LISTINGS_PROMPT_QUESTION")
+LISTINGS_SHARD_PROMPT = """
+This is batch {shard_number} of {shards_count}. Make these properties different from the ones of other batches:
+use other neighborhoods, architectural styles and price ranges.
 """
+LISTINGS_COUNT = 10
+LISTINGS_SHARD_SIZE = 10
+MAX_CONCURRENT_SHARDS = 4
+LISTINGS_SHARD_MAX_RETRIES = 3
 OPENAI_EMBEDDING_SMALL_MODEL_NAME = "text-embedding-3-small"
+LISTINGS_COLLECTION_NAME = "listings_embeddings"
+EMBEDDING_BACKEND = os.getenv("HOMEMATCH_EMBEDDING_BACKEND", "openai")
+LOCAL_EMBEDDING_DIMENSIONS = 1024
+LOCAL_EMBEDDING_BATCH_SIZE = 2048
+EMBEDDING_MAX_INPUTS_PER_REQUEST = 2048  # The limits of one OpenAI embeddings request
+EMBEDDING_MAX_TOKENS_PER_REQUEST = 300000
+EMBEDDING_MAX_TOKENS_PER_INPUT = 8191
+EMBEDDING_MIN_INPUTS_PER_REQUEST = 128  # Smaller corpora are not spread over more requests than that
+EMBEDDING_MAX_CONCURRENT_REQUESTS = int(os.getenv("HOMEMATCH_EMBEDDING_CONCURRENCY", "8"))
+VECTOR_STORE_MAX_WRITE_BATCH_SIZE = 5000  # Rows per write transaction, Chroma may cap it lower
+CPU_POOL_WORKERS = int(os.getenv("HOMEMATCH_CPU_WORKERS", str(os.cpu_count() or 1)))
+CPU_POOL_CHUNK_SIZE = 2000  # Listings per task sent to a worker process
+CPU_POOL_MIN_OFFLOAD_ITEMS = 256  # Fewer listings are processed in place, a handoff would cost more than the work
+CPU_POOL_MIN_OFFLOAD_CHARS = 256 * 1024  # Smaller LLM responses are parsed in place
+VECTOR_STORE_BACKEND = os.getenv("HOMEMATCH_VECTOR_STORE", "chroma")  # chroma or numpy
+VECTOR_INDEX_DIR_NAME = "numpy_index"
+VECTOR_INDEX_IVF_MIN_VECTORS = 50000  # Smaller corpora are searched exhaustively
+VECTOR_INDEX_IVF_NPROBE = 16
+VECTOR_INDEX_QUANTIZATION = os.getenv("HOMEMATCH_VECTOR_QUANTIZATION", "none")  # none, float16 or int8
+VECTOR_INDEX_DIMENSIONS = int(os.getenv("HOMEMATCH_VECTOR_DIMENSIONS", "0"))  # Matryoshka truncation, 0 keeps them all
+VECTOR_INDEX_RESCORE_FACTOR = int(os.getenv("HOMEMATCH_VECTOR_RESCORE_FACTOR", "4"))  # Shortlist of k times this, 0 off
+VECTOR_INDEX_BLOCK_ROWS = 65536  # Compact vectors are encoded and scored this many rows at a time
+KMEANS_ITERATIONS = 10
+KMEANS_TRAINING_POINTS_PER_CLUSTER = 64
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_INDEX_SUFFIX = ".bm25.npz"
+BM25_MAX_POSTINGS_PER_TERM = 2000  # Impact ordered postings scored per term by an unfiltered search
+HYBRID_SEARCH = os.getenv("HOMEMATCH_HYBRID_SEARCH", "1") == "1"  # Fuse BM25 with the dense search
+HYBRID_FETCH_K_MULTIPLIER = 4  # Each retriever contributes this many times k candidates to the fusion
+RRF_K = 60
+RETRIEVAL_FETCH_K = 20  # Candidates retrieved for the reranker
+RETRIEVAL_FINAL_K = 5  # Reranked listings sent to personalization
+RERANK_RETRIEVAL_WEIGHT = 0.5
+RERANK_ATTRIBUTE_WEIGHT = 0.3
+RERANK_KEYWORD_WEIGHT = 0.2
+RERANK_MMR_LAMBDA = 0.7  # 1 ranks by relevance only, lower values favor diverse listings
+RERANK_SIMILARITY_DIMENSIONS = 256
 
 # BUYER_QUESTIONS = ["How big do you want your house to be?",
 #                    "What are 3 most important things for you in choosing this property?",
@@ -115,3 +200,54 @@ and nearby parks, making it an ideal location for families. Residents enjoy acce
 as tennis courts, a fitness center, a private lake, walking trails, and a clubhouse."
 }}
 """
+
+BUYER_BATCH_PERSONALIZATION_PROMPT = """
+The buyers' preferences are as follows:\n{buyer_preferences}\n
+The listings found relevant for the buyer, keyed by listing key, are: {listings_descriptions}
+\n\nPlease augment the description of every listing to better match the buyer's preferences.
+Answer with the augmented description of every listing under its listing key.\n\n
+"""
+BUYER_BATCH_PERSONALIZATION_FEW_SHOT_EXAMPLES = """
+Buyer's Preferences:
+
+How big do you want your house to be?: At least 3 bedrooms & 2 bathrooms
+Which amenities would you like?: Would like to have a large swimming pool
+What is the most important thing you wish your neighborhood had?: Great schools and parks nearby
+
+Original Listings:
+{{
+    "listing_1": "Experience luxury living in this magnificent 5-bedroom, 4-bathroom home in Lakeside. The backyard offers a covered patio, a swimming pool, and a beautifully landscaped garden. Neighborhood Description: Lakeside is an upscale community with a private lake and walking trails, close to prestigious schools.",
+    "listing_2": "Charming 3-bedroom, 2-bathroom bungalow in Maple Grove with a renovated kitchen and a fenced yard. Neighborhood Description: Maple Grove is a quiet area with a community park and an elementary school within walking distance."
+}}
+
+The output should be:{{"Augmented Descriptions": {{
+    "listing_1": "Experience luxury living in this magnificent 5-bedroom, 4-bathroom home in Lakeside, with all the space a growing family needs. The backyard offers a covered patio, a swimming pool, and a beautifully landscaped garden, perfect for summer days. Lakeside is close to prestigious schools and offers a private lake and walking trails for time outdoors.",
+    "listing_2": "This charming 3-bedroom, 2-bathroom bungalow in Maple Grove gives a family room to grow, with a renovated kitchen and a fenced yard for safe outdoor play. An elementary school and a community park are within walking distance in this quiet neighborhood."
+}}
+}}
+"""
+
+
+def __getattr__(name: str):
+    if name not in SCHEMA_DERIVED_CONSTANTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    from scripts.models import HouseListing
+    schema = HouseListing.model_json_schema()
+    template = f"""Provide detailed information about {{num_listings}} imaginary properties to attract potential buyers. 
+The information should include the following details as an example: 
+
+{LISTINGS_FEW_SHOT_EXAMPLE}
+
+Use the following schema for each property listing:
+
+{schema}
+
+IMPORTANT- Avoid creating "augmented_description" field in the schema.
+
+Please only answer in a json format without any additional text!
+"""
+    # Kept as module attributes, so __getattr__ is not called again
+    globals().update(PROPERTY_LISTING_SCHEMA_JSON=schema, LISTINGS_PROMPT_QUESTION_TEMPLATE=template,
+                     LISTINGS_PROMPT_QUESTION=template.replace("{num_listings}", "10"))
+    return globals()[name]
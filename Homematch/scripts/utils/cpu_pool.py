@@ -0,0 +1,88 @@
+import asyncio
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence, TypeVar
+
+from scripts.resources.consts import CPU_POOL_WORKERS, CPU_POOL_CHUNK_SIZE, CPU_POOL_MIN_OFFLOAD_ITEMS
+from scripts.utils.metrics import metrics
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+class CpuPool:
+    """
+    Runs the CPU-bound stages of the pipeline (listing validation, text conversion, large JSON parses) in a pool of
+    worker processes, so the event loop only awaits them and keeps its network calls going.
+
+    Items are handed over in chunks of chunk_size, one task per chunk, and the worker functions return plain tuples,
+    strings and dicts rather than pydantic models: those pickle several times faster, which keeps the handoff cost on
+    the event loop small next to the work moved off it.
+    Inputs of fewer than min_offload_items are processed in place. With a single worker the pool is a thread, which
+    still frees the event loop between the GIL switches.
+    """
+
+    def __init__(self, max_workers: int = CPU_POOL_WORKERS, chunk_size: int = CPU_POOL_CHUNK_SIZE,
+                 min_offload_items: int = CPU_POOL_MIN_OFFLOAD_ITEMS):
+        self.max_workers = max(1, max_workers)
+        self.chunk_size = chunk_size
+        self.min_offload_items = min_offload_items
+        self._executor = None
+        self._lock = threading.Lock()
+
+    async def map_chunks(self, func: Callable[[List[T]], List[R]], items: Sequence[T]) -> List[R]:
+        """
+        Applies func to consecutive chunks of items and returns the concatenated results, in the order of the items.
+        func must be a module level function (or a staticmethod) taking a list and returning one result per item.
+        """
+        if len(items) < self.min_offload_items:
+            return func(list(items))
+
+        chunks = [list(items[start:start + self.chunk_size]) for start in range(0, len(items), self.chunk_size)]
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        with metrics.span("cpu_pool.map", function=func.__qualname__, items=len(items), chunks=len(chunks)):
+            chunk_results = await asyncio.gather(*(loop.run_in_executor(executor, func, chunk) for chunk in chunks))
+
+        metrics.counter("homematch_cpu_pool_items_total", len(items), function=func.__qualname__)
+        return [result for results in chunk_results for result in results]
+
+    async def run(self, func: Callable[..., R], *args, offload: bool = True) -> R:
+        """
+        Runs func(*args) in the pool, or in place when offload is False, e.g. for an input too small to be worth it.
+        """
+        if not offload:
+            return func(*args)
+
+        with metrics.span("cpu_pool.run", function=func.__qualname__):
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _get_executor(self) -> Executor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = (ProcessPoolExecutor(max_workers=self.max_workers) if self.max_workers > 1
+                                  else ThreadPoolExecutor(max_workers=1))
+
+            return self._executor
+
+
+_cpu_pool: Optional[CpuPool] = None
+_cpu_pool_lock = threading.Lock()
+
+
+def get_cpu_pool() -> CpuPool:
+    """
+    Returns the process-wide pool, sized by HOMEMATCH_CPU_WORKERS, so the stages share their worker processes.
+    """
+    global _cpu_pool
+    with _cpu_pool_lock:
+        if _cpu_pool is None:
+            _cpu_pool = CpuPool()
+
+        return _cpu_pool
@@ -0,0 +1,129 @@
+import json
+import re
+from typing import List
+
+
+class JsonObjectStreamParser:
+    """
+    Incrementally extracts the innermost JSON objects from a stream of text chunks.
+    A model asked for several listings answers with a wrapper such as {"property_1": {...}, ...} or [{...}, ...],
+    possibly inside a markdown fence. Every flat object is returned as soon as its closing brace arrives,
+    so each listing can be validated while the rest of the response is still streaming.
+    Objects that are complete but not valid JSON are counted in invalid_objects and skipped.
+    """
+
+    def __init__(self):
+        self.invalid_objects = 0
+        self._text = ""
+        self._position = 0
+        self._in_string = False
+        self._escaped = False
+        self._open_objects = []  # (start index, has nested object) of every open object
+
+    def feed(self, chunk: str) -> List[dict]:
+        objects = []
+        self._text += chunk
+        text = self._text
+        for position in range(self._position, len(text)):
+            char = text[position]
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+
+            elif char == '"' and self._open_objects:
+                self._in_string = True
+
+            elif char == "{":
+                if self._open_objects:
+                    self._open_objects[-1] = (self._open_objects[-1][0], True)
+
+                self._open_objects.append((position, False))
+
+            elif char == "}" and self._open_objects:
+                start, has_nested_object = self._open_objects.pop()
+                if not has_nested_object:
+                    self._parse_object(text[start:position + 1], objects)
+
+        self._position = len(text)
+        if not self._open_objects:
+            # Nothing can refer back to the consumed text anymore
+            self._text = ""
+            self._position = 0
+
+        return objects
+
+    def _parse_object(self, object_text: str, objects: List[dict]) -> None:
+        try:
+            objects.append(json.loads(object_text))
+
+        except json.decoder.JSONDecodeError:
+            self.invalid_objects += 1
+
+
+class JsonStringFieldStreamParser:
+    """
+    Incrementally decodes the value of one string field of a JSON object streamed as text chunks.
+    A model asked for {"Augmented Description": "..."} streams the JSON envelope and escapes with the text, feed()
+    returns only the decoded text of the field that arrived with the chunk, so it can be shown as it is written.
+    Text before the field, e.g. a markdown fence, and everything after its closing quote are ignored.
+    """
+    ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+    def __init__(self, field_name: str):
+        self.field_pattern = re.compile(r'"' + re.escape(field_name) + r'"\s*:\s*"')
+        self.done = False
+        self.decoded_length = 0
+        self._text = ""
+        self._position = None  # Of the next undecoded character of the value, once its opening quote arrived
+
+    def feed(self, chunk: str) -> str:
+        if self.done:
+            return ""
+
+        self._text += chunk
+        if self._position is None:
+            field_match = self.field_pattern.search(self._text)
+            if field_match is None:
+                return ""
+
+            self._position = field_match.end()
+
+        decoded, text, position = [], self._text, self._position
+        while position < len(text):
+            char = text[position]
+            if char == '"':
+                self.done = True
+                break
+
+            if char != "\\":
+                decoded.append(char)
+                position += 1
+                continue
+
+            # An escape split across chunks is decoded once its last character arrived
+            if position + 1 >= len(text):
+                break
+
+            if text[position + 1] == "u":
+                # A character outside the BMP is escaped as a surrogate pair, decoded together
+                escape_length = 12 if text[position + 2:position + 4].lower() in ("d8", "d9", "da", "db") else 6
+                if position + escape_length > len(text):
+                    break
+
+                decoded.append(json.loads(f'"{text[position:position + escape_length]}"'))
+                position += escape_length
+
+            else:
+                decoded.append(self.ESCAPES.get(text[position + 1], text[position + 1]))
+                position += 2
+
+        # Nothing before the undecoded tail is needed anymore
+        self._text = text[position:]
+        self._position = 0
+        decoded_text = "".join(decoded)
+        self.decoded_length += len(decoded_text)
+        return decoded_text
@@ -0,0 +1,38 @@
+from typing import Tuple
+
+import numpy as np
+
+from scripts.resources.consts import KMEANS_ITERATIONS, KMEANS_TRAINING_POINTS_PER_CLUSTER
+
+
+def spherical_kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = KMEANS_ITERATIONS,
+                     training_points_per_cluster: int = KMEANS_TRAINING_POINTS_PER_CLUSTER,
+                     seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Clusters L2 normalized vectors by cosine similarity. The centroids are trained on a random sample of
+    training_points_per_cluster points per cluster, then every vector is assigned to its most similar centroid.
+    Returns the normalized centroids (n_clusters, dimensions) and the cluster of every vector.
+    """
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, min(n_clusters, len(vectors)))
+    sample_size = min(len(vectors), n_clusters * training_points_per_cluster)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        # An empty cluster keeps its previous centroid
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+    return centroids, assign_clusters(vectors, centroids)
+
+
+def assign_clusters(vectors: np.ndarray, centroids: np.ndarray, batch_size: int = 65536) -> np.ndarray:
+    # Batched so a large memory-mapped corpus is never materialized as one similarity matrix
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), batch_size):
+        assignments[start:start + batch_size] = np.argmax(vectors[start:start + batch_size] @ centroids.T, axis=1)
+
+    return assignments
@@ -0,0 +1,328 @@
+import bisect
+import contextvars
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from scripts.resources.consts import METRICS_LATENCY_BUCKETS_SECONDS, METRICS_TRACE_PATH, METRICS_PROMETHEUS_PATH, \
+    METRICS_PROMETHEUS_PORT, METRICS_PROMETHEUS_HOST, METRICS_SINKS
+
+SPAN_METRIC_NAME = "homematch_span_duration_seconds"
+
+LabelsKey = Tuple[Tuple[str, str], ...]
+
+_current_span: contextvars.ContextVar[Optional["Span"]] = contextvars.ContextVar("current_span", default=None)
+_span_ids = itertools.count(1)
+
+
+class Span:
+    """
+    A timed unit of work. Spans opened while another span is active (in the same task, or in tasks created from it)
+    become its children, so a trace shows where the time of a stage went.
+    """
+    __slots__ = ("name", "span_id", "parent_id", "trace_id", "attributes", "start_time", "duration")
+
+    def __init__(self, name: str, parent: Optional["Span"], attributes: dict):
+        self.name = name
+        self.span_id = next(_span_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.duration = 0.0
+
+    def set_attribute(self, name: str, value) -> None:
+        self.attributes[name] = value
+
+    def to_dict(self) -> dict:
+        return {"name": self.name, "span_id": self.span_id, "parent_id": self.parent_id, "trace_id": self.trace_id,
+                "start_time": self.start_time, "duration": self.duration, "attributes": self.attributes}
+
+
+class MetricsSink:
+    """
+    Receives every finished span and can export the aggregated metrics. Sinks are registered on a MetricsRegistry.
+    """
+
+    def on_span(self, span: Span) -> None:
+        pass
+
+    def close(self, registry: "MetricsRegistry") -> None:
+        pass
+
+
+class LoggingSink(MetricsSink):
+
+    def __init__(self, logger: Optional[logging.Logger] = None, level: int = logging.INFO):
+        if logger is None:
+            logger = logging.getLogger("homematch.metrics")
+            # Without any logging configured the records would be dropped, give the metrics logger its own handler
+            if not logger.handlers and not logging.getLogger().handlers:
+                handler = logging.StreamHandler()
+                handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+                logger.addHandler(handler)
+                logger.setLevel(level)
+
+        self.logger = logger
+        self.level = level
+
+    def on_span(self, span: Span) -> None:
+        self.logger.log(self.level, "span %s took %.1fms %s", span.name, span.duration * 1000,
+                        json.dumps(span.attributes, default=str))
+
+    def close(self, registry: "MetricsRegistry") -> None:
+        self.logger.log(self.level, "metrics\n%s", registry.render_prometheus())
+
+
+class JsonTraceSink(MetricsSink):
+    """
+    Writes the spans as Chrome trace events (open the file in Perfetto or chrome://tracing).
+    Every top level span and its children share a track, so concurrent buyers or shards appear side by side.
+    """
+
+    def __init__(self, path: str = METRICS_TRACE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "w")
+        # The closing bracket is optional in the trace event format, so the file stays loadable after a crash
+        self._file.write("[\n")
+
+    def on_span(self, span: Span) -> None:
+        event = {"name": span.name, "cat": "homematch", "ph": "X", "ts": span.start_time * 1e6,
+                 "dur": span.duration * 1e6, "pid": os.getpid(), "tid": span.trace_id,
+                 "args": {"span_id": span.span_id, "parent_id": span.parent_id, **span.attributes}}
+        with self._lock:
+            if self._file.closed:
+                return
+
+            self._file.write(json.dumps(event, default=str) + ",\n")
+            self._file.flush()
+
+    def close(self, registry: "MetricsRegistry") -> None:
+        with self._lock:
+            if not self._file.closed:
+                self._file.write("{}]\n")
+                self._file.close()
+
+
+class PrometheusSink(MetricsSink):
+    """
+    Exposes the metrics in the Prometheus text format on http://host:port/metrics while the process runs,
+    and writes them to textfile_path on close for short-lived runs (node_exporter textfile collector).
+    """
+
+    def __init__(self, port: Optional[int] = METRICS_PROMETHEUS_PORT, host: str = METRICS_PROMETHEUS_HOST,
+                 textfile_path: Optional[str] = METRICS_PROMETHEUS_PATH, registry: Optional["MetricsRegistry"] = None):
+        self.textfile_path = textfile_path
+        self.registry = registry or metrics
+        self.httpd = None
+        if port is not None:
+            self.httpd = ThreadingHTTPServer((host, port), _PrometheusRequestHandler)
+            self.httpd.daemon_threads = True
+            self.httpd.registry = self.registry
+            threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self, registry: "MetricsRegistry") -> None:
+        if self.textfile_path:
+            with open(self.textfile_path, "w") as f:
+                f.write(registry.render_prometheus())
+
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.httpd = None
+
+
+class _PrometheusRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.registry.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsRegistry:
+    """
+    Aggregates counters, gauges and latency histograms, and times spans.
+    Recording is cheap and always on; the registered sinks decide where spans and metrics are exported.
+    Metrics are identified by their name and labels, e.g. counter("homematch_llm_tokens_total", 10, kind="prompt").
+    """
+
+    def __init__(self, latency_buckets: Tuple[float, ...] = METRICS_LATENCY_BUCKETS_SECONDS):
+        self.latency_buckets = latency_buckets
+        self.sinks: List[MetricsSink] = []
+        self._counters: Dict[str, Dict[LabelsKey, float]] = {}
+        self._gauges: Dict[str, Dict[LabelsKey, float]] = {}
+        self._histograms: Dict[str, Dict[LabelsKey, List]] = {}  # [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink: MetricsSink) -> None:
+        self.sinks.append(sink)
+
+    def counter(self, name: str, value: float = 1, **labels) -> None:
+        labels_key = self._get_labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[labels_key] = series.get(labels_key, 0) + value
+
+    def gauge(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._gauges.setdefault(name, {})[self._get_labels_key(labels)] = value
+
+    def add_to_gauge(self, name: str, delta: float, **labels) -> None:
+        labels_key = self._get_labels_key(labels)
+        with self._lock:
+            series = self._gauges.setdefault(name, {})
+            series[labels_key] = series.get(labels_key, 0) + delta
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        labels_key = self._get_labels_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(labels_key)
+            if histogram is None:
+                histogram = series[labels_key] = [[0] * len(self.latency_buckets), 0.0, 0]
+
+            bucket_index = bisect.bisect_left(self.latency_buckets, value)
+            if bucket_index < len(self.latency_buckets):
+                histogram[0][bucket_index] += 1
+
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Span]:
+        span = Span(name, _current_span.get(), attributes)
+        token = _current_span.set(span)
+        start = time.perf_counter()
+        try:
+            yield span
+
+        except BaseException as e:
+            span.set_attribute("error", type(e).__name__)
+            raise
+
+        finally:
+            span.duration = time.perf_counter() - start
+            try:
+                _current_span.reset(token)
+
+            except ValueError:
+                pass  # An async generator finalized from another context, its span is still recorded
+
+            self.observe(SPAN_METRIC_NAME, span.duration, span=name)
+            for sink in self.sinks:
+                sink.on_span(span)
+
+    def get_counter(self, name: str, **labels) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(self._get_labels_key(labels), 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "counters": {name: {self._format_labels(key): value for key, value in series.items()}
+                             for name, series in self._counters.items()},
+                "gauges": {name: {self._format_labels(key): value for key, value in series.items()}
+                           for name, series in self._gauges.items()},
+                "histograms": {name: {self._format_labels(key): {"count": histogram[2], "sum": histogram[1]}
+                                      for key, histogram in series.items()}
+                               for name, series in self._histograms.items()},
+            }
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                lines.extend(f"{name}{self._format_labels(key)} {value}" for key, value in series.items())
+
+            for name, series in sorted(self._gauges.items()):
+                lines.append(f"# TYPE {name} gauge")
+                lines.extend(f"{name}{self._format_labels(key)} {value}" for key, value in series.items())
+
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, (bucket_counts, total, count) in series.items():
+                    cumulative_count = 0
+                    for bucket, bucket_count in zip(self.latency_buckets, bucket_counts):
+                        cumulative_count += bucket_count
+                        lines.append(f"{name}_bucket{self._format_labels(key + (('le', str(bucket)),))} "
+                                     f"{cumulative_count}")
+
+                    lines.append(f"{name}_bucket{self._format_labels(key + (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{self._format_labels(key)} {total}")
+                    lines.append(f"{name}_count{self._format_labels(key)} {count}")
+
+        return "\n".join(lines) + "\n"
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def close(self) -> None:
+        for sink in self.sinks:
+            sink.close(self)
+
+        self.sinks = []
+
+    @staticmethod
+    def _get_labels_key(labels: dict) -> LabelsKey:
+        return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+    @staticmethod
+    def _format_labels(labels_key: LabelsKey) -> str:
+        if not labels_key:
+            return ""
+
+        escaped_labels = []
+        for name, value in labels_key:
+            escaped_value = value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            escaped_labels.append(f'{name}="{escaped_value}"')
+
+        return "{" + ",".join(escaped_labels) + "}"
+
+
+# The process-wide registry every component records into
+metrics = MetricsRegistry()
+
+METRICS_SINKS_FACTORIES = {
+    "logging": LoggingSink,
+    "trace": JsonTraceSink,
+    "prometheus": PrometheusSink,
+}
+
+
+def configure_metrics(sink_names: Optional[List[str]] = None) -> MetricsRegistry:
+    """
+    Registers the named sinks (logging, trace, prometheus) on the process-wide registry,
+    by default the ones listed in HOMEMATCH_METRICS_SINKS. Call metrics.close() at exit to flush them.
+    """
+    if sink_names is None:
+        sink_names = [sink_name.strip() for sink_name in METRICS_SINKS.split(",") if sink_name.strip()]
+
+    for sink_name in sink_names:
+        if sink_name not in METRICS_SINKS_FACTORIES:
+            raise ValueError(f"Unknown metrics sink {sink_name}, expected one of {sorted(METRICS_SINKS_FACTORIES)}")
+
+        metrics.add_sink(METRICS_SINKS_FACTORIES[sink_name]())
+
+    return metrics
@@ -0,0 +1,440 @@
+import asyncio
+import re
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterator, Mapping, Optional, TypeVar
+
+from scripts.resources.consts import CHAT_REQUESTS_PER_MINUTE, CHAT_TOKENS_PER_MINUTE, \
+    EMBEDDING_REQUESTS_PER_MINUTE, EMBEDDING_TOKENS_PER_MINUTE, RATE_LIMIT_BURST_SECONDS, \
+    RATE_LIMIT_DECREASE_FACTOR, RATE_LIMIT_INCREASE_RATIO, RATE_LIMIT_MIN_RATIO, RATE_LIMIT_DEFAULT_RETRY_SECONDS, \
+    RATE_LIMIT_MAX_RETRIES, CIRCUIT_BREAKER_FAILURE_THRESHOLD, CIRCUIT_BREAKER_RECOVERY_SECONDS
+from scripts.utils.metrics import metrics
+
+T = TypeVar("T")
+
+DURATION_PART_PATTERN = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_UNITS_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+RETRYABLE_ERROR_NAMES = {"APIConnectionError", "APITimeoutError", "Timeout", "TimeoutError", "ServiceUnavailableError",
+                         "InternalServerError", "TryAgain"}
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised without calling the upstream while the circuit breaker is open.
+    """
+
+
+class ApiErrors:
+    """
+    Classifies the errors of the OpenAI clients (both the pre-1.0 and the current SDK, and LangChain wrapping them)
+    without importing them: by HTTP status when the error carries one, otherwise by the error type name.
+    """
+
+    @staticmethod
+    def get_status_code(error: BaseException) -> Optional[int]:
+        status_code = getattr(error, "status_code", None) or getattr(error, "http_status", None)
+        if status_code is None:
+            status_code = getattr(getattr(error, "response", None), "status_code", None)
+
+        return status_code if isinstance(status_code, int) else None
+
+    @staticmethod
+    def get_headers(error: BaseException) -> Mapping[str, str]:
+        headers = getattr(getattr(error, "response", None), "headers", None)
+        if headers is None:
+            headers = getattr(error, "headers", None)
+
+        return headers or {}
+
+    @staticmethod
+    def is_rate_limit_error(error: BaseException) -> bool:
+        return ApiErrors.get_status_code(error) == 429 or "RateLimit" in type(error).__name__
+
+    @staticmethod
+    def is_upstream_failure(error: BaseException) -> bool:
+        # Failures that say the upstream is unhealthy, counted by the circuit breaker
+        if ApiErrors.is_rate_limit_error(error):
+            return False
+
+        status_code = ApiErrors.get_status_code(error)
+        if status_code is not None:
+            return status_code >= 500
+
+        return isinstance(error, (TimeoutError, ConnectionError)) or type(error).__name__ in RETRYABLE_ERROR_NAMES
+
+    @staticmethod
+    def is_retryable(error: BaseException) -> bool:
+        return ApiErrors.is_rate_limit_error(error) or ApiErrors.is_upstream_failure(error)
+
+    @staticmethod
+    def get_retry_after(error: BaseException) -> Optional[float]:
+        headers = {name.lower(): value for name, value in ApiErrors.get_headers(error).items()}
+        if headers.get("retry-after-ms"):
+            return parse_duration(f"{headers['retry-after-ms']}ms")
+
+        return parse_duration(headers.get("retry-after"))
+
+
+def parse_duration(duration: Optional[str]) -> Optional[float]:
+    """
+    Parses the durations of the rate limit headers: plain seconds ("20") or Go style ("6m0s", "1.5s", "20ms").
+    """
+    if not duration:
+        return None
+
+    try:
+        return float(duration)
+
+    except ValueError:
+        parts = DURATION_PART_PATTERN.findall(duration)
+        return sum(float(amount) * DURATION_UNITS_SECONDS[unit] for amount, unit in parts) if parts else None
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at rate tokens per second up to capacity. Reservations may take the bucket into debt,
+    the reserving caller then waits until the debt is paid off, so waiters are served in order without polling.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    @classmethod
+    def for_rate(cls, rate: float, burst_seconds: float) -> "TokenBucket":
+        return cls(rate, max(1.0, rate * burst_seconds))
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.refill(now)
+        self.tokens -= min(amount, self.capacity)  # A request larger than the bucket waits for a full bucket
+        return max(0.0, -self.tokens / self.rate)
+
+    def set_rate(self, rate: float, burst_seconds: float) -> None:
+        self.refill(time.monotonic())
+        self.rate = rate
+        self.capacity = max(1.0, rate * burst_seconds)
+        self.tokens = min(self.tokens, self.capacity)
+
+
+class CircuitBreaker:
+    """
+    Opens after failure_threshold consecutive upstream failures and then fails fast with CircuitOpenError.
+    After recovery_seconds a single probe call is let through (half open): its success closes the circuit,
+    its failure opens it again.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_BREAKER_FAILURE_THRESHOLD,
+                 recovery_seconds: float = CIRCUIT_BREAKER_RECOVERY_SECONDS):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_seconds = recovery_seconds
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.recovery_seconds:
+                self._set_state(self.HALF_OPEN)
+
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._probe_in_flight):
+                metrics.counter("homematch_circuit_rejected_total", limiter=self.name)
+                raise CircuitOpenError(f"The {self.name} circuit is open after {self.consecutive_failures} "
+                                       f"consecutive failures, failing fast")
+
+            if self.state == self.HALF_OPEN:
+                self._probe_in_flight = True
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.consecutive_failures = 0
+            self._probe_in_flight = False
+            if self.state != self.CLOSED:
+                print(f"The {self.name} circuit is closed again")
+                self._set_state(self.CLOSED)
+
+    def on_failure(self) -> None:
+        with self._lock:
+            self.consecutive_failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and
+                                                self.consecutive_failures >= self.failure_threshold):
+                print(f"Opening the {self.name} circuit for {self.recovery_seconds}s "
+                      f"after {self.consecutive_failures} consecutive failures")
+                self.opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def on_neutral(self) -> None:
+        # The call neither proved nor disproved the upstream health (e.g. a 429 or a bad request)
+        with self._lock:
+            self._probe_in_flight = False
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        metrics.gauge("homematch_circuit_state", self.STATE_VALUES[state], limiter=self.name)
+
+
+class RateLimiter:
+    """
+    Paces the calls to one upstream with a requests per minute and a tokens per minute token bucket, and guards it
+    with a circuit breaker. One instance is shared by every caller of the upstream (see get_rate_limiter), from
+    coroutines (acquire_async) and threads (acquire) alike.
+
+    The rates adapt AIMD style: a 429 cuts them by decrease_factor and pauses every caller for the Retry-After time,
+    each success raises them by increase_ratio of the configured limit, and rate limit headers
+    (x-ratelimit-limit/remaining/reset-*) found on the responses, successful or not, override the configured limits.
+    Bursts are bounded by burst_seconds worth of tokens, so a queue of callers is paced instead of stampeding.
+    A call reserves an estimate of its tokens, reconciled with the tokens it used by settle() once it is answered.
+    """
+
+    def __init__(self, name: str, requests_per_minute: float, tokens_per_minute: float,
+                 burst_seconds: float = RATE_LIMIT_BURST_SECONDS, max_retries: int = RATE_LIMIT_MAX_RETRIES,
+                 circuit_breaker: Optional[CircuitBreaker] = None):
+        self.name = name
+        self.requests_per_minute_limit = requests_per_minute
+        self.tokens_per_minute_limit = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.burst_seconds = burst_seconds
+        self.max_retries = max_retries
+        self.circuit_breaker = circuit_breaker or CircuitBreaker(name)
+        self.requests_bucket = TokenBucket.for_rate(requests_per_minute / 60, burst_seconds)
+        self.tokens_bucket = TokenBucket.for_rate(tokens_per_minute / 60, burst_seconds)
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0, requests: int = 1) -> float:
+        wait_seconds = self._reserve(tokens, requests)
+        if wait_seconds > 0:
+            time.sleep(wait_seconds)
+
+        return wait_seconds
+
+    async def acquire_async(self, tokens: int = 0, requests: int = 1) -> float:
+        wait_seconds = self._reserve(tokens, requests)
+        if wait_seconds > 0:
+            await asyncio.sleep(wait_seconds)
+
+        return wait_seconds
+
+    @contextmanager
+    def limit(self, tokens: int = 0, requests: int = 1) -> Iterator[None]:
+        """
+        Checks the circuit, waits for capacity and records the outcome of the call made in the block.
+        A wait that is interrupted gives the reserved tokens back, and releases the circuit's probe if it held it.
+        """
+        self.circuit_breaker.before_call()
+        acquired = False
+        try:
+            self.acquire(tokens, requests)
+            acquired = True
+            yield
+
+        except BaseException as e:
+            self._record_interrupted_call(e, tokens, acquired)
+            raise
+
+        self.record_success()
+
+    @asynccontextmanager
+    async def limit_async(self, tokens: int = 0, requests: int = 1) -> AsyncIterator[None]:
+        self.circuit_breaker.before_call()
+        acquired = False
+        try:
+            await self.acquire_async(tokens, requests)
+            acquired = True
+            yield
+
+        except BaseException as e:
+            self._record_interrupted_call(e, tokens, acquired)
+            raise
+
+        self.record_success()
+
+    def call(self, func: Callable[[], T], tokens: int = 0, requests: int = 1) -> T:
+        """
+        Calls func within the limits, retrying it when it is rate limited (429). Other errors are raised.
+        The tokens of a call that fails are given back, an error answer does not use them.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.limit(tokens, requests):
+                    try:
+                        return func()
+
+                    except BaseException:
+                        self.settle(tokens, 0)
+                        raise
+
+            except Exception as e:
+                if not ApiErrors.is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+
+    async def call_async(self, func: Callable[[], Awaitable[T]], tokens: int = 0, requests: int = 1) -> T:
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.limit_async(tokens, requests):
+                    try:
+                        return await func()
+
+                    except BaseException:
+                        self.settle(tokens, 0)
+                        raise
+
+            except Exception as e:
+                if not ApiErrors.is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+
+    def settle(self, reserved_tokens: int, used_tokens: int) -> None:
+        """
+        Gives back the tokens reserved for a call but not used, or takes the ones it used beyond its reservation.
+        """
+        with self._lock:
+            self.tokens_bucket.refill(time.monotonic())
+            # reserve() never took more than a full bucket
+            reserved_tokens = min(reserved_tokens, self.tokens_bucket.capacity)
+            self.tokens_bucket.tokens = min(self.tokens_bucket.capacity,
+                                            self.tokens_bucket.tokens + reserved_tokens - used_tokens)
+
+    def record_success(self) -> None:
+        self.circuit_breaker.on_success()
+        with self._lock:
+            if (self.requests_per_minute, self.tokens_per_minute) == (self.requests_per_minute_limit,
+                                                                       self.tokens_per_minute_limit):
+                return
+
+            requests_increase = self.requests_per_minute_limit * RATE_LIMIT_INCREASE_RATIO
+            tokens_increase = self.tokens_per_minute_limit * RATE_LIMIT_INCREASE_RATIO
+            requests_per_minute = min(self.requests_per_minute_limit, self.requests_per_minute + requests_increase)
+            tokens_per_minute = min(self.tokens_per_minute_limit, self.tokens_per_minute + tokens_increase)
+            if (requests_per_minute, tokens_per_minute) != (self.requests_per_minute, self.tokens_per_minute):
+                self._set_rates(requests_per_minute, tokens_per_minute)
+
+    def _record_interrupted_call(self, error: BaseException, tokens: int, acquired: bool) -> None:
+        if acquired:
+            self.record_failure(error)
+            return
+
+        # Interrupted while waiting, e.g. cancelled: no call was made, so the upstream health is unknown
+        self.settle(tokens, 0)
+        self.circuit_breaker.on_neutral()
+
+    def record_failure(self, error: BaseException) -> None:
+        if ApiErrors.is_rate_limit_error(error):
+            self.circuit_breaker.on_neutral()
+            self.on_rate_limited(ApiErrors.get_retry_after(error), ApiErrors.get_headers(error))
+
+        elif ApiErrors.is_upstream_failure(error):
+            self.circuit_breaker.on_failure()
+
+        else:
+            self.circuit_breaker.on_neutral()
+
+    def on_rate_limited(self, retry_after: Optional[float] = None, headers: Optional[Mapping[str, str]] = None) -> None:
+        metrics.counter("homematch_rate_limited_total", limiter=self.name)
+        with self._lock:
+            now = time.monotonic()
+            retry_after = retry_after if retry_after is not None else RATE_LIMIT_DEFAULT_RETRY_SECONDS
+            # The concurrent calls rejected during the same pause are one overload signal, the rates are cut once
+            already_paused = now < self.blocked_until
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            if not already_paused:
+                self._set_rates(max(self.requests_per_minute_limit * RATE_LIMIT_MIN_RATIO,
+                                    self.requests_per_minute * RATE_LIMIT_DECREASE_FACTOR),
+                                max(self.tokens_per_minute_limit * RATE_LIMIT_MIN_RATIO,
+                                    self.tokens_per_minute * RATE_LIMIT_DECREASE_FACTOR))
+
+            # The capacity we believed we had is gone, callers queue up behind the pause
+            self.requests_bucket.tokens = min(self.requests_bucket.tokens, 0.0)
+            self.tokens_bucket.tokens = min(self.tokens_bucket.tokens, 0.0)
+
+        if headers:
+            self.update_from_headers(headers)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """
+        Adopts the limits the upstream reports, and pauses the callers until the window resets when it reports
+        no remaining requests or tokens.
+        """
+        headers = {name.lower(): value for name, value in headers.items()}
+        with self._lock:
+            now = time.monotonic()
+            for kind in ("requests", "tokens"):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                reset_seconds = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+                if limit is not None and float(limit) > 0:
+                    self._set_limit(kind, float(limit))
+
+                if remaining is not None and float(remaining) <= 0 and reset_seconds:
+                    self.blocked_until = max(self.blocked_until, now + reset_seconds)
+
+                elif remaining is not None:
+                    bucket = self.requests_bucket if kind == "requests" else self.tokens_bucket
+                    bucket.refill(now)
+                    bucket.tokens = min(bucket.tokens, float(remaining))
+
+    def _set_limit(self, kind: str, limit: float) -> None:
+        # A limiter running at its previous limit moves to the new one at once, a backed off one ramps up to it
+        if kind == "requests" and limit != self.requests_per_minute_limit:
+            at_limit = self.requests_per_minute >= self.requests_per_minute_limit
+            self.requests_per_minute_limit = limit
+            self._set_rates(limit if at_limit else min(self.requests_per_minute, limit), self.tokens_per_minute)
+
+        elif kind == "tokens" and limit != self.tokens_per_minute_limit:
+            at_limit = self.tokens_per_minute >= self.tokens_per_minute_limit
+            self.tokens_per_minute_limit = limit
+            self._set_rates(self.requests_per_minute, limit if at_limit else min(self.tokens_per_minute, limit))
+
+    def _set_rates(self, requests_per_minute: float, tokens_per_minute: float) -> None:
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_bucket.set_rate(requests_per_minute / 60, self.burst_seconds)
+        self.tokens_bucket.set_rate(tokens_per_minute / 60, self.burst_seconds)
+        metrics.gauge("homematch_rate_limit_requests_per_minute", requests_per_minute, limiter=self.name)
+        metrics.gauge("homematch_rate_limit_tokens_per_minute", tokens_per_minute, limiter=self.name)
+
+    def _reserve(self, tokens: int, requests: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait_seconds = max(self.requests_bucket.reserve(requests, now), self.tokens_bucket.reserve(tokens, now),
+                               self.blocked_until - now)
+
+        if wait_seconds > 0:
+            metrics.observe("homematch_rate_limit_wait_seconds", wait_seconds, limiter=self.name)
+
+        return max(0.0, wait_seconds)
+
+
+_rate_limiters: Dict[str, RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+RATE_LIMITS = {
+    "chat": (CHAT_REQUESTS_PER_MINUTE, CHAT_TOKENS_PER_MINUTE),
+    "embeddings": (EMBEDDING_REQUESTS_PER_MINUTE, EMBEDDING_TOKENS_PER_MINUTE),
+}
+
+
+def get_rate_limiter(name: str) -> RateLimiter:
+    """
+    Returns the process-wide limiter of an upstream ("chat" or "embeddings"), so every caller shares its limits.
+    """
+    with _rate_limiters_lock:
+        if name not in _rate_limiters:
+            requests_per_minute, tokens_per_minute = RATE_LIMITS[name]
+            _rate_limiters[name] = RateLimiter(name, requests_per_minute, tokens_per_minute)
+
+        return _rate_limiters[name]
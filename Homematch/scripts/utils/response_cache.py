@@ -0,0 +1,132 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from scripts.resources.consts import RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL_SECONDS, RESPONSE_CACHE_MAX_ENTRIES, \
+    RESPONSE_CACHE_MEMORY_MAX_ENTRIES
+from scripts.utils.lru_cache import LRUCache
+
+
+class ResponseCache:
+    """
+    A content-addressed cache for LLM responses.
+    Lookups go to an in-memory LRU first and fall back to an on-disk SQLite store, so repeated prompts are answered
+    without calling the model. Entries expire after ttl_seconds and the disk store is trimmed to max_entries by
+    evicting the least recently accessed rows.
+    """
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, db_path: str = RESPONSE_CACHE_PATH,
+                 ttl_seconds: float = RESPONSE_CACHE_TTL_SECONDS,
+                 max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 memory_max_entries: int = RESPONSE_CACHE_MEMORY_MAX_ENTRIES):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.memory_cache = LRUCache(max_size=memory_max_entries)
+        self.hits = 0
+        self.misses = 0
+        self._writes_since_eviction = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(db_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(*parts) -> str:
+        serialized_parts = json.dumps(parts, sort_keys=True, default=str)
+        return hashlib.sha256(serialized_parts.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        memory_entry = self.memory_cache.get(key)
+        if memory_entry is not None:
+            value, created_at = memory_entry
+            if not self._is_expired(created_at, now):
+                self.hits += 1
+                return json.loads(value)
+
+            self.memory_cache.pop(key)
+
+        with self._lock:
+            row = self._connection.execute("SELECT value, created_at FROM responses WHERE key = ?",
+                                           (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            value, created_at = row
+            if self._is_expired(created_at, now):
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._connection.commit()
+                self.misses += 1
+                return None
+
+            self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self._connection.commit()
+
+        self.memory_cache.put(key, (value, created_at))
+        self.hits += 1
+        return json.loads(value)
+
+    def set(self, key: str, response: dict) -> None:
+        now = time.time()
+        value = json.dumps(response)
+        self.memory_cache.put(key, (value, now))
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            self._evict_if_needed(now)
+            self._connection.commit()
+
+    def clear(self) -> None:
+        self.memory_cache.clear()
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            disk_entries = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+        return {"hits": self.hits, "misses": self.misses, "memory_entries": len(self.memory_cache),
+                "disk_entries": disk_entries}
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def _evict_if_needed(self, now: float) -> None:
+        # Counting and purging scan the table, so only do it every EVICTION_INTERVAL writes
+        self._writes_since_eviction += 1
+        if self._writes_since_eviction < self.EVICTION_INTERVAL:
+            return
+
+        self._writes_since_eviction = 0
+        if self.ttl_seconds is not None:
+            self._connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+
+        entries_count = self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if entries_count > self.max_entries:
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY last_access ASC LIMIT ?)",
+                (entries_count - self.max_entries,)
+            )
@@ -1,4 +1,9 @@
+import asyncio
 import os
+import random
+from typing import Awaitable, List
+
+from scripts.resources.consts import RETRY_BASE_DELAY_SECONDS, RETRY_MAX_DELAY_SECONDS
 
 
 class Utils:
@@ -7,3 +12,22 @@ class Utils:
     def get_resource_path(folder_name: str, file_name: str) -> str:
         dir_path = os.path.dirname(__file__)
         return os.path.join(dir_path, folder_name, file_name)
+
+    @staticmethod
+    def get_backoff_delay(attempt: int) -> float:
+        # Exponential backoff with full jitter, so concurrent retries do not hit the API in lockstep
+        return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+
+    @staticmethod
+    async def gather_or_cancel(*awaitables: Awaitable) -> List:
+        # asyncio.gather without the siblings left running when one of them raises (TaskGroup needs Python 3.11)
+        tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+        try:
+            return await asyncio.gather(*tasks)
+
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
@@ -0,0 +1,339 @@
+import json
+import os
+import shutil
+import threading
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from scripts.resources.consts import VECTOR_INDEX_IVF_MIN_VECTORS, VECTOR_INDEX_IVF_NPROBE, VECTOR_INDEX_QUANTIZATION, \
+    VECTOR_INDEX_DIMENSIONS, VECTOR_INDEX_RESCORE_FACTOR, VECTOR_INDEX_BLOCK_ROWS
+from scripts.utils.kmeans import spherical_kmeans
+
+
+class VectorIndex:
+    """
+    An in-process vector index on plain NumPy files in its own directory:
+    vectors.npy holds the L2 normalized vectors as one contiguous float32 matrix, opened memory-mapped so a cold start
+    only maps the file, and records.jsonl holds the id, document and metadata of every row, read by byte offset
+    (offsets.npy) so a search only parses the rows it returns.
+
+    A search is an exact cosine top-k: one matrix multiply of the query batch against the vectors and an argpartition.
+    Corpora of ivf_min_vectors or more also get an IVF index (k-means lists over the vectors), and a search then
+    scores only the nprobe lists whose centroids are closest to the query.
+    Every write goes to a new generation directory, published by atomically replacing the CURRENT marker file. A
+    loaded index keeps the memory maps and the records file handle of its generation, so it never reads half of a
+    write, and refresh() moves it to the latest generation.
+
+    With a quantization (float16 or int8) the searches scan a compact copy of the vectors instead, optionally
+    truncated to their first dimensions (Matryoshka embeddings such as text-embedding-3 keep most of their quality
+    in a prefix) and normalized again. int8 codes are scaled per dimension by the largest absolute value in the corpus.
+    The k * rescore_factor best rows of the compact scan are rescored against the full precision vectors, of which
+    only these rows are read from the memory-mapped file. The compact copy is kept with the vectors, one file per
+    quantization and dimensions, and is built on the first load when the settings change, without a new ingestion.
+    """
+    CURRENT_FILE = "CURRENT"
+    GENERATION_PREFIX = "generation_"
+    VECTORS_FILE = "vectors.npy"
+    OFFSETS_FILE = "offsets.npy"
+    RECORDS_FILE = "records.jsonl"
+    IVF_CENTROIDS_FILE = "ivf_centroids.npy"
+    IVF_ORDER_FILE = "ivf_order.npy"
+    IVF_OFFSETS_FILE = "ivf_offsets.npy"
+    COMPACT_VECTORS_FILE = "compact_{quantization}_{dimensions}.npy"
+    COMPACT_SCALES_FILE = "compact_{quantization}_{dimensions}_scales.npy"
+    QUANTIZATIONS = ("none", "float16", "int8")
+
+    def __init__(self, path: str, ivf_min_vectors: int = VECTOR_INDEX_IVF_MIN_VECTORS,
+                 nprobe: int = VECTOR_INDEX_IVF_NPROBE, quantization: str = VECTOR_INDEX_QUANTIZATION,
+                 dimensions: int = VECTOR_INDEX_DIMENSIONS, rescore_factor: int = VECTOR_INDEX_RESCORE_FACTOR):
+        if quantization not in self.QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization '{quantization}', choose one of {list(self.QUANTIZATIONS)}")
+
+        self.path = path
+        self.ivf_min_vectors = ivf_min_vectors
+        self.nprobe = nprobe
+        self.quantization = quantization
+        self.dimensions = dimensions
+        self.rescore_factor = rescore_factor
+        self._records = None
+        self._lock = threading.Lock()
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    @property
+    def has_ivf(self) -> bool:
+        return self.ivf_centroids is not None
+
+    @property
+    def search_nbytes(self) -> int:
+        """
+        The size of the vectors a search scans, the part of the index that has to stay in memory.
+        """
+        if self.compact_vectors is None:
+            return self.vectors.nbytes
+
+        return self.compact_vectors.nbytes + (self.compact_scales.nbytes if self.compact_scales is not None else 0)
+
+    def get_records(self) -> List[dict]:
+        """
+        Returns every row as {"id", "document", "metadata"}. Parsed once and kept, it is only needed for writes
+        and filters.
+        """
+        with self._lock:
+            if self._records is None:
+                self._records = self.read_records(range(len(self)))
+
+            return self._records
+
+    def read_records(self, indices) -> List[dict]:
+        if not len(self):
+            return []
+
+        # pread does not move a shared file position, so concurrent readers do not need a lock
+        offsets, records_file = self.offsets, self._records_file
+        return [json.loads(os.pread(records_file.fileno(), int(offsets[index + 1] - offsets[index]),
+                                    int(offsets[index])))
+                for index in indices]
+
+    def search(self, query_vectors, k: int,
+               mask: Optional[np.ndarray] = None) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Returns the row indices and cosine similarities of the k rows most similar to each query, best first.
+        A boolean mask restricts the search to the rows it selects.
+        """
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        queries = queries.reshape(-1, queries.shape[-1])
+        if not len(self) or k <= 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)) for _ in queries]
+
+        queries = self._normalize(queries)
+        if self.has_ivf:
+            return [self._search_ivf(query, k, mask) for query in queries]
+
+        candidates = None if mask is None else np.flatnonzero(mask)
+        scores = self._score(queries, candidates)
+        return [self._select(query, query_scores, k, candidates) for query, query_scores in zip(queries, scores)]
+
+    def write(self, ids: List[str], vectors, documents: List[str], metadatas: List[dict]) -> None:
+        """
+        Replaces the content of the index with the given rows.
+        """
+        vectors = (self._normalize(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1)) if ids
+                   else np.empty((0, 0), dtype=np.float32))
+        # Written in full into a generation directory no reader knows about yet, then published by the marker
+        generation = f"{self.GENERATION_PREFIX}{time.time_ns()}_{os.getpid()}"
+        generation_path = os.path.join(self.path, generation)
+        os.makedirs(generation_path)
+        offsets = np.zeros(len(ids) + 1, dtype=np.int64)
+        with open(os.path.join(generation_path, self.RECORDS_FILE), "wb") as f:
+            for index, (listing_id, document, metadata) in enumerate(zip(ids, documents, metadatas)):
+                line = json.dumps({"id": listing_id, "document": document, "metadata": metadata}).encode("utf-8")
+                f.write(line + b"\n")
+                offsets[index + 1] = offsets[index] + len(line) + 1
+
+        files = {self.VECTORS_FILE: vectors, self.OFFSETS_FILE: offsets}
+        if len(ids) >= self.ivf_min_vectors:
+            print(f"Building the IVF lists of {len(ids)} vectors")
+            centroids, assignments = spherical_kmeans(vectors, int(np.sqrt(len(ids))))
+            order = np.argsort(assignments, kind="stable")
+            files.update({self.IVF_CENTROIDS_FILE: centroids, self.IVF_ORDER_FILE: order,
+                          self.IVF_OFFSETS_FILE: np.searchsorted(assignments[order], np.arange(len(centroids) + 1))})
+
+        for file_name, array in files.items():
+            with open(os.path.join(generation_path, file_name), "wb") as f:
+                np.save(f, array)
+
+        current_path = os.path.join(self.path, self.CURRENT_FILE)
+        with open(f"{current_path}.{generation}.tmp", "w") as f:
+            f.write(generation)
+
+        previous_generation = None
+        if os.path.exists(current_path):
+            with open(current_path) as f:
+                previous_generation = f.read().strip()
+
+        os.replace(f"{current_path}.{generation}.tmp", current_path)
+        self._load()
+        # Readers of the older generations keep their memory maps and records handle, which outlive the files.
+        # The replaced generation is only removed by the next write, so a reader that read the old marker but did not
+        # open its files yet can still load it. Newer generations may be the ones of a concurrent writer
+        kept_generations = {generation, previous_generation, os.path.basename(self.generation_path)}
+        for file_name in os.listdir(self.path):
+            file_path = os.path.join(self.path, file_name)
+            if file_name.startswith(self.GENERATION_PREFIX):
+                if file_name not in kept_generations and file_name < generation:
+                    shutil.rmtree(file_path, ignore_errors=True)
+
+            elif file_name.endswith(".npy") or file_name == self.RECORDS_FILE:
+                os.remove(file_path)  # The flat layout written before the generations
+
+    def refresh(self) -> bool:
+        """
+        Reloads the index when another instance wrote a new generation since it was loaded, and returns whether it
+        did. The rows read between two refreshes all come from the same generation.
+        """
+        if self._get_marker_state() == self._marker_state:
+            return False
+
+        self._load()
+        return True
+
+    def warmup(self) -> None:
+        # Touch every page of the memory-mapped vectors the searches scan, so the first search does not fault them in
+        if len(self):
+            float(np.asarray(self.vectors if self.compact_vectors is None else self.compact_vectors).sum())
+
+    def _load(self) -> None:
+        self._marker_state = self._get_marker_state()
+        generation = None
+        if self._marker_state is not None:
+            with open(os.path.join(self.path, self.CURRENT_FILE)) as f:
+                generation = f.read().strip()
+
+        # An index written before the generations has its files directly in path
+        self.generation_path = os.path.join(self.path, generation) if generation else self.path
+        if os.path.exists(self._get_file_path(self.VECTORS_FILE)):
+            self.vectors = np.load(self._get_file_path(self.VECTORS_FILE), mmap_mode="r")
+            self.offsets = np.load(self._get_file_path(self.OFFSETS_FILE), mmap_mode="r")
+            # Pinned with the memory maps, so the offsets always point into the records of their own generation
+            self._records_file = open(self._get_file_path(self.RECORDS_FILE), "rb")
+
+        else:
+            self.vectors = np.empty((0, 0), dtype=np.float32)
+            self.offsets = np.zeros(1, dtype=np.int64)
+            self._records_file = None
+
+        self.ivf_centroids = self.ivf_order = self.ivf_offsets = None
+        if os.path.exists(self._get_file_path(self.IVF_CENTROIDS_FILE)):
+            self.ivf_centroids = np.load(self._get_file_path(self.IVF_CENTROIDS_FILE))
+            self.ivf_order = np.load(self._get_file_path(self.IVF_ORDER_FILE), mmap_mode="r")
+            self.ivf_offsets = np.load(self._get_file_path(self.IVF_OFFSETS_FILE))
+
+        self.compact_vectors = self.compact_scales = None
+        if self.quantization != "none" and len(self):
+            self._load_compact_vectors()
+
+        with self._lock:
+            self._records = None
+
+    def _get_marker_state(self) -> Optional[Tuple[int, int]]:
+        # The marker is replaced, never rewritten in place, so a new inode means a new generation
+        try:
+            stat = os.stat(os.path.join(self.path, self.CURRENT_FILE))
+
+        except FileNotFoundError:
+            return None
+
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _load_compact_vectors(self) -> None:
+        dimensions = min(self.dimensions or self.vectors.shape[1], self.vectors.shape[1])
+        vectors_path = self._get_file_path(self.COMPACT_VECTORS_FILE.format(quantization=self.quantization,
+                                                                            dimensions=dimensions))
+        scales_path = self._get_file_path(self.COMPACT_SCALES_FILE.format(quantization=self.quantization,
+                                                                          dimensions=dimensions))
+        if not os.path.exists(vectors_path):
+            print(f"Building the {self.quantization} copy of {len(self)} vectors, truncated to {dimensions} dimensions")
+            compact_vectors, compact_scales = quantize_vectors(self.vectors, self.quantization, dimensions)
+            if compact_scales is not None:
+                with open(scales_path + ".tmp", "wb") as f:
+                    np.save(f, compact_scales)
+
+                os.replace(scales_path + ".tmp", scales_path)
+
+            # The vectors file is swapped in last, it marks the copy as complete
+            with open(vectors_path + ".tmp", "wb") as f:
+                np.save(f, compact_vectors)
+
+            os.replace(vectors_path + ".tmp", vectors_path)
+
+        self.compact_vectors = np.load(vectors_path, mmap_mode="r")
+        self.compact_scales = np.load(scales_path) if self.quantization == "int8" else None
+
+    def _score(self, queries: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        """
+        Scores the queries against all the rows, or the given ones, on the compact vectors when there are some.
+        """
+        if self.compact_vectors is None:
+            return queries @ (self.vectors if rows is None else self.vectors[rows]).T
+
+        queries = self._normalize(queries[:, :self.compact_vectors.shape[1]])
+        if self.compact_scales is not None:
+            queries = queries * self.compact_scales
+
+        rows_count = len(self) if rows is None else len(rows)
+        scores = np.empty((len(queries), rows_count), dtype=np.float32)
+        # The compact vectors are widened to float32 a block at a time, never as a whole
+        for start in range(0, rows_count, VECTOR_INDEX_BLOCK_ROWS):
+            end = min(start + VECTOR_INDEX_BLOCK_ROWS, rows_count)
+            block = self.compact_vectors[start:end] if rows is None else self.compact_vectors[rows[start:end]]
+            scores[:, start:end] = queries @ block.astype(np.float32).T
+
+        return scores
+
+    def _select(self, query: np.ndarray, scores: np.ndarray, k: int,
+                candidates: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        if self.compact_vectors is None or self.rescore_factor <= 0:
+            return self._top_k(scores, k, candidates)
+
+        shortlist, _ = self._top_k(scores, k * self.rescore_factor, candidates)
+        shortlist = np.sort(shortlist)  # Sequential reads from the memory-mapped vectors
+        return self._top_k(self.vectors[shortlist] @ query, k, shortlist)
+
+    def _search_ivf(self, query: np.ndarray, k: int, mask: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        nprobe = min(self.nprobe, len(self.ivf_centroids))
+        centroid_scores = self.ivf_centroids @ query
+        probed_lists = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        candidates = np.concatenate([self.ivf_order[self.ivf_offsets[list_index]:self.ivf_offsets[list_index + 1]]
+                                     for list_index in probed_lists])
+        if mask is not None:
+            candidates = candidates[mask[candidates]]
+
+        candidates = np.sort(candidates)  # Sequential reads from the memory-mapped vectors
+        return self._select(query, self._score(query[np.newaxis], candidates)[0], k, candidates)
+
+    @staticmethod
+    def _top_k(scores: np.ndarray, k: int, candidates: Optional[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, len(scores))
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        # argpartition finds the top k in linear time, only those k are sorted
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        indices = top if candidates is None else candidates[top]
+        return indices.astype(np.int64), scores[top]
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _get_file_path(self, file_name: str) -> str:
+        return os.path.join(self.generation_path, file_name)
+
+
+def quantize_vectors(vectors: np.ndarray, quantization: str,
+                     dimensions: int) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Truncates L2 normalized vectors to their first dimensions, normalizes them again and quantizes them to float16,
+    or to int8 with the per-dimension scales returned next to the codes. A code times its scale is the value.
+    """
+    def truncate(start: int) -> np.ndarray:
+        return VectorIndex._normalize(np.asarray(vectors[start:start + VECTOR_INDEX_BLOCK_ROWS, :dimensions],
+                                                 dtype=np.float32))
+
+    starts = range(0, len(vectors), VECTOR_INDEX_BLOCK_ROWS)
+    if quantization == "float16":
+        return np.concatenate([truncate(start).astype(np.float16) for start in starts]), None
+
+    # Two passes over the blocks, the scales need the largest value of every dimension first
+    max_values = np.max([np.abs(truncate(start)).max(axis=0) for start in starts], axis=0)
+    scales = np.maximum(max_values, 1e-12) / 127
+    codes = np.concatenate([np.clip(np.rint(truncate(start) / scales), -127, 127).astype(np.int8)
+                            for start in starts])
+    return codes, scales.astype(np.float32)
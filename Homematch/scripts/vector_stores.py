@@ -0,0 +1,283 @@
+import glob
+import os
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import numpy as np
+
+from scripts.embeddings import embed_in_batches, get_collection_name
+from scripts.listing_attribute_index import ListingAttributeIndex
+from scripts.models import ListingDocument, ListingFilter
+from scripts.resources.consts import VECTOR_STORE_BACKEND, VECTOR_INDEX_DIR_NAME, VECTOR_STORE_MAX_WRITE_BATCH_SIZE
+from scripts.vector_index import VectorIndex
+
+if TYPE_CHECKING:
+    from langchain_core.embeddings import Embeddings
+
+
+class ListingsVectorStore:
+    """
+    The interface the searcher and the ingestion use to store and search the embedded listings.
+    Every backend keeps one collection per embedding backend (see EmbeddingBackend.collection_name) under db_path.
+    """
+    name = "base"
+
+    def __init__(self, db_path: str, embeddings: "Embeddings"):
+        self.db_path = db_path
+        self.embeddings = embeddings
+        self._attribute_index = None
+
+    def get_metadatas(self) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    def get_documents(self, ids: List[str]) -> List[ListingDocument]:
+        raise NotImplementedError
+
+    def add_texts(self, texts: List[str], metadatas: List[dict], ids: List[str]) -> None:
+        """
+        Embeds and stores new listings, with their metadata and ids.
+        """
+        raise NotImplementedError
+
+    def update_metadatas(self, ids: List[str], metadatas: List[dict]) -> None:
+        raise NotImplementedError
+
+    def delete(self, ids: List[str]) -> None:
+        raise NotImplementedError
+
+    def search_by_vectors(self, query_embeddings: List[List[float]], k: int,
+                          listing_filter: Optional[ListingFilter] = None) -> List[List[ListingDocument]]:
+        raise NotImplementedError
+
+    def warmup(self) -> None:
+        pass
+
+    def refresh(self) -> bool:
+        """
+        Picks up the writes made by other instances since the last call, and returns whether the store changed.
+        The caches derived from the stored listings are dropped when it did.
+        """
+        return False
+
+    @property
+    def attribute_index(self) -> ListingAttributeIndex:
+        self.refresh()
+        if self._attribute_index is None:
+            stored_metadatas = self.get_metadatas()
+            self._attribute_index = ListingAttributeIndex.from_metadatas(list(stored_metadatas),
+                                                                         list(stored_metadatas.values()))
+
+        return self._attribute_index
+
+
+class ChromaVectorStore(ListingsVectorStore):
+    """
+    The listings in a persistent Chroma collection (SQLite and an HNSW index).
+    Every write replaces a generation marker file next to the collection, so the stores opened by other instances
+    know to drop their caches of the stored listings.
+    """
+    name = "chroma"
+
+    def __init__(self, db_path: str, embeddings: "Embeddings"):
+        super().__init__(db_path, embeddings)
+        from langchain.vectorstores import Chroma
+        self.chroma = Chroma(collection_name=get_collection_name(embeddings), embedding_function=embeddings,
+                             persist_directory=db_path)
+        self.generation_path = os.path.join(db_path, f"{get_collection_name(embeddings)}.generation")
+        self._generation_state = self._get_generation_state()
+
+    def get_metadatas(self) -> Dict[str, dict]:
+        stored_listings = self.chroma._collection.get(include=["metadatas"])
+        return dict(zip(stored_listings["ids"], stored_listings["metadatas"]))
+
+    def get_documents(self, ids: List[str]) -> List[ListingDocument]:
+        stored_listings = self.chroma._collection.get(ids=ids, include=["documents", "metadatas"])
+        documents_by_id = {listing_id: ListingDocument(document, metadata or {})
+                           for listing_id, document, metadata in zip(stored_listings["ids"],
+                                                                     stored_listings["documents"],
+                                                                     stored_listings["metadatas"])}
+        return [documents_by_id[listing_id] for listing_id in ids if listing_id in documents_by_id]
+
+    def add_texts(self, texts: List[str], metadatas: List[dict], ids: List[str]) -> None:
+        # Every embedded batch is written as soon as it comes back, in bulk adds of write_batch_size rows: Chroma
+        # commits once per add, and a single add of the whole corpus would go over its maximal batch size
+        write_batch_size = self._get_write_batch_size()
+        for start, embeddings in embed_in_batches(self.embeddings, texts):
+            for offset in range(0, len(embeddings), write_batch_size):
+                rows = slice(start + offset, start + min(offset + write_batch_size, len(embeddings)))
+                self.chroma._collection.add(ids=ids[rows], embeddings=embeddings[offset:offset + write_batch_size],
+                                            metadatas=metadatas[rows], documents=texts[rows])
+
+        self._publish_generation()
+
+    def update_metadatas(self, ids: List[str], metadatas: List[dict]) -> None:
+        self.chroma._collection.update(ids=ids, metadatas=metadatas)
+        self._publish_generation()
+
+    def delete(self, ids: List[str]) -> None:
+        self.chroma.delete(ids=ids)
+        self._publish_generation()
+
+    def search_by_vectors(self, query_embeddings: List[List[float]], k: int,
+                          listing_filter: Optional[ListingFilter] = None) -> List[List[ListingDocument]]:
+        where = listing_filter.to_chroma_where() if listing_filter is not None else None
+        if len(query_embeddings) == 1:
+            return [[ListingDocument(document.page_content, document.metadata or {})
+                     for document in self.chroma.similarity_search_by_vector(query_embeddings[0], k=k, filter=where)]]
+
+        results = self.chroma._collection.query(query_embeddings=query_embeddings, n_results=k, where=where,
+                                                include=["documents", "metadatas"])
+        return [
+            [ListingDocument(document, metadata or {}) for document, metadata in zip(documents, metadatas)]
+            for documents, metadatas in zip(results["documents"], results["metadatas"])
+        ]
+
+    def warmup(self) -> None:
+        # Page the HNSW segment files (header.bin, link_lists.bin, ...) into the OS cache
+        for segment_file in glob.glob(os.path.join(self.db_path, "*", "*.bin")):
+            with open(segment_file, "rb") as f:
+                while f.read(1 << 20):
+                    pass
+
+        # Chroma loads the HNSW index into memory on the first query against the collection
+        sample = self.chroma._collection.peek(limit=1)
+        if sample["embeddings"] is not None and len(sample["embeddings"]):
+            self.chroma._collection.query(query_embeddings=[list(sample["embeddings"][0])], n_results=1)
+
+    def refresh(self) -> bool:
+        generation_state = self._get_generation_state()
+        if generation_state == self._generation_state:
+            return False
+
+        self._generation_state = generation_state
+        self._attribute_index = None
+        return True
+
+    def _publish_generation(self) -> None:
+        with open(f"{self.generation_path}.{os.getpid()}.tmp", "w") as f:
+            f.write(str(time.time_ns()))
+
+        os.replace(f"{self.generation_path}.{os.getpid()}.tmp", self.generation_path)
+        # This store's own caches are dropped on the next refresh
+        self._generation_state = None
+        self._attribute_index = None
+
+    def _get_generation_state(self) -> Optional[tuple]:
+        # The marker is replaced, never rewritten in place, so a new inode means a new generation
+        try:
+            stat = os.stat(self.generation_path)
+
+        except FileNotFoundError:
+            return None
+
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _get_write_batch_size(self) -> int:
+        client = self.chroma._client
+        # Older Chroma clients expose the limit as max_batch_size
+        max_batch_size = (client.get_max_batch_size() if hasattr(client, "get_max_batch_size")
+                          else getattr(client, "max_batch_size", VECTOR_STORE_MAX_WRITE_BATCH_SIZE))
+        return min(VECTOR_STORE_MAX_WRITE_BATCH_SIZE, max_batch_size)
+
+
+class NumpyVectorStore(ListingsVectorStore):
+    """
+    The listings in a memory-mapped NumPy VectorIndex, with no database in the process.
+    Filters are a mask from the columnar attribute index, applied before the vectors are scored.
+    The compact float16/int8 storage of the index is set with HOMEMATCH_VECTOR_QUANTIZATION and
+    HOMEMATCH_VECTOR_DIMENSIONS.
+    """
+    name = "numpy"
+
+    def __init__(self, db_path: str, embeddings: "Embeddings"):
+        super().__init__(db_path, embeddings)
+        self.index = VectorIndex(os.path.join(db_path, VECTOR_INDEX_DIR_NAME, get_collection_name(embeddings)))
+        self._rows_by_id = None
+
+    def get_metadatas(self) -> Dict[str, dict]:
+        self.refresh()
+        return {record["id"]: record["metadata"] for record in self.index.get_records()}
+
+    def get_documents(self, ids: List[str]) -> List[ListingDocument]:
+        self.refresh()
+        if self._rows_by_id is None:
+            self._rows_by_id = {record["id"]: row for row, record in enumerate(self.index.get_records())}
+
+        rows = [self._rows_by_id[listing_id] for listing_id in ids if listing_id in self._rows_by_id]
+        return self._to_documents(self.index.read_records(rows))
+
+    def add_texts(self, texts: List[str], metadatas: List[dict], ids: List[str]) -> None:
+        self.refresh()
+        records = self.index.get_records()
+        # Each batch is kept as float32 as it comes back, then the whole index is rewritten once
+        batches = {start: np.asarray(embeddings, dtype=np.float32)
+                   for start, embeddings in embed_in_batches(self.embeddings, texts)}
+        vectors = np.vstack([batches[start] for start in sorted(batches)])
+        if len(self.index):
+            vectors = np.vstack([self.index.vectors, vectors])
+
+        self._write([record["id"] for record in records] + ids, vectors,
+                    [record["document"] for record in records] + texts,
+                    [record["metadata"] for record in records] + metadatas)
+
+    def update_metadatas(self, ids: List[str], metadatas: List[dict]) -> None:
+        self.refresh()
+        updated_metadatas = dict(zip(ids, metadatas))
+        records = self.index.get_records()
+        self._write([record["id"] for record in records], self.index.vectors,
+                    [record["document"] for record in records],
+                    [updated_metadatas.get(record["id"], record["metadata"]) for record in records])
+
+    def delete(self, ids: List[str]) -> None:
+        self.refresh()
+        deleted_ids = set(ids)
+        records = self.index.get_records()
+        kept_rows = [row for row, record in enumerate(records) if record["id"] not in deleted_ids]
+        self._write([records[row]["id"] for row in kept_rows], self.index.vectors[kept_rows],
+                    [records[row]["document"] for row in kept_rows],
+                    [records[row]["metadata"] for row in kept_rows])
+
+    def search_by_vectors(self, query_embeddings: List[List[float]], k: int,
+                          listing_filter: Optional[ListingFilter] = None) -> List[List[ListingDocument]]:
+        # The mask, the search and the records all come from the generation loaded here
+        self.refresh()
+        mask = None
+        if listing_filter is not None and not listing_filter.is_empty():
+            mask = self.attribute_index.mask(listing_filter)
+
+        return [self._to_documents(self.index.read_records(indices))
+                for indices, _ in self.index.search(query_embeddings, k, mask)]
+
+    def warmup(self) -> None:
+        self.index.warmup()
+
+    def refresh(self) -> bool:
+        if not self.index.refresh():
+            return False
+
+        self._attribute_index = None
+        self._rows_by_id = None
+        return True
+
+    def _write(self, ids: List[str], vectors, documents: List[str], metadatas: List[dict]) -> None:
+        self.index.write(ids, vectors, documents, metadatas)
+        self._attribute_index = None
+        self._rows_by_id = None
+
+    @staticmethod
+    def _to_documents(records: List[dict]) -> List[ListingDocument]:
+        return [ListingDocument(record["document"], record["metadata"] or {}) for record in records]
+
+
+VECTOR_STORES = {
+    ChromaVectorStore.name: ChromaVectorStore,
+    NumpyVectorStore.name: NumpyVectorStore,
+}
+
+
+def get_vector_store(db_path: str, embeddings: "Embeddings",
+                     name: str = VECTOR_STORE_BACKEND) -> ListingsVectorStore:
+    if name not in VECTOR_STORES:
+        raise ValueError(f"Unknown vector store '{name}', choose one of {sorted(VECTOR_STORES)}")
+
+    return VECTOR_STORES[name](db_path, embeddings)